@@ -0,0 +1,325 @@
+"""
+Event loop server for TransAm
+
+Serves XML-RPC (same wire protocol as the threaded SimpleXMLRPCServer) and the
+binary RPC transport from one asyncio event loop.  Idle and slow client
+connections only cost a socket, and the blocking MySQL work is handed to a
+fixed size thread pool.
+
+Admission control: at most ASYNC_WORKERS requests run at once, and at most
+ASYNC_MAX_QUEUED more wait for a worker.  Anything beyond that is turned away
+immediately (HTTP 503, or an error response for binary RPC), so a burst cant
+queue up unbounded work and memory.
+"""
+
+
+import asyncio
+import concurrent.futures
+import gzip
+import zlib
+import re
+from xmlrpc.server import SimpleXMLRPCDispatcher
+
+import query
+from query import Log, LOG_WARNING
+import binaryrpc
+
+
+# Threads running requests (and their database queries)
+#NOTE(g): A request holds at most one pool connection at a time (a write does its
+#   lookups before its Transaction checks out a connection), so one worker per connection
+ASYNC_WORKERS = query.POOL_MAX_SIZE
+
+# Requests that can wait for a worker, before we turn new ones away
+ASYNC_MAX_QUEUED = 1000
+
+# Methods that wait for something (long-poll).  They run on their own threads, so
+#   waiting doesnt hold up the workers, up to this many at once.
+LONG_POLL_METHODS = ('WaitForCommits',)
+ASYNC_LONG_POLL_WORKERS = 100
+
+# Find the method name in an XML-RPC or binary RPC request, without parsing all of it
+#NOTE(g): Only used to pick the thread pool, so a miss just uses the workers
+METHOD_NAME_XMLRPC = re.compile(rb'<methodName>\s*([^<\s]+)\s*</methodName>')
+METHOD_NAME_BINARY = re.compile(rb'"method":\s*"([^"]+)"')
+
+# Maximum open client connections, new connections beyond this are closed
+ASYNC_MAX_CONNECTIONS = 10000
+
+# Seconds a kept-alive connection can be idle before we close it
+ASYNC_IDLE_TIMEOUT = 300
+
+# Largest HTTP header block and request body we will read
+HTTP_MAX_HEADER_SIZE = 64*1024
+HTTP_MAX_BODY_SIZE = 256*1024*1024
+
+# Paths XML-RPC is served on, as SimpleXMLRPCRequestHandler does
+XMLRPC_PATHS = ('/', '/RPC2')
+
+# Compress XML-RPC responses bigger than this, if the client accepts gzip
+GZIP_MIN_SIZE = 1400
+
+
+class ServerBusy(Exception):
+  """Too many requests are pending to accept another"""
+
+
+class AsyncRPCServer:
+  """Serves an instance's methods over XML-RPC and binary RPC, from an event loop"""
+  
+  def __init__(self, instance, workers=ASYNC_WORKERS, max_queued=ASYNC_MAX_QUEUED,
+               max_connections=ASYNC_MAX_CONNECTIONS):
+    self.instance = instance
+    
+    self.dispatcher = SimpleXMLRPCDispatcher(allow_none=True, encoding=None)
+    self.dispatcher.register_instance(instance)
+    self.dispatcher.register_multicall_functions()
+    
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='AsyncRPCWorker')
+    self.long_poll_executor = concurrent.futures.ThreadPoolExecutor(max_workers=ASYNC_LONG_POLL_WORKERS, thread_name_prefix='AsyncRPCLongPoll')
+    self.workers = workers
+    self.max_queued = max_queued
+    self.max_connections = max_connections
+    
+    # Requests running or waiting for a worker, long-poll requests waiting, and open connections
+    self.pending = 0
+    self.long_polls = 0
+    self.connections = 0
+    
+    self.stats = {'requests':0, 'rejected':0, 'connections_rejected':0}
+  
+  
+  def GetStats(self):
+    """Returns dict of request and connection counts"""
+    stats = dict(self.stats)
+    stats['pending'] = self.pending
+    stats['long_polls'] = self.long_polls
+    stats['connections'] = self.connections
+    stats['workers'] = self.workers
+    
+    return stats
+  
+  
+  async def Serve(self, xmlrpc_address, binary_address=None):
+    """Serve forever on the XML-RPC address (host, port), and binary RPC address if specified"""
+    servers = [await asyncio.start_server(self._HandleXMLRPCConnection, xmlrpc_address[0], xmlrpc_address[1],
+                                          limit=HTTP_MAX_HEADER_SIZE)]
+    
+    if binary_address:
+      servers.append(await asyncio.start_server(self._HandleBinaryConnection, binary_address[0], binary_address[1]))
+    
+    await asyncio.gather(*[server.serve_forever() for server in servers])
+  
+  
+  async def _RunRequest(self, function, *args, method=None):
+    """Returns the result of function(*args) run on a worker thread, or raises ServerBusy"""
+    if method in LONG_POLL_METHODS:
+      return await self._RunLongPoll(function, *args)
+    
+    # Turn it away if too much is already waiting, instead of queueing without bound
+    if self.pending >= self.workers + self.max_queued:
+      self.stats['rejected'] += 1
+      raise ServerBusy('Server busy: %s requests pending' % self.pending)
+    
+    self.pending += 1
+    self.stats['requests'] += 1
+    
+    try:
+      return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+    finally:
+      self.pending -= 1
+  
+  
+  async def _RunLongPoll(self, function, *args):
+    """Returns the result of function(*args) run on a long-poll thread, or raises ServerBusy"""
+    if self.long_polls >= ASYNC_LONG_POLL_WORKERS:
+      self.stats['rejected'] += 1
+      raise ServerBusy('Server busy: %s long-poll requests waiting' % self.long_polls)
+    
+    self.long_polls += 1
+    self.stats['requests'] += 1
+    
+    try:
+      return await asyncio.get_running_loop().run_in_executor(self.long_poll_executor, function, *args)
+    finally:
+      self.long_polls -= 1
+  
+  
+  def _AcceptConnection(self, writer):
+    """Returns boolean, True if we have room for this new connection, else closes it"""
+    if self.connections >= self.max_connections:
+      self.stats['connections_rejected'] += 1
+      writer.close()
+      return False
+    
+    self.connections += 1
+    return True
+  
+  
+  async def _HandleXMLRPCConnection(self, reader, writer):
+    """Handle HTTP requests on one kept-alive connection"""
+    if not self._AcceptConnection(writer):
+      return
+    
+    try:
+      while True:
+        request = await self._ReadHTTPRequest(reader)
+        if request == None:
+          break
+        
+        (method, path, version, headers, body) = request
+        keep_alive = _IsKeepAlive(version, headers)
+        
+        if method != 'POST':
+          await self._WriteHTTPResponse(writer, 501, b'', keep_alive=False)
+          break
+        
+        if path not in XMLRPC_PATHS:
+          await self._WriteHTTPResponse(writer, 404, b'', keep_alive=keep_alive)
+          if not keep_alive:
+            break
+          continue
+        
+        if headers.get('content-encoding', '') == 'gzip':
+          body = gzip.decompress(body)
+        
+        try:
+          response = await self._RunRequest(self.dispatcher._marshaled_dispatch, body, method=_GetMethodName(METHOD_NAME_XMLRPC, body))
+          status = 200
+        except ServerBusy as exc:
+          Log(str(exc), level=LOG_WARNING)
+          (response, status) = (b'', 503)
+        
+        # Compress large responses, if the client accepts it
+        response_headers = {}
+        if status == 200 and len(response) > GZIP_MIN_SIZE and 'gzip' in headers.get('accept-encoding', ''):
+          response = gzip.compress(response)
+          response_headers['Content-Encoding'] = 'gzip'
+        
+        await self._WriteHTTPResponse(writer, status, response, keep_alive=keep_alive, headers=response_headers)
+        if not keep_alive:
+          break
+    
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, OSError, ValueError, zlib.error) as exc:
+      Log('XML-RPC connection failed: %s' % exc)
+    
+    finally:
+      self.connections -= 1
+      writer.close()
+  
+  
+  async def _ReadHTTPRequest(self, reader):
+    """Returns tuple (method, path, version, headers dict, body bytes), or None if the connection closed or went idle"""
+    try:
+      header_block = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), ASYNC_IDLE_TIMEOUT)
+    except asyncio.TimeoutError:
+      return None
+    except asyncio.IncompleteReadError as exc:
+      # Closed between requests is a normal end of a kept-alive connection
+      if not exc.partial:
+        return None
+      raise
+    
+    lines = header_block.decode('latin-1').split('\r\n')
+    (method, path, version) = lines[0].split(' ', 2)
+    
+    headers = {}
+    for line in lines[1:]:
+      if ':' in line:
+        (name, value) = line.split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    
+    length = int(headers.get('content-length', 0))
+    if length > HTTP_MAX_BODY_SIZE:
+      raise ValueError('Request body too large: %s bytes' % length)
+    
+    body = await reader.readexactly(length)
+    
+    return (method, path.split('?')[0], version, headers, body)
+  
+  
+  async def _WriteHTTPResponse(self, writer, status, body, keep_alive=True, headers=None):
+    """Write an HTTP response"""
+    reasons = {200:'OK', 404:'Not Found', 501:'Not Implemented', 503:'Service Unavailable'}
+    
+    lines = ['HTTP/1.1 %s %s' % (status, reasons.get(status, '')),
+             'Content-Type: text/xml',
+             'Content-Length: %s' % len(body)]
+    if not keep_alive:
+      lines.append('Connection: close')
+    for (name, value) in (headers or {}).items():
+      lines.append('%s: %s' % (name, value))
+    
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
+  
+  
+  async def _HandleBinaryConnection(self, reader, writer):
+    """Handle binary RPC frames on one kept-alive connection"""
+    if not self._AcceptConnection(writer):
+      return
+    
+    try:
+      while True:
+        try:
+          header = await asyncio.wait_for(reader.readexactly(binaryrpc.FRAME_HEADER.size), ASYNC_IDLE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+          break
+        
+        (size, flags) = binaryrpc.FRAME_HEADER.unpack(header)
+        if size > binaryrpc.FRAME_MAX_SIZE:
+          Log('Binary RPC frame too large: %s bytes' % size)
+          break
+        
+        body = await reader.readexactly(size)
+        
+        try:
+          method = None
+          if not flags & binaryrpc.FLAG_COMPRESSED:
+            method = _GetMethodName(METHOD_NAME_BINARY, body)
+          
+          response = await self._RunRequest(binaryrpc.HandleRequest, self.instance, body, flags, method=method)
+        except ServerBusy as exc:
+          Log(str(exc), level=LOG_WARNING)
+          response = {'id':None, 'error':str(exc)}
+        
+        writer.write(binaryrpc.EncodeResponse(response, flags))
+        await writer.drain()
+    
+    except (asyncio.IncompleteReadError, ConnectionError, OSError) as exc:
+      Log('Binary RPC connection failed: %s' % exc)
+    
+    finally:
+      self.connections -= 1
+      writer.close()
+
+
+def _GetMethodName(pattern, body):
+  """Returns string, the method name the request body calls, or None if it wasnt found"""
+  match = pattern.search(body)
+  if not match:
+    return None
+  
+  return match.group(1).decode('utf-8', 'replace')
+
+
+def _IsKeepAlive(version, headers):
+  """Returns boolean, True if the HTTP connection stays open after this request"""
+  connection = headers.get('connection', '').lower()
+  
+  if version == 'HTTP/1.0':
+    return connection == 'keep-alive'
+  
+  return connection != 'close'
+
+
+def Serve(instance, xmlrpc_address, binary_address=None):
+  """Run the event loop server forever.  Returns the AsyncRPCServer when the loop stops."""
+  server = AsyncRPCServer(instance)
+  
+  try:
+    asyncio.run(server.Serve(xmlrpc_address, binary_address))
+  except KeyboardInterrupt:
+    pass
+  
+  return server
@@ -0,0 +1,544 @@
+"""
+Database backends for TransAm
+
+query.py does its database work through the backend in query.BACKEND, so the
+rest of TransAm doesnt care which database it is talking to.  A backend covers
+what differs between databases: connecting, schema introspection, quoting,
+parameter style and the current time.  SQL that is the same everywhere is
+left alone (SQLite accepts `quoted` names, LIMIT, multi-row INSERTs and row value IN).
+
+  MySQLBackend:  The default, a MySQL server through MySQLdb
+  SQLiteBackend: Embedded SQLite files in a directory (or in memory), no database
+      server needed.  For small deployments, edge read-caches, and running and
+      benchmarking TransAm locally.
+
+Select a backend before any queries are made:
+
+  query.SetBackend(backend.SQLiteBackend('/var/lib/transam'))
+"""
+
+
+import os
+import re
+import glob
+import time
+import shutil
+import atexit
+import sqlite3
+import tempfile
+import threading
+
+#NOTE(g): MySQLdb is only needed for the MySQL backend
+try:
+  import MySQLdb
+  import MySQLdb.cursors
+  import MySQLdb.converters
+  from MySQLdb.constants import FIELD_TYPE
+except ImportError:
+  MySQLdb = None
+
+
+class BackendFailure(Exception):
+  """The backend cant be used: missing driver, or bad configuration"""
+
+
+class Backend:
+  """Interface for a database backend.  Subclasses implement all of these.
+  
+  Rows are returned as dicts, and SQL templates use %s for each bound param,
+  whatever the driver's own param style is.
+  """
+  
+  # Name for logs and stats
+  name = None
+  
+  # Exception class for all the driver's database errors
+  DatabaseError = Exception
+  
+  # True if the driver returns DATE/TIME/DATETIME values as objects, which
+  #   process.py has to convert back into strings
+  returns_temporal_objects = False
+  
+  # True if the backend creates TransAm's own tables (commit_version, record_version, 
+  #   session, checkpoints), else they are created in MySQL by hand, or by TransAm
+  creates_system_tables = False
+  
+  
+  def Connect(self, host, user, password, database, port):
+    """Returns a new driver connection to database"""
+    raise NotImplementedError()
+  
+  
+  def DescribeConnection(self, host, database):
+    """Returns string, where a connection to database goes, for logs and errors"""
+    raise NotImplementedError()
+  
+  
+  def GetCursor(self, conn, streaming=False):
+    """Returns a cursor returning dict rows.  If streaming, rows are fetched as they are read, not all at once."""
+    raise NotImplementedError()
+  
+  
+  def Ping(self, conn):
+    """Raises DatabaseError if this connection can no longer be used"""
+    raise NotImplementedError()
+  
+  
+  def IsLostConnection(self, exc):
+    """Returns boolean, True if this DatabaseError means the connection is gone, and another should be used"""
+    return False
+  
+  
+  def Execute(self, cursor, sql, params=None):
+    """Execute sql on cursor.  If params (sequence) is specified, sql has a %s for each one."""
+    if params == None:
+      cursor.execute(sql)
+    else:
+      cursor.execute(self.FormatParams(sql), params)
+  
+  
+  def ExecuteMany(self, cursor, sql, params_list):
+    """Execute the sql template for each params sequence in params_list.  Returns int, rows affected."""
+    cursor.executemany(self.FormatParams(sql), params_list)
+    
+    return cursor.rowcount
+  
+  
+  def FormatParams(self, sql):
+    """Returns sql with its %s param markers in the driver's param style"""
+    return sql
+  
+  
+  def QuoteName(self, name):
+    """Returns the quoted name (string) of a database, table, field or index"""
+    return '`%s`' % str(name).replace('`', '``')
+  
+  
+  def GetFields(self, query_function, database, table):
+    """Returns list of dicts, one per field in order, in MySQL DESC format: Field, Type, Null, Key, Default, Extra
+    
+    query_function(sql) returns the result of sql run in database.
+    """
+    raise NotImplementedError()
+  
+  
+  def GetPrimaryKey(self, query_function, database, table):
+    """Returns list of field names (strings) in the table's PRIMARY KEY, in order"""
+    raise NotImplementedError()
+  
+  
+  def GetTables(self, query_function, database):
+    """Returns list of table names (strings) in database"""
+    raise NotImplementedError()
+  
+  
+  def GetDatabases(self, query_function):
+    """Returns list of database names (strings)"""
+    raise NotImplementedError()
+  
+  
+  def GetIndexNames(self, query_function, database, table):
+    """Returns set of the index names (strings) on the table"""
+    raise NotImplementedError()
+  
+  
+  def GetAddIndexSql(self, database, table, name, fields):
+    """Returns SQL (string) to add an index on the fields (sequence of strings) of the table"""
+    raise NotImplementedError()
+  
+  
+  def GetNowSql(self, seconds=0):
+    """Returns SQL expression (string) for the current date and time, plus seconds (int)"""
+    raise NotImplementedError()
+
+
+class _MissingDriverError(Exception):
+  """Stands in for MySQLdb.DatabaseError when MySQLdb isnt installed, so except clauses still work"""
+
+
+class MySQLBackend(Backend):
+  """MySQL server, through MySQLdb"""
+  
+  name = 'MySQL'
+  
+  if MySQLdb != None:
+    DatabaseError = MySQLdb.DatabaseError
+  else:
+    DatabaseError = _MissingDriverError
+  
+  # MySQL error codes that mean our connection is gone: Server has gone away, Lost connection
+  LOST_CONNECTION_ERRORS = (2006, 2013)
+  
+  def __init__(self, temporal_as_string=False):
+    """
+    Args:
+      temporal_as_string: boolean, if True, connections return DATE, TIME, DATETIME and
+          TIMESTAMP values as strings, instead of datetime objects that process.py has to
+          format back into strings.  Strings are exactly what MySQL sent, so DATETIME(6)
+          columns keep their fractional seconds.
+    """
+    self.temporal_as_string = temporal_as_string
+    self.returns_temporal_objects = not temporal_as_string
+  
+  
+  def Connect(self, host, user, password, database, port):
+    if MySQLdb == None:
+      raise BackendFailure('MySQLdb is not installed, it is required for the MySQL backend')
+    
+    options = {'port':port, 'cursorclass':MySQLdb.cursors.DictCursor}
+    if self.temporal_as_string:
+      options['conv'] = self.GetConversions()
+    
+    return MySQLdb.Connect(host, user, password, database, **options)
+  
+  
+  def DescribeConnection(self, host, database):
+    return '%s: %s' % (host, database)
+  
+  
+  def GetConversions(self):
+    """Returns dict, the MySQLdb conv map for new connections, honoring temporal_as_string"""
+    conversions = MySQLdb.converters.conversions.copy()
+    
+    if self.temporal_as_string:
+      for field_type in (FIELD_TYPE.DATE, FIELD_TYPE.NEWDATE, FIELD_TYPE.TIME, FIELD_TYPE.DATETIME, FIELD_TYPE.TIMESTAMP):
+        conversions[field_type] = str
+    
+    return conversions
+  
+  
+  def GetCursor(self, conn, streaming=False):
+    if streaming:
+      return conn.cursor(MySQLdb.cursors.SSDictCursor)
+    
+    return conn.cursor()
+  
+  
+  def Ping(self, conn):
+    conn.ping()
+  
+  
+  def IsLostConnection(self, exc):
+    return bool(exc.args) and exc.args[0] in self.LOST_CONNECTION_ERRORS
+  
+  
+  def ExecuteMany(self, cursor, sql, params_list):
+    #NOTE(g): MySQLdb sends an INSERT as multi-row INSERTs
+    return cursor.executemany(sql, params_list)
+  
+  
+  def GetFields(self, query_function, database, table):
+    return list(query_function('DESC %s' % self.QuoteName(table)))
+  
+  
+  def GetPrimaryKey(self, query_function, database, table):
+    # Sort the PRIMARY KEY fields by their sequence order (ensure its correct)
+    sequence = {}
+    for item in query_function('SHOW INDEXES IN %s' % self.QuoteName(table)):
+      if item['Key_name'] == 'PRIMARY':
+        sequence[item['Seq_in_index']] = item['Column_name']
+    
+    return [sequence[count] for count in sorted(sequence.keys())]
+  
+  
+  def GetTables(self, query_function, database):
+    return [list(item.values())[0] for item in query_function('SHOW TABLES')]
+  
+  
+  def GetDatabases(self, query_function):
+    return [list(item.values())[0] for item in query_function('SHOW DATABASES')]
+  
+  
+  def GetIndexNames(self, query_function, database, table):
+    return set([item['Key_name'] for item in query_function('SHOW INDEXES IN %s' % self.QuoteName(table))])
+  
+  
+  def GetAddIndexSql(self, database, table, name, fields):
+    return 'ALTER TABLE %s ADD INDEX %s (%s)' % (self.QuoteName(table), self.QuoteName(name),
+                                                 ', '.join([self.QuoteName(field) for field in fields]))
+  
+  
+  def GetNowSql(self, seconds=0):
+    if seconds:
+      return 'NOW() + INTERVAL %d SECOND' % int(seconds)
+    
+    return 'NOW()'
+
+
+# SQLite databases are files in the backend's directory, named: (database).sqlite
+SQLITE_FILE_SUFFIX = '.sqlite'
+
+# Empty database file each connection opens as its main database, see SQLiteBackend.Connect()
+SQLITE_MAIN_FILE = '.main'
+
+# Seconds a connection waits for another connection's write lock, before failing
+SQLITE_BUSY_TIMEOUT = 30
+
+# Most databases a connection can ATTACH, SQLite's default SQLITE_MAX_ATTACHED.  Only
+#   raise it if your SQLite was compiled with a bigger one.
+SQLITE_MAX_ATTACHED = 10
+
+# Journal mode for the database files, or None for SQLite's default (rollback journal)
+#NOTE(g): 'WAL' lets reads run during writes, but a transaction over several
+#   WAL databases is not atomic across them, and every commit writes the
+#   system database and the table's database.  So the default is left alone.
+SQLITE_JOURNAL_MODE = None
+
+# TransAm's own tables, created in the system database of a SQLiteBackend
+SQLITE_SYSTEM_TABLES_SQL = [
+  """CREATE TABLE IF NOT EXISTS `commit_version` (
+    `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+    `user` VARCHAR(255),
+    `comment` TEXT,
+    `created` DATETIME NOT NULL DEFAULT (DATETIME('now', 'localtime'))
+  )""",
+  """CREATE TABLE IF NOT EXISTS `record_version` (
+    `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+    `version` INTEGER NOT NULL,
+    `database` VARCHAR(255) NOT NULL,
+    `table` VARCHAR(255) NOT NULL,
+    `record` VARCHAR(255) NOT NULL,
+    `data` TEXT,
+    `is_deleted` INTEGER NOT NULL DEFAULT 0
+  )""",
+  """CREATE TABLE IF NOT EXISTS `session` (
+    `key` VARCHAR(255) NOT NULL PRIMARY KEY,
+    `application` VARCHAR(255),
+    `user` VARCHAR(255),
+    `expire` DATETIME,
+    `created` DATETIME NOT NULL DEFAULT (DATETIME('now', 'localtime'))
+  )""",
+  """CREATE TABLE IF NOT EXISTS `version_checkpoint` (
+    `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+    `database` VARCHAR(255) NOT NULL,
+    `table` VARCHAR(255) NOT NULL,
+    `version` INTEGER NOT NULL,
+    `record_count` INTEGER NOT NULL DEFAULT 0,
+    `created` DATETIME NOT NULL DEFAULT (DATETIME('now', 'localtime'))
+  )""",
+  #NOTE(g): SQLite index names are per database, not per table, so this cant have the same name as a record_version index
+  """CREATE INDEX IF NOT EXISTS `version_checkpoint_database_table_version` ON `version_checkpoint` (`database`, `table`, `version`)""",
+  """CREATE TABLE IF NOT EXISTS `version_checkpoint_record` (
+    `checkpoint` INTEGER NOT NULL,
+    `record` VARCHAR(255) NOT NULL,
+    `data` TEXT,
+    PRIMARY KEY (`checkpoint`, `record`)
+  )""",
+]
+
+
+def _DictRow(cursor, row):
+  """sqlite3 row_factory returning dict rows, like MySQLdb's DictCursor"""
+  return dict(zip([column[0] for column in cursor.description], row))
+
+
+def _Now():
+  """Returns string, the local date and time, as MySQL's NOW() does"""
+  return time.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class SQLiteBackend(Backend):
+  """Embedded SQLite, one file per database in a directory.
+  
+  Each connection ATTACHes every database file under its database name, its
+  own database first, so unqualified table names are found in its database,
+  and `database`.`table` works for the rest, the same as MySQL.  Databases are
+  created with CreateDatabase(), and new connections see them.  Tables must be
+  created as `database`.`table`.  SQLite attaches at most SQLITE_MAX_ATTACHED 
+  databases, so that is the most databases (with the system database) a directory
+  can have.
+  
+  The host, user, password and port of a connection are ignored.
+  """
+  
+  name = 'SQLite'
+  
+  DatabaseError = sqlite3.DatabaseError
+  
+  creates_system_tables = True
+  
+  def __init__(self, path=None, system_database='transam'):
+    """
+    Args:
+      path: string or None, directory of the database files, created if needed.  If None
+          or ':memory:', a temporary directory (in /dev/shm if there is one) is used,
+          and removed when the process exits.
+      system_database: string, database for TransAm's own tables (commit_version,
+          record_version, session, etc), which are created if they dont exist
+    """
+    #NOTE(g): A real :memory: database is private to one connection, so it
+    #   cant be shared by a connection pool
+    if path == None or path == ':memory:':
+      memory_dir = None
+      if os.path.isdir('/dev/shm'):
+        memory_dir = '/dev/shm'
+      
+      path = tempfile.mkdtemp(prefix='transam_', dir=memory_dir)
+      atexit.register(shutil.rmtree, path, True)
+    
+    elif not os.path.isdir(path):
+      os.makedirs(path)
+    
+    self.path = path
+    self.system_database = system_database
+    
+    self.lock = threading.Lock()
+    
+    self.CreateDatabase(system_database)
+    self._CreateSystemTables()
+  
+  
+  def CreateDatabase(self, database):
+    """Create the database file, if it doesnt exist"""
+    if not database or os.path.basename(database) != database or database.startswith('.'):
+      raise BackendFailure('Invalid SQLite database name: %s' % database)
+    
+    with self.lock:
+      if os.path.exists(self._GetPath(database)):
+        return
+      
+      # Every connection attaches every database, so one more than it can would break them all
+      self._CheckDatabaseCount(len(self.GetDatabases(None)) + 1)
+      
+      conn = sqlite3.connect(self._GetPath(database))
+      try:
+        if SQLITE_JOURNAL_MODE:
+          conn.execute('PRAGMA journal_mode = %s' % SQLITE_JOURNAL_MODE)
+        conn.commit()
+      finally:
+        conn.close()
+  
+  
+  def Connect(self, host, user, password, database, port):
+    if not database:
+      database = self.system_database
+    
+    if not os.path.exists(self._GetPath(database)):
+      raise BackendFailure('Unknown SQLite database: %s: %s' % (self.path, database))
+    
+    #NOTE(g): The main database is an empty file, only so transactions over several
+    #   attached databases are atomic (they arent if main is :memory:).  Pooled 
+    #   connections are used by one thread at a time, but not always the same thread.
+    conn = sqlite3.connect(os.path.join(self.path, SQLITE_MAIN_FILE), timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+    conn.row_factory = _DictRow
+    conn.create_function('NOW', 0, _Now)
+    
+    # Our database first, so unqualified table names are found in it
+    databases = [database] + [name for name in self.GetDatabases(None) if name != database]
+    self._CheckDatabaseCount(len(databases))
+    
+    for name in databases:
+      conn.execute('ATTACH DATABASE ? AS %s' % self.QuoteName(name), (self._GetPath(name),))
+    
+    return conn
+  
+  
+  def GetCursor(self, conn, streaming=False):
+    #NOTE(g): sqlite3 cursors always read rows as they are fetched
+    return conn.cursor()
+  
+  
+  def Ping(self, conn):
+    conn.execute('SELECT 1')
+  
+  
+  def FormatParams(self, sql):
+    #NOTE(g): Like MySQLdb, a literal % in bound sql is written %%
+    return re.sub('%([s%])', lambda match: '?' if match.group(1) == 's' else '%', sql)
+  
+  
+  def QuoteName(self, name):
+    return '"%s"' % str(name).replace('"', '""')
+  
+  
+  def GetFields(self, query_function, database, table):
+    rows = query_function('PRAGMA %s.table_info(%s)' % (self.QuoteName(database), self.QuoteName(table)))
+    
+    key_count = len([row for row in rows if row['pk']])
+    
+    fields = []
+    for row in rows:
+      item = {'Field':row['name'], 'Type':row['type'].lower() or 'text', 'Default':row['dflt_value'], 'Extra':''}
+      
+      if row['notnull'] or row['pk']:
+        item['Null'] = 'NO'
+      else:
+        item['Null'] = 'YES'
+      
+      if row['pk']:
+        item['Key'] = 'PRI'
+      else:
+        item['Key'] = ''
+      
+      # An INTEGER PRIMARY KEY is the rowid, which is assigned like an auto_increment
+      if row['pk'] and key_count == 1 and row['type'].upper() == 'INTEGER':
+        item['Extra'] = 'auto_increment'
+      
+      fields.append(item)
+    
+    return fields
+  
+  
+  def GetPrimaryKey(self, query_function, database, table):
+    rows = query_function('PRAGMA %s.table_info(%s)' % (self.QuoteName(database), self.QuoteName(table)))
+    rows = sorted([row for row in rows if row['pk']], key=lambda row: row['pk'])
+    
+    return [row['name'] for row in rows]
+  
+  
+  def GetTables(self, query_function, database):
+    sql = "SELECT `name` FROM %s.`sqlite_master` WHERE `type` = 'table' AND `name` NOT LIKE 'sqlite_%%'" % self.QuoteName(database)
+    
+    return [item['name'] for item in query_function(sql)]
+  
+  
+  def GetDatabases(self, query_function):
+    paths = glob.glob(os.path.join(glob.escape(self.path), '*%s' % SQLITE_FILE_SUFFIX))
+    
+    return sorted([os.path.basename(path)[:-len(SQLITE_FILE_SUFFIX)] for path in paths])
+  
+  
+  def GetIndexNames(self, query_function, database, table):
+    rows = query_function('PRAGMA %s.index_list(%s)' % (self.QuoteName(database), self.QuoteName(table)))
+    
+    return set([row['name'] for row in rows])
+  
+  
+  def GetAddIndexSql(self, database, table, name, fields):
+    # SQLite index names are per database, the index goes in the table's database
+    return 'CREATE INDEX IF NOT EXISTS %s.%s ON %s (%s)' % (self.QuoteName(database), self.QuoteName(name), self.QuoteName(table),
+                                                             ', '.join([self.QuoteName(field) for field in fields]))
+  
+  
+  def GetNowSql(self, seconds=0):
+    if seconds:
+      return "DATETIME('now', 'localtime', '%+d seconds')" % int(seconds)
+    
+    return 'NOW()'
+  
+  
+  def DescribeConnection(self, host, database):
+    return self._GetPath(database or self.system_database)
+  
+  
+  def _GetPath(self, database):
+    """Returns string, the file path of the database"""
+    return os.path.join(self.path, database + SQLITE_FILE_SUFFIX)
+  
+  
+  def _CheckDatabaseCount(self, count):
+    """Raises BackendFailure if a connection cant attach count databases"""
+    if count > SQLITE_MAX_ATTACHED:
+      raise BackendFailure('Too many SQLite databases: %s: %s databases, but a connection can only attach %s (SQLITE_MAX_ATTACHED)' % \
+                           (self.path, count, SQLITE_MAX_ATTACHED))
+  
+  
+  def _CreateSystemTables(self):
+    """Create TransAm's own tables in the system database, if they dont exist"""
+    conn = sqlite3.connect(self._GetPath(self.system_database), timeout=SQLITE_BUSY_TIMEOUT)
+    try:
+      for sql in SQLITE_SYSTEM_TABLES_SQL:
+        conn.execute(sql)
+      conn.commit()
+    finally:
+      conn.close()
@@ -0,0 +1,555 @@
+#!/usr/local/bin/python3
+
+"""
+TransAm benchmark
+
+Drives mixed GetMany, SetMany, DeleteMany and versioned GetMany workloads at
+several concurrency levels, and reports throughput, latency percentiles and
+database queries per RPC.  Results can be written as JSON, and compared with
+an earlier run, to see if a change made things faster or slower.
+
+By default a TransAm server is started on embedded SQLite in a temporary
+directory, and seeded.  With --url, an already running server is used instead
+(on MySQL, say), which must have the benchmark tables (see --print-schema).
+
+  ./benchmark.py --rows 10000 --width 10 --history 5 --concurrency 1,4,16 --output results.json
+  ./benchmark.py --mix get=80,set=20 --compare results.json
+"""
+
+
+import sys
+import os
+import json
+import math
+import time
+import random
+import socket
+import string
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+import binaryrpc
+
+
+# Database the benchmark tables are created in, and their names: bench_0, bench_1, ...
+BENCH_DATABASE = 'bench'
+BENCH_TABLE_PREFIX = 'bench_'
+
+# Workload mixes: operation weights.  Or specified with --mix get=80,set=20
+MIXES = {
+  'read':{'get':90, 'get_version':5, 'set':5},
+  'mixed':{'get':60, 'get_version':10, 'set':25, 'delete':5},
+  'write':{'get':20, 'set':70, 'delete':10},
+}
+
+# Operations, and the RPC each one calls
+OPERATIONS = {'get':'GetMany', 'get_version':'GetMany', 'set':'SetMany', 'delete':'DeleteMany'}
+
+# Latency percentiles reported
+PERCENTILES = (50, 90, 95, 99)
+
+# Seconds to wait for a started server to accept connections
+SERVER_START_TIMEOUT = 30
+
+
+class BenchmarkFailure(Exception):
+  """The benchmark could not be run"""
+
+
+def ParseArgs(args):
+  """Returns argparse.Namespace of the benchmark options"""
+  parser = argparse.ArgumentParser(description='Benchmark the TransAm RPCs')
+  
+  parser.add_argument('--url', help='Use this running server (http://host:1967/ or transam://host:1968/), instead of starting one')
+  parser.add_argument('--transport', choices=('binary', 'xmlrpc'), default='binary', help='RPC transport, for a started server')
+  parser.add_argument('--server-mode', choices=('threaded', 'async'), default='threaded', help='Server core, for a started server')
+  parser.add_argument('--sqlite-path', help='Directory for the started server\'s SQLite files (default: temporary, in memory)')
+  
+  parser.add_argument('--tables', type=int, default=1, help='Tables to seed')
+  parser.add_argument('--rows', type=int, default=10000, help='Records seeded in each table')
+  parser.add_argument('--width', type=int, default=10, help='Fields in each record, besides its id')
+  parser.add_argument('--value-size', type=int, default=32, help='Characters in each field value')
+  parser.add_argument('--history', type=int, default=3, help='Versions of each record seeded')
+  parser.add_argument('--batch-size', type=int, default=500, help='Records per SetMany while seeding')
+  parser.add_argument('--no-seed', action='store_true', help='Use the records already seeded on --url')
+  
+  parser.add_argument('--mix', default='mixed', help='Workload: %s, or weights like get=80,set=20' % ', '.join(sorted(MIXES)))
+  parser.add_argument('--keys', type=int, default=10, help='Records each operation reads or writes')
+  parser.add_argument('--concurrency', default='1,4,16', help='Comma separated client thread counts to run')
+  parser.add_argument('--duration', type=float, default=10.0, help='Seconds to run each concurrency level')
+  parser.add_argument('--profile-calls', type=int, default=50, help='Calls of each operation, one at a time, to count DB queries per RPC')
+  parser.add_argument('--random-seed', type=int, default=1967, help='Seed, so runs pick the same keys and values')
+  
+  parser.add_argument('--output', help='Write the results to this JSON file')
+  parser.add_argument('--compare', help='Compare with the results in this JSON file')
+  parser.add_argument('--print-schema', action='store_true', help='Print the MySQL CREATE TABLEs for --url, and exit')
+  parser.add_argument('--allow-errors', action='store_true', help='Exit 0 even if some RPCs failed')
+  
+  options = parser.parse_args(args)
+  
+  options.concurrency = [int(count) for count in options.concurrency.split(',')]
+  options.mix_weights = ParseMix(options.mix)
+  
+  return options
+
+
+def ParseMix(mix):
+  """Returns dict of operation weights, for a MIXES name or 'op=weight,op=weight'"""
+  if mix in MIXES:
+    return dict(MIXES[mix])
+  
+  weights = {}
+  for item in mix.split(','):
+    (operation, weight) = item.split('=')
+    if operation not in OPERATIONS:
+      raise BenchmarkFailure('Unknown operation in mix: %s (use: %s)' % (operation, ', '.join(sorted(OPERATIONS))))
+    
+    weights[operation] = float(weight)
+  
+  return weights
+
+
+def GetTableNames(options):
+  """Returns list of the benchmark table names"""
+  return ['%s%s' % (BENCH_TABLE_PREFIX, count) for count in range(options.tables)]
+
+
+def GetCreateTableSql(options, table, mysql=False):
+  """Returns the CREATE TABLE SQL (string) for a benchmark table"""
+  fields = ['`f%s` VARCHAR(%s)' % (count, max(options.value_size, 1)) for count in range(options.width)]
+  
+  if mysql:
+    return 'CREATE TABLE `%s` (`id` INT NOT NULL, %s, PRIMARY KEY (`id`))' % (table, ', '.join(fields))
+  
+  return 'CREATE TABLE `%s`.`%s` (`id` INTEGER NOT NULL PRIMARY KEY, %s)' % (BENCH_DATABASE, table, ', '.join(fields))
+
+
+def CreateSQLiteDatabase(options, path):
+  """Create the SQLite files for a started server: the TransAm tables, and empty benchmark tables"""
+  import query
+  import backend
+  
+  query.LOG_LEVEL = query.LOG_WARNING
+  sqlite_backend = backend.SQLiteBackend(path)
+  query.SetBackend(sqlite_backend)
+  
+  sqlite_backend.CreateDatabase(BENCH_DATABASE)
+  for table in GetTableNames(options):
+    query.Query(GetCreateTableSql(options, table), database=BENCH_DATABASE)
+  
+  query.CloseAll()
+
+
+def _GetFreePort():
+  """Returns int, a TCP port nothing is listening on"""
+  sock = socket.socket()
+  sock.bind(('127.0.0.1', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  
+  return port
+
+
+def StartServer(options):
+  """Start a TransAm server on SQLite in another process.  Returns tuple (subprocess.Popen, url, temporary directory or None)."""
+  temp_dir = None
+  path = options.sqlite_path
+  if path == None:
+    memory_dir = None
+    if os.path.isdir('/dev/shm'):
+      memory_dir = '/dev/shm'
+    temp_dir = tempfile.TemporaryDirectory(prefix='transam_bench_', dir=memory_dir)
+    path = temp_dir.name
+  
+  path = os.path.abspath(path)
+  CreateSQLiteDatabase(options, path)
+  
+  (port, binary_port) = (_GetFreePort(), _GetFreePort())
+  command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'transam.py'),
+             '--sqlite=%s' % path, '--port=%s' % port, '--binary-port=%s' % binary_port, '--%s' % options.server_mode]
+  
+  # Run in the data directory, so the server's log file goes there
+  server = subprocess.Popen(command, cwd=path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  
+  if options.transport == 'binary':
+    url = 'transam://127.0.0.1:%s/' % binary_port
+  else:
+    url = 'http://127.0.0.1:%s/' % port
+  
+  # Wait for the server to listen
+  start_time = time.time()
+  while True:
+    if server.poll() != None:
+      raise BenchmarkFailure('Server exited at startup: %s' % ' '.join(command))
+    
+    try:
+      socket.create_connection(('127.0.0.1', binary_port if options.transport == 'binary' else port), timeout=1).close()
+      break
+    except OSError:
+      if time.time() - start_time > SERVER_START_TIMEOUT:
+        server.kill()
+        raise BenchmarkFailure('Server did not start listening: %s' % ' '.join(command))
+      time.sleep(0.1)
+  
+  return (server, url, temp_dir)
+
+
+def _Call(proxy, method, *params):
+  """Returns the result of the RPC, raising BenchmarkFailure if it returned an error"""
+  result = getattr(proxy, method)(*params)
+  
+  if isinstance(result, dict) and '[error]' in result:
+    raise BenchmarkFailure('%s failed: %s' % (method, result['[error]']))
+  
+  return result
+
+
+def _CreateRecord(rng, options, key):
+  """Returns dict, a benchmark record with random field values"""
+  record = {'id':key}
+  for count in range(options.width):
+    record['f%s' % count] = ''.join(rng.choice(string.ascii_letters) for _ in range(options.value_size))
+  
+  return record
+
+
+def _GetNewestVersion(proxy, session_id):
+  """Returns int, the newest commit version, or 0"""
+  result = _Call(proxy, 'ListCommits', session_id, None, None, 1, True)
+  if not result:
+    return 0
+  
+  return max([int(version) for version in result.keys()])
+
+
+def Seed(proxy, session_id, options):
+  """Seed the benchmark tables with --history versions of --rows records.  Returns list of the versions after each round."""
+  rng = random.Random(options.random_seed)
+  keys = [str(key) for key in range(1, options.rows + 1)]
+  
+  versions = []
+  for round_count in range(options.history):
+    for table in GetTableNames(options):
+      for offset in range(0, len(keys), options.batch_size):
+        records = dict([(key, _CreateRecord(rng, options, key)) for key in keys[offset:offset + options.batch_size]])
+        _Call(proxy, 'SetMany', session_id, BENCH_DATABASE, table, records, 'Benchmark seed %s' % round_count)
+    
+    versions.append(_GetNewestVersion(proxy, session_id))
+  
+  return versions
+
+
+def RunOperation(proxy, session_id, rng, options, operation, versions):
+  """Run one benchmark operation: a GetMany, versioned GetMany, SetMany or DeleteMany of --keys random records"""
+  table = rng.choice(GetTableNames(options))
+  keys = [str(rng.randint(1, options.rows)) for _ in range(options.keys)]
+  
+  if operation == 'get':
+    return _Call(proxy, 'GetMany', session_id, BENCH_DATABASE, table, keys)
+  
+  elif operation == 'get_version':
+    return _Call(proxy, 'GetMany', session_id, BENCH_DATABASE, table, keys, rng.choice(versions))
+  
+  elif operation == 'set':
+    records = dict([(key, _CreateRecord(rng, options, key)) for key in keys])
+    return _Call(proxy, 'SetMany', session_id, BENCH_DATABASE, table, records, 'Benchmark')
+  
+  elif operation == 'delete':
+    return _Call(proxy, 'DeleteMany', session_id, BENCH_DATABASE, table, keys, 'Benchmark')
+  
+  raise BenchmarkFailure('Unknown operation: %s' % operation)
+
+
+def GetQueryCount(proxy, session_id):
+  """Returns int, the database queries the server has run, from its pool stats"""
+  stats = _Call(proxy, 'GetPoolStats', session_id)
+  
+  return sum([pool_stats.get('queries', 0) for pool_stats in stats.values()])
+
+
+def GetCacheCounts(proxy, session_id):
+  """Returns dict of the server's GetMany cache hits and misses, or {} if it has no cache"""
+  try:
+    stats = _Call(proxy, 'GetCacheStats', session_id)
+  #NOTE(g): Older servers dont have GetCacheStats
+  except Exception:
+    return {}
+  
+  counts = {}
+  for tier in ('live', 'versioned'):
+    if tier in stats:
+      counts['%s_hits' % tier] = stats[tier]['hits']
+      counts['%s_misses' % tier] = stats[tier]['misses']
+  
+  return counts
+
+
+def GetLatencyStats(latencies):
+  """Returns dict of latency mean, max and percentiles, in milliseconds"""
+  if not latencies:
+    return {}
+  
+  latencies = sorted(latencies)
+  stats = {'mean':sum(latencies) / len(latencies) * 1000.0, 'max':latencies[-1] * 1000.0}
+  
+  # Nearest rank percentiles
+  for percentile in PERCENTILES:
+    rank = max(int(math.ceil(percentile / 100.0 * len(latencies))) - 1, 0)
+    stats['p%s' % percentile] = latencies[rank] * 1000.0
+  
+  return stats
+
+
+def Profile(url, session_id, options, versions):
+  """Run each operation in the mix --profile-calls times, one at a time.  Returns dict of DB queries and latency per operation."""
+  proxy = binaryrpc.ServerProxy(url)
+  rng = random.Random(options.random_seed + 1)
+  
+  results = {}
+  for operation in sorted(options.mix_weights.keys()):
+    if operation == 'get_version' and not versions:
+      continue
+    
+    latencies = []
+    start_queries = GetQueryCount(proxy, session_id)
+    
+    for _ in range(options.profile_calls):
+      start_time = time.time()
+      RunOperation(proxy, session_id, rng, options, operation, versions)
+      latencies.append(time.time() - start_time)
+    
+    queries = GetQueryCount(proxy, session_id) - start_queries
+    
+    results[operation] = {'rpc':OPERATIONS[operation], 'calls':options.profile_calls,
+                          'db_queries_per_call':queries / float(max(options.profile_calls, 1)),
+                          'latency_ms':GetLatencyStats(latencies)}
+  
+  return results
+
+
+def RunLevel(url, session_id, options, concurrency, versions):
+  """Run the mix with this many client threads for --duration seconds.  Returns dict of the results."""
+  operations = sorted([operation for operation in options.mix_weights if operation != 'get_version' or versions])
+  weights = [options.mix_weights[operation] for operation in operations]
+  
+  # Each thread keeps its own results, so they dont wait on each other.  'first_error' is (time, message) or None.
+  thread_results = [dict([(operation, {'latencies':[], 'errors':0, 'first_error':None}) for operation in operations])
+                    for _ in range(concurrency)]
+  start_event = threading.Event()
+  
+  def Worker(thread_count):
+    proxy = binaryrpc.ServerProxy(url)
+    rng = random.Random(options.random_seed + 100 + thread_count)
+    results = thread_results[thread_count]
+    
+    start_event.wait()
+    while time.time() < stop_time:
+      operation = rng.choices(operations, weights)[0]
+      
+      start_time = time.time()
+      try:
+        RunOperation(proxy, session_id, rng, options, operation, versions)
+        results[operation]['latencies'].append(time.time() - start_time)
+      except Exception as exc:
+        results[operation]['errors'] += 1
+        if results[operation]['first_error'] == None:
+          results[operation]['first_error'] = (start_time, '%s: %s' % (type(exc).__name__, exc))
+  
+  control_proxy = binaryrpc.ServerProxy(url)
+  start_queries = GetQueryCount(control_proxy, session_id)
+  start_cache = GetCacheCounts(control_proxy, session_id)
+  
+  threads = [threading.Thread(target=Worker, args=(count,), name='BenchmarkClient%s' % count) for count in range(concurrency)]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+  
+  start_time = time.time()
+  stop_time = start_time + options.duration
+  start_event.set()
+  
+  for thread in threads:
+    thread.join()
+  
+  seconds = time.time() - start_time
+  queries = GetQueryCount(control_proxy, session_id) - start_queries
+  end_cache = GetCacheCounts(control_proxy, session_id)
+  
+  # Combine the threads' results for each operation
+  rpcs = {}
+  total_ops = 0
+  total_errors = 0
+  for operation in operations:
+    latencies = []
+    errors = 0
+    first_errors = []
+    for results in thread_results:
+      latencies += results[operation]['latencies']
+      errors += results[operation]['errors']
+      if results[operation]['first_error'] != None:
+        first_errors.append(results[operation]['first_error'])
+    
+    total_ops += len(latencies)
+    total_errors += errors
+    
+    # The error message of the earliest failed call, from any thread
+    first_error = None
+    if first_errors:
+      first_error = min(first_errors)[1]
+    
+    rpcs[operation] = {'rpc':OPERATIONS[operation], 'count':len(latencies), 'errors':errors, 'first_error':first_error,
+                       'throughput':len(latencies) / seconds, 'latency_ms':GetLatencyStats(latencies)}
+  
+  return {'concurrency':concurrency, 'seconds':seconds, 'ops':total_ops, 'errors':total_errors,
+          'throughput':total_ops / seconds, 'db_queries':queries, 'db_queries_per_op':queries / float(max(total_ops, 1)),
+          'cache':dict([(name, end_cache[name] - start_cache.get(name, 0)) for name in end_cache]), 'rpcs':rpcs}
+
+
+def GetEnvironment():
+  """Returns dict describing where the benchmark ran, so results can be matched up"""
+  environment = {'python':platform.python_version(), 'platform':platform.platform(), 'cpus':os.cpu_count(),
+                 'time':time.strftime('%Y-%m-%d %H:%M:%S')}
+  
+  try:
+    environment['commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                                    stderr=subprocess.DEVNULL).decode('utf-8').strip()
+  except (OSError, subprocess.CalledProcessError):
+    environment['commit'] = None
+  
+  return environment
+
+
+def PrintReport(results):
+  """Print the results as tables"""
+  print('Seed: %(rows)s rows x %(tables)s tables, %(history)s versions, %(seconds).1fs' % results['seed'])
+  
+  print('\nDB queries per call (one at a time):')
+  for (operation, profile) in sorted(results['profile'].items()):
+    print('  %-12s %-11s %6.2f queries  p50 %7.2fms' % (operation, profile['rpc'], profile['db_queries_per_call'],
+                                                       profile['latency_ms'].get('p50', 0)))
+  
+  for level in results['levels']:
+    print('\nConcurrency %(concurrency)s: %(throughput).1f ops/s, %(errors)s errors, %(db_queries_per_op).2f DB queries/op' % level)
+    if level['cache']:
+      print('  Cache: %s' % ', '.join(['%s %s' % (name, count) for (name, count) in sorted(level['cache'].items())]))
+    
+    print('  %-12s %8s %10s %9s %9s %9s %9s %9s' % ('operation', 'count', 'ops/s', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for (operation, rpc) in sorted(level['rpcs'].items()):
+      latency = rpc['latency_ms']
+      print('  %-12s %8s %10.1f %9.2f %9.2f %9.2f %9.2f %9.2f' % (operation, rpc['count'], rpc['throughput'], latency.get('mean', 0),
+                                                                 latency.get('p50', 0), latency.get('p95', 0), latency.get('p99', 0),
+                                                                 latency.get('max', 0)))
+    
+    for (operation, rpc) in sorted(level['rpcs'].items()):
+      if rpc['errors']:
+        print('  %s: %s errors, first: %s' % (operation, rpc['errors'], _GetErrorSummary(rpc.get('first_error'))))
+
+
+def _GetErrorSummary(message):
+  """Returns string, the first and last lines of an error message, without a server traceback between them"""
+  lines = [line.strip() for line in (message or '').strip().splitlines() if line.strip()]
+  if len(lines) <= 1:
+    return ''.join(lines)
+  
+  return '%s ... %s' % (lines[0], lines[-1])
+
+
+def _Change(new, old):
+  """Returns string, the percent change from old to new"""
+  if not old:
+    return '   n/a'
+  
+  return '%+6.1f%%' % ((new - old) / old * 100.0)
+
+
+def PrintComparison(results, baseline):
+  """Print the throughput and latency changes from the baseline results, for matching concurrency levels and operations"""
+  print('\nCompared with %s (commit %s):' % (baseline['environment'].get('time'), baseline['environment'].get('commit')))
+  
+  baseline_levels = dict([(level['concurrency'], level) for level in baseline.get('levels', [])])
+  
+  for level in results['levels']:
+    old_level = baseline_levels.get(level['concurrency'])
+    if old_level == None:
+      continue
+    
+    print('  Concurrency %s: throughput %s, DB queries/op %s' % (level['concurrency'], _Change(level['throughput'], old_level['throughput']),
+                                                               _Change(level['db_queries_per_op'], old_level['db_queries_per_op'])))
+    
+    for (operation, rpc) in sorted(level['rpcs'].items()):
+      old_rpc = old_level['rpcs'].get(operation)
+      if old_rpc == None:
+        continue
+      
+      print('    %-12s ops/s %s  p50 %s  p99 %s' % (operation, _Change(rpc['throughput'], old_rpc['throughput']),
+                                                  _Change(rpc['latency_ms'].get('p50', 0), old_rpc['latency_ms'].get('p50', 0)),
+                                                  _Change(rpc['latency_ms'].get('p99', 0), old_rpc['latency_ms'].get('p99', 0))))
+
+
+def Main(args=None):
+  options = ParseArgs(args)
+  
+  if options.print_schema:
+    for table in GetTableNames(options):
+      print('%s;' % GetCreateTableSql(options, table, mysql=True))
+    return 0
+  
+  server = None
+  temp_dir = None
+  url = options.url
+  
+  try:
+    if url == None:
+      (server, url, temp_dir) = StartServer(options)
+    
+    proxy = binaryrpc.ServerProxy(url)
+    session_id = _Call(proxy, 'Authenticate', 'benchmark', '', 'benchmark')['session']
+    
+    # Seed the tables, or find the versions already seeded
+    start_time = time.time()
+    if options.no_seed:
+      versions = sorted([int(version) for version in _Call(proxy, 'ListCommits', session_id, None, None, options.history, True).keys()])
+    else:
+      versions = Seed(proxy, session_id, options)
+    
+    results = {'config':dict([(name, value) for (name, value) in vars(options).items() if name not in ('compare', 'output')]),
+               'environment':GetEnvironment(),
+               'seed':{'rows':options.rows, 'tables':options.tables, 'history':options.history, 'versions':versions,
+                       'seconds':time.time() - start_time},
+               'profile':Profile(url, session_id, options, versions),
+               'levels':[]}
+    
+    for concurrency in options.concurrency:
+      results['levels'].append(RunLevel(url, session_id, options, concurrency, versions))
+  
+  finally:
+    if server != None:
+      server.terminate()
+      server.wait()
+    if temp_dir != None:
+      temp_dir.cleanup()
+  
+  PrintReport(results)
+  
+  if options.compare:
+    PrintComparison(results, json.load(open(options.compare)))
+  
+  if options.output:
+    fp = open(options.output, 'w')
+    json.dump(results, fp, indent=2, sort_keys=True)
+    fp.close()
+  
+  # Failed RPCs make the numbers meaningless, so fail the run unless they are expected
+  total_errors = sum([level['errors'] for level in results['levels']])
+  if total_errors and not options.allow_errors:
+    sys.stderr.write('%s RPCs failed, see the errors above (use --allow-errors to exit 0 anyway)\n' % total_errors)
+    return 1
+  
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv[1:]))
@@ -0,0 +1,255 @@
+"""
+Result cache for GetMany
+
+Two LRU caches, each bounded by the (estimated) bytes of the results in it:
+
+  Live: current table data, keyed on (database, table, keys).  Writes to a table
+      through TransAm invalidate its entries when they are committed or rolled
+      back.  Entries also expire after CACHE_LIVE_TTL seconds, so writes made
+      around TransAm are seen eventually.
+  
+  Versioned: table data at a version, keyed on (database, table, version, keys).
+      A committed version never changes, so these are never invalidated, only
+      evicted.
+
+Cached results are shared between callers, so they must not be changed.
+"""
+
+
+import collections
+import threading
+import time
+
+
+# Set to False to always read from the database
+CACHE_ENABLED = True
+
+# Bytes of results each tier can hold, before the least recently used are evicted
+CACHE_LIVE_MAX_BYTES = 128*1024*1024
+CACHE_VERSIONED_MAX_BYTES = 128*1024*1024
+
+# Results bigger than this are not cached, so one full table read cant flush everything else
+CACHE_ENTRY_MAX_BYTES = 16*1024*1024
+
+# Seconds a live result is used, or None to only drop them when TransAm writes the table
+CACHE_LIVE_TTL = 60
+
+# Estimated bytes of a record, and of each field, on top of their values
+RECORD_OVERHEAD_BYTES = 240
+FIELD_OVERHEAD_BYTES = 120
+
+
+class LRUCache:
+  """Least recently used cache, bounded by the bytes of its values.  Safe to share between threads."""
+  
+  def __init__(self, max_bytes, ttl=None):
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    
+    # Key is the cache key, value is (value, size, expire time or None, tag), oldest use first
+    self.entries = collections.OrderedDict()
+    self.bytes = 0
+    
+    # Cache keys of each tag, so they can be removed together
+    self.tags = {}
+    self.lock = threading.Lock()
+    
+    self.stats = {'hits':0, 'misses':0, 'stores':0, 'evictions':0, 'expired':0, 'invalidations':0, 'too_large':0}
+  
+  
+  def Get(self, cache_key):
+    """Returns the cached value, or None if it isnt cached"""
+    with self.lock:
+      entry = self.entries.get(cache_key)
+      
+      if entry == None:
+        self.stats['misses'] += 1
+        return None
+      
+      (value, size, expire, tag) = entry
+      
+      if expire != None and time.time() >= expire:
+        self._Remove(cache_key)
+        self.stats['expired'] += 1
+        self.stats['misses'] += 1
+        return None
+      
+      self.entries.move_to_end(cache_key)
+      self.stats['hits'] += 1
+      
+      return value
+  
+  
+  def Set(self, cache_key, value, size, tag=None):
+    """Cache value, which is size bytes, evicting the least recently used entries to make room.
+    
+    If tag is specified, RemoveTag(tag) removes this and every other entry with the tag.
+    """
+    if size > min(self.max_bytes, CACHE_ENTRY_MAX_BYTES):
+      with self.lock:
+        self.stats['too_large'] += 1
+      return
+    
+    expire = None
+    if self.ttl != None:
+      expire = time.time() + self.ttl
+    
+    with self.lock:
+      if cache_key in self.entries:
+        self._Remove(cache_key)
+      
+      self.entries[cache_key] = (value, size, expire, tag)
+      self.bytes += size
+      if tag != None:
+        self.tags.setdefault(tag, set()).add(cache_key)
+      self.stats['stores'] += 1
+      
+      while self.bytes > self.max_bytes:
+        self._Remove(next(iter(self.entries)))
+        self.stats['evictions'] += 1
+  
+  
+  def RemoveTag(self, tag):
+    """Remove all the entries cached with this tag"""
+    with self.lock:
+      for cache_key in list(self.tags.get(tag, ())):
+        self._Remove(cache_key)
+        self.stats['invalidations'] += 1
+  
+  
+  def Clear(self):
+    """Remove everything"""
+    with self.lock:
+      self.stats['invalidations'] += len(self.entries)
+      self.entries.clear()
+      self.tags.clear()
+      self.bytes = 0
+  
+  
+  def GetStats(self):
+    """Returns dict of hit/miss counts and size"""
+    with self.lock:
+      stats = dict(self.stats)
+      stats['entries'] = len(self.entries)
+      stats['bytes'] = self.bytes
+      stats['max_bytes'] = self.max_bytes
+    
+    lookups = stats['hits'] + stats['misses']
+    if lookups:
+      stats['hit_rate'] = stats['hits'] / lookups
+    else:
+      stats['hit_rate'] = 0.0
+    
+    return stats
+  
+  
+  def _Remove(self, cache_key):
+    """Remove a cached key.  Must hold self.lock."""
+    (value, size, expire, tag) = self.entries.pop(cache_key)
+    self.bytes -= size
+    
+    if tag != None:
+      self.tags[tag].discard(cache_key)
+      if not self.tags[tag]:
+        del self.tags[tag]
+
+
+LIVE_CACHE = LRUCache(CACHE_LIVE_MAX_BYTES, ttl=CACHE_LIVE_TTL)
+VERSIONED_CACHE = LRUCache(CACHE_VERSIONED_MAX_BYTES)
+
+# How many times each (database, table) has been invalidated
+#NOTE(g): A read gets the generation before it queries, and its result is only
+#   cached if no write finished in between, so a read that raced a write cant
+#   put the old data back after the write invalidated it.
+LIVE_TABLE_GENERATION = {}
+LIVE_TABLE_LOCK = threading.Lock()
+
+
+def _GetKeysKey(keys):
+  """Returns hashable cache key part for the keys GetMany was asked for (sequence or None)"""
+  if keys == None:
+    return None
+  
+  return tuple(sorted(set(keys), key=str))
+
+
+def GetLive(database, table, keys):
+  """Returns tuple (cached GetMany result or None, generation to pass to SetLive())"""
+  with LIVE_TABLE_LOCK:
+    generation = LIVE_TABLE_GENERATION.get((database, table), 0)
+  
+  if not CACHE_ENABLED:
+    return (None, generation)
+  
+  return (LIVE_CACHE.Get((database, table, _GetKeysKey(keys))), generation)
+
+
+def SetLive(database, table, keys, result, generation):
+  """Cache a current GetMany result, read after GetLive() returned generation"""
+  if not CACHE_ENABLED:
+    return
+  
+  cache_key = (database, table, _GetKeysKey(keys))
+  size = EstimateSize(result)
+  
+  # Hold the table lock, so an invalidation cant happen between our check and store
+  with LIVE_TABLE_LOCK:
+    if LIVE_TABLE_GENERATION.get((database, table), 0) != generation:
+      return
+    
+    LIVE_CACHE.Set(cache_key, result, size, tag=(database, table))
+
+
+def InvalidateTable(database, table):
+  """Drop the live results of this table.  Call after every write to it is committed or rolled back."""
+  with LIVE_TABLE_LOCK:
+    LIVE_TABLE_GENERATION[(database, table)] = LIVE_TABLE_GENERATION.get((database, table), 0) + 1
+    
+    LIVE_CACHE.RemoveTag((database, table))
+
+
+def GetVersioned(database, table, version, keys):
+  """Returns the cached GetMany result at version, or None"""
+  if not CACHE_ENABLED:
+    return None
+  
+  return VERSIONED_CACHE.Get((database, table, version, _GetKeysKey(keys)))
+
+
+def SetVersioned(database, table, version, keys, result):
+  """Cache a GetMany result at version.  Only for versions that are committed, as they never change."""
+  if not CACHE_ENABLED:
+    return
+  
+  VERSIONED_CACHE.Set((database, table, version, _GetKeysKey(keys)), result, EstimateSize(result))
+
+
+def Clear():
+  """Remove all cached results"""
+  with LIVE_TABLE_LOCK:
+    for table_key in LIVE_TABLE_GENERATION:
+      LIVE_TABLE_GENERATION[table_key] += 1
+    
+    LIVE_CACHE.Clear()
+  
+  VERSIONED_CACHE.Clear()
+
+
+def GetStats():
+  """Returns dict, 'live' and 'versioned' are dicts of each tier's hits, misses, entries and bytes"""
+  return {'enabled':CACHE_ENABLED, 'live':LIVE_CACHE.GetStats(), 'versioned':VERSIONED_CACHE.GetStats()}
+
+
+def EstimateSize(result):
+  """Returns int, estimated bytes of a GetMany result (dict of key: record dict)"""
+  size = 0
+  
+  for (key, record) in result.items():
+    size += RECORD_OVERHEAD_BYTES + len(str(key))
+    
+    for value in record.values():
+      size += FIELD_OVERHEAD_BYTES
+      if isinstance(value, (str, bytes)):
+        size += len(value)
+  
+  return size
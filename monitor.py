@@ -1,9 +1,11 @@
 #!/usr/local/bin/python3
 
 import sys
-import xmlrpc.client
 
-proxy = xmlrpc.client.ServerProxy('http://transam.your.domain.com:1967/', allow_none=True)
+import binaryrpc
+
+#NOTE(g): Use transam://transam.your.domain.com:1968/ for the binary RPC transport
+proxy = binaryrpc.ServerProxy('http://transam.your.domain.com:1967/')
 result = proxy.GetMany("", 'test_db', 'test_item', ['1001'])
 
 if '1001' in result and 'name' in result['1001']:
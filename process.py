@@ -19,12 +19,41 @@ Design Notes (ghowland):
 
 from traceback import format_tb
 import json
+import base64
+import threading
+import time
+import datetime
 
 import query
-from query import Log, Query, SanitizeSQL
+from query import Log, Query
 
 import versioning
 import session
+import cache
+
+
+# Cache of GetSchemaInfo() results, keyed on (database, table), value is (time cached, schema)
+#NOTE(g): Schemas rarely change, and each write was fetching them several 
+#   times.  ALTERs are detected by a field mismatch in GetMany, or the cache
+#   can be cleared with the ClearSchemaCache RPC.
+SCHEMA_CACHE = {}
+SCHEMA_CACHE_LOCK = threading.Lock()
+
+# Seconds to keep a cached schema before fetching it again
+SCHEMA_CACHE_TTL = 300
+
+# Cache of parameterized SQL templates from _GetSqlTemplate(), keyed on 
+#   (database, table, operation, fields, key_fields, update_fields), value is (sql, bind_fields)
+SQL_TEMPLATE_CACHE = {}
+SQL_TEMPLATE_CACHE_LOCK = threading.Lock()
+
+# Cache of _GetColumnConverters() results, keyed on the schema field types, value is list of (field, converter)
+COLUMN_CONVERTER_CACHE = {}
+COLUMN_CONVERTER_CACHE_LOCK = threading.Lock()
+
+# Records per page for GetManyPage(), by default and at most
+PAGE_SIZE_DEFAULT = 1000
+PAGE_SIZE_MAX = 10000
 
 
 def Authenticate(user, password, application):
@@ -36,45 +65,113 @@ def Authenticate(user, password, application):
 
 
 def GetSchemaInfo(session_id, database, table):
-  """Returns a dict of schema info to assist in processing."""
-  data = {'schema':{}, 'key_fields':[]}
+  """Returns a dict of schema info to assist in processing.
+  
+  Schema info is cached per (database, table) for SCHEMA_CACHE_TTL seconds, 
+  or until ClearSchemaCache() is called for it.
+  """
+  cache_key = (database, table)
+  
+  # If we have a fresh cached schema, return it
+  with SCHEMA_CACHE_LOCK:
+    if cache_key in SCHEMA_CACHE:
+      (cache_time, data) = SCHEMA_CACHE[cache_key]
+      if time.time() - cache_time < SCHEMA_CACHE_TTL:
+        return data
   
-  # Get the table DESC
-  sql = 'DESC `%s`' % table
-  result = query.Query(sql, database=database)
+  data = {'schema':{}, 'key_fields':[], 'field_types':{}}
+  
+  # Get the table fields, in DESC format
+  result = query.GetTableFields(database, table)
   field_order = 0
   for item in result:
     data['schema'][item['Field']] = item
     data['schema'][item['Field']]['_Order'] = field_order
     field_order += 1
+    
+    # Get a simplified SQL field type, so we dont have to parse it per record
+    sql_type = item['Type'].lower()
+    if '(' in sql_type:
+      sql_type = sql_type.split('(')[0]
+    data['field_types'][item['Field']] = sql_type
   
-  # Get the table PRIMARY KEY INDEX
-  sequence = {}
-  sql = 'SHOW INDEXES IN `%s`' % table
-  result = query.Query(sql, database=database)
-  for item in result:
-    if item['Key_name'] == 'PRIMARY':
-      sequence[item['Seq_in_index']] = item
+  # Get the table PRIMARY KEY fields, in their sequence order
+  data['key_fields'] = query.GetPrimaryKeyFields(database, table)
   
-  # Add the PRIMARY KEY keys by their sequence order (ensure its correct)
-  sequence_keys = list(sequence.keys())
-  sequence_keys.sort()
-  for sequence_key in sequence_keys:
-    data['key_fields'].append(sequence[sequence_key]['Column_name'])
+  # Cache the schema
+  with SCHEMA_CACHE_LOCK:
+    SCHEMA_CACHE[cache_key] = (time.time(), data)
   
   return data
 
 
-def GetDatabaseTables(session_id, database):
-  """Returns a dict of schema info to assist in processing."""
-  data = []
+def ClearSchemaCache(session_id, database=None, table=None):
+  """Clear cached schema info, so it is fetched again from the database.
   
-  # Get the table DESC
-  sql = 'SHOW TABLES'
-  result = query.Query(sql, database=database)
-  for item in result:
-    data.append(item[list(item.keys())[0]])
+  Args:
+    session_id: string, session ID
+    database: string or None, if None, all databases are cleared
+    table: string or None, if None, all tables in the database are cleared
   
+  Returns: list of [database, table] pairs that were cleared
+  """
+  cleared = []
+  
+  with SCHEMA_CACHE_LOCK:
+    for cache_key in list(SCHEMA_CACHE.keys()):
+      if database != None and cache_key[0] != database:
+        continue
+      if table != None and cache_key[1] != table:
+        continue
+      
+      del SCHEMA_CACHE[cache_key]
+      cleared.append(list(cache_key))
+  
+  # Templates for the cleared tables will never be used again
+  with SQL_TEMPLATE_CACHE_LOCK:
+    for template_key in list(SQL_TEMPLATE_CACHE.keys()):
+      if list(template_key[:2]) in cleared:
+        del SQL_TEMPLATE_CACHE[template_key]
+  
+  # Cached results of the cleared tables may have the old fields
+  for (cleared_database, cleared_table) in cleared:
+    cache.InvalidateTable(cleared_database, cleared_table)
+  
+  if cleared:
+    Log('Cleared schema cache: %s' % cleared)
+  
+  return cleared
+
+
+def _IsSchemaMismatch(schema, record):
+  """Returns boolean, True if the fields in this record do not match the schema fields.
+  
+  This means the table was altered after we cached the schema.
+  """
+  return set(record.keys()) != set(schema['schema'].keys())
+
+
+def GetPoolStats(session_id):
+  """Returns dict of database connection pool stats, keyed on 'host:port/database'."""
+  return query.GetPoolStats()
+
+
+def GetCacheStats(session_id):
+  """Returns dict of GetMany result cache stats, 'live' and 'versioned' are dicts of each tier's hits, misses, entries and bytes."""
+  return cache.GetStats()
+
+
+def EnsureRecordVersionIndexes(session_id):
+  """Add any record_version indexes TransAm needs that are missing.  This can take a while on a big record_version.
+  
+  Returns list of strings, the index names added
+  """
+  return versioning.EnsureRecordVersionIndexes()
+
+
+def GetDatabaseTables(session_id, database):
+  """Returns a dict of schema info to assist in processing."""
+  data = query.GetTables(database)
   data.sort()
   
   return data
@@ -82,19 +179,20 @@ def GetDatabaseTables(session_id, database):
 
 def GetDatabases(session_id):
   """Returns a list of database tables."""
-  data = []
-  
-  # Get the table DESC
-  sql = 'SHOW DATABASES'
-  result = query.Query(sql)
-  for item in result:
-    data.append(item[list(item.keys())[0]])
-  
+  data = query.GetDatabases()
   data.sort()
   
   return data
 
 
+def _GetTableSql(database, table):
+  """Returns the quoted table name (string) for SQL, with the database if specified."""
+  if database:
+    return '%s.%s' % (query.QuoteName(database), query.QuoteName(table))
+  else:
+    return query.QuoteName(table)
+
+
 def _CreateSchemaKey(schema, record):
   """Takes the schema result of GetSchemaInfo() and record data dict and returns the key as string."""
   key = ''
@@ -109,9 +207,81 @@ def _CreateSchemaKey(schema, record):
   return key
 
 
-def GetMany(session_id, database, table, keys=None, version=None):
+def _ParseSchemaKey(schema, key):
+  """Takes the schema result of GetSchemaInfo() and a key string (from _CreateSchemaKey) and
+  returns a list of the PKEY field values, or None if the key cannot be split unambiguously.
+  """
+  # Single field PKEYs are the whole string, no splitting required
+  if len(schema['key_fields']) == 1:
+    return [str(key)]
+  
+  values = str(key).split(',')
+  
+  # If a value had a comma in it, we cant tell which field it belongs to
+  if len(values) != len(schema['key_fields']):
+    return None
+  
+  return values
+
+
+def _CreateKeyWhereSql(schema, keys, table_alias=None):
+  """Returns a list of SQL WHERE clauses, each restricting to a batch of keys, with their key values as %s params.
+  
+  Args:
+    schema: dict, from GetSchemaInfo()
+    keys: sequence of strings, keys from _CreateSchemaKey()
+    table_alias: string or None, if specified, fields are prefixed with this table alias
+  
+  Returns: list of tuples (where (string), params (list)), or None if any key could not be parsed (caller must not restrict)
+  """
+  # No PKEY, so we cant restrict on it
+  if not schema['key_fields']:
+    return None
+  
+  if table_alias:
+    fields = ['%s.%s' % (query.QuoteName(table_alias), query.QuoteName(field)) for field in schema['key_fields']]
+  else:
+    fields = [query.QuoteName(field) for field in schema['key_fields']]
+  
+  # Convert all the keys into their PKEY field values, removing duplicates
+  key_values = []
+  seen_keys = set()
+  for key in keys:
+    if key in seen_keys:
+      continue
+    seen_keys.add(key)
+  
+    values = _ParseSchemaKey(schema, key)
+    if values == None:
+      return None
+  
+    #NOTE(g): Always bind key values as strings, they come from the client as strings 
+    #   and MySQL will convert them for numeric columns, without losing the index
+    key_values.append([str(value) for value in values])
+  
+  # Create a WHERE clause for each batch of keys
+  where_list = []
+  for offset in range(0, len(key_values), query.KEY_BATCH_SIZE):
+    batch = key_values[offset:offset + query.KEY_BATCH_SIZE]
+  
+    # Single field PKEY, use a normal IN list
+    if len(fields) == 1:
+      where = '%s IN (%s)' % (fields[0], ', '.join(['%s'] * len(batch)))
+  
+    # Multiple field PKEY, use a row constructor IN list
+    else:
+      where = '(%s) IN (%s)' % (', '.join(fields), ', '.join(['(%s)' % ', '.join(['%s'] * len(fields))] * len(batch)))
+  
+    where_list.append((where, [value for values in batch for value in values]))
+  
+  return where_list
+
+
+def GetMany(session_id, database, table, keys=None, version=None, use_cache=True):
   """Returns dict with PKEY digest as key, and dict of key/value for the fields of this Row/Record
   
+  Results are cached (see cache.py), so they must not be changed by the caller.
+  
   Args:
     session_id: string, session ID
     database: string, database name
@@ -119,6 +289,8 @@ def GetMany(session_id, database, table, keys=None, version=None):
     keys: sequence of strings or None, if a sequence of strings, only records who have a key
         that matches one in this sequence will be returned
     version: int or None, if an int, the data will be returned from the specified version number
+    use_cache: boolean, if False, always read from the database, and dont cache the result.
+        Writes use this, so they always decide from what is really stored.
   
   Returns: dict with PKEY digest as key, and dict of key/value for the fields of this Row/Record
   """
@@ -127,73 +299,78 @@ def GetMany(session_id, database, table, keys=None, version=None):
   try:
     # If we dont want versioned data
     if version == None:
-      # Get all the records in this table, no versioning
-      #TODO(g): Optimize this by restricting them first.  Because PKEY can be 
-      #   multiple fields this is harder than if it was always an "id" type 
-      #   field, so this will take some work.
-      sql = "SELECT * FROM `%s`" % table
-    
-      sql_result = query.Query(sql, database=database)
+      # Use the cached result, if no write has invalidated it
+      if use_cache:
+        (cached, generation) = cache.GetLive(database, table, keys)
+        if cached != None:
+          return cached
+      
+      # Get the records in this table, no versioning
+      sql = 'SELECT * FROM %s' % _GetTableSql(database, table)
+      
+      # If we specified keys, restrict the SELECT to them in batches
+      #NOTE(g): If a key cant be parsed back into its PKEY fields (comma in a
+      #   multi-field PKEY value), we fall back to the full table scan below
+      where_list = None
+      if keys != None:
+        keys = set(keys)
+        where_list = _CreateKeyWhereSql(schema, keys)
+      
+      # If we asked for no keys, there is nothing to get
+      if where_list == []:
+        sql_result = []
+      elif where_list:
+        sql_result = []
+        for (where, params) in where_list:
+          sql_result += query.Query('%s WHERE %s' % (sql, where), database=database, params=params)
+      else:
+        sql_result = query.Query(sql, database=database)
+      
+      # If the table was altered since we cached the schema, get it again
+      if sql_result and _IsSchemaMismatch(schema, sql_result[0]):
+        Log('Schema mismatch, refreshing: %s: %s' % (database, table))
+        ClearSchemaCache(session_id, database, table)
+        schema = GetSchemaInfo(session_id, database, table)
+      
+      # Clean out object garbage put in by MySQLdb, so we have pure data
+      #NOTE(g): Only the temporal fields need it, and none do if the backend 
+      #   returns them as strings in the first place
+      converters = _GetColumnConverters(schema)
+      
       result = {}
       for item in sql_result:
         key = _CreateSchemaKey(schema, item)
         if keys == None or key in keys:
-          # Clean out object garbage put in by MySQLdb, so we have pure data
-          #NOTE(g): I'd turn off the feature, but that doesnt seem to be an
-          #   option.  Later I can possibly monkey-path the __repr__ function
-          #   but that seems more dangerous than this.  Faster though...
-          item = _CleanObjectGarbage(schema, item)
+          if converters:
+            item = _CleanObjectGarbage(converters, item)
         
           result[key] = item
+      
+      if use_cache:
+        cache.SetLive(database, table, keys, result, generation)
     
     # Else, we want a specific version of the data
     else:
-      # Get all the record versions for this database/table, where the 
-      #   version is less than or equal to the specified version
-      #NOTE(g): This allows us to collect up deleted data at this version
-      #   and to skip data that did not exist yet at this version.
-      sql = "SELECT * FROM `record_version` WHERE `database` = '%s' AND `table` = '%s' AND `version` <= %s ORDER BY `version` DESC" % \
-            (SanitizeSQL(database), SanitizeSQL(table), int(version))
-      sql_result = query.Query(sql)
+      version = int(version)
       
-      # Keep track of record keys that have been deleted, so we dont add them.  
-      #   This is due to not being able to use "LIMIT 1" on individual 
-      #   records, so I track it here to provide the protection to avoid 
-      #   adding in records that were marked as deleted and NOT added to the 
-      #   result set.
-      deleted_records = []
+      result = None
+      if use_cache:
+        result = cache.GetVersioned(database, table, version, keys)
       
-      # Create a result after pulling out the 'data' field, unless 
-      #   'is_deleted'==1, and then do not include this record in the results
-      result = {}
-      for item in sql_result:
-        # Skip deleted entries
-        if item['is_deleted'] == 1:
-          # Add this record key to deleted items, to skip any possible add 
-          #   to result set on already-found deleted items
-          deleted_records.append(item['record'])
-          continue
+      if result == None:
+        # Only a committed version never changes, newer ones can still get commits
+        #NOTE(g): Check before reading, a commit that finishes after our read isnt in it
+        cacheable = use_cache and version <= versioning.GetCommittedVersion()
         
-        # Skip if we specified record keys, and this record isnt in them
-        #TODO(g):OPTIMIZE: Gets all the data, throws away what isnt needed.  
-        #   This has scaling issues, but is the fastest way to get it working
-        #   and typically all our data sets are small enough in Corp that this
-        #   method should be fine.  Fix when its a problem...
-        if keys != None and item['record'] not in keys:
-          continue
+        result = versioning.GetRecordsAtVersion(database, table, version, keys=keys)
         
-        # Get the data and unpack it
-        #TODO(g):OPTIMIZE: Second optimization problem, I cant use "LIMIT 1"
-        #   in the SQL because I want all the data for different records,
-        #   but only the top version.  Im discarding all earlier versions
-        #   so only the first one shows up, which should be the top
-        if item['record'] not in result and item['record'] not in deleted_records:
-          result[item['record']] = json.loads(item['data'])
+        if cacheable:
+          cache.SetVersioned(database, table, version, keys, result)
       
   
   except Exception as exc:
     error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
-    Log(error)
+    Log(error, level=query.LOG_ERROR)
     result = {'[error]':error}
   
   #Log('Result: %s' % str(result))
@@ -201,268 +378,734 @@ def GetMany(session_id, database, table, keys=None, version=None):
   return result
 
 
-def SetMany(session_id, database, table, records, comment=None):
+def GetManyPage(session_id, database, table, page_size=None, cursor=None):
+  """Returns one page of the records in a table, in PRIMARY KEY order.
+  
+  Walk the whole table by passing the returned cursor back in, until it is None.  
+  Each page only reads its own rows, so any page costs the same.
+  
+  Args:
+    session_id: string, session ID
+    database: string, database name
+    table: string, table name
+    page_size: int or None, maximum records to return, up to PAGE_SIZE_MAX.  If None, PAGE_SIZE_DEFAULT
+    cursor: string or None, cursor returned with the previous page.  If None, start at the first record
+  
+  Returns: dict, 'records' is dict like GetMany() returns, 'cursor' is string to get the 
+      next page, or None if this is the last page
+  """
+  schema = GetSchemaInfo(session_id, database, table)
+  
+  if not schema['key_fields']:
+    raise ValueError('Table has no PRIMARY KEY to page by: %s: %s' % (database, table))
+  
+  if page_size == None:
+    page_size = PAGE_SIZE_DEFAULT
+  page_size = max(1, min(int(page_size), PAGE_SIZE_MAX))
+  
+  # Get the records after the cursor, in PRIMARY KEY order
+  #NOTE(g): Get 1 more than the page, so we know if there is another page
+  sql = 'SELECT * FROM %s' % _GetTableSql(database, table)
+  params = None
+  if cursor:
+    (where, params) = _CreateKeyAfterSql(schema, _DecodePageCursor(schema, cursor))
+    sql += ' WHERE %s' % where
+  sql += ' ORDER BY %s LIMIT %s' % (', '.join([query.QuoteName(field) for field in schema['key_fields']]), page_size + 1)
+  
+  converters = _GetColumnConverters(schema)
+  
+  records = {}
+  last_record = None
+  next_cursor = None
+  for item in query.QueryIter(sql, database=database, params=params):
+    # There is another page, it starts after the last record we are returning
+    if len(records) == page_size:
+      next_cursor = _EncodePageCursor(schema, last_record)
+      continue
+    
+    last_record = item
+    records[_CreateSchemaKey(schema, item)] = _CleanObjectGarbage(converters, item)
+  
+  return {'records':records, 'cursor':next_cursor}
+
+
+def _EncodePageCursor(schema, record):
+  """Returns string, an opaque cursor for GetManyPage() to continue after this record"""
+  values = [str(record[field]) for field in schema['key_fields']]
+  
+  return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def _DecodePageCursor(schema, cursor):
+  """Returns list of PRIMARY KEY values (strings) from a cursor from _EncodePageCursor()"""
+  try:
+    values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+  except (ValueError, TypeError) as exc:
+    raise ValueError('Invalid page cursor: %s: %s' % (cursor, exc))
+  
+  if not isinstance(values, list) or len(values) != len(schema['key_fields']):
+    raise ValueError('Page cursor does not match the table PRIMARY KEY: %s' % cursor)
+  
+  return [str(value) for value in values]
+
+
+def _CreateKeyAfterSql(schema, values):
+  """Returns tuple (SQL WHERE clause (string), params (list)) for records after these PRIMARY KEY values, in PRIMARY KEY order.
+  
+  Written as (a > 1) OR (a = 1 AND b > 2), as MySQL uses the index for this, and not for (a, b) > (1, 2)
+  """
+  where_list = []
+  params = []
+  for count in range(len(schema['key_fields'])):
+    where = ['%s = %%s' % query.QuoteName(field) for field in schema['key_fields'][:count]]
+    where.append('%s > %%s' % query.QuoteName(schema['key_fields'][count]))
+    params += values[:count + 1]
+    
+    where_list.append('(%s)' % ' AND '.join(where))
+  
+  return (' OR '.join(where_list), params)
+
+
+def SetMany(session_id, database, table, records, comment=None, expected_version=None, return_counts=False):
   """Sets many records for a given database and table
   
+  Records that are identical to what is stored are skipped (no record version, 
+  no write), and existing records only have their changed fields UPDATEd.
+  
   Args:
     session_id: string, session ID
     database: string, database name
     table: string, table name
-    keys: sequence of strings or None, if a sequence of strings, only records who have a key
-        that matches one in this sequence will be returned
-    version: int or None, if an int, the data will be returned from the specified version number
+    records: dict, key is the record key (string), value is dict of the record data
+    comment: string or None, comment for this commit
+    expected_version: int or None, if an int, no records are set if any of them have
+        been changed after this version (raises versioning.VersionConflict)
+    return_counts: boolean, if True, return the counts of inserted, updated and unchanged records too
   
-  Returns: dict with PKEY digest as key, and dict of key/value for the fields of this Row/Record
+  Returns: dict with PKEY digest as key, and dict of key/value for the fields of this Row/Record.
+      If return_counts, dict: {'records':(that dict), 'counts':{'inserted':int, 'updated':int, 'unchanged':int}}
+  """
+  # Hold this table's write lock while we decide what to write, and write it
+  with query.GetTableWriteLock(database, table):
+    plan = _PrepareSetRecords(session_id, database, table, records, expected_version=expected_version)
+    
+    # If nothing changed, there is nothing to commit
+    if not plan['version_records']:
+      commit_version = None
+      set_keys = plan['set_keys']
+    
+    # Commit the versions and the records all together, or none of it
+    else:
+      user_name = versioning.PrepareCommitVersion(session_id)
+      with query.Transaction() as transaction:
+        commit_version = versioning.CreateCommitVersion(session_id, comment=comment, transaction=transaction, user_name=user_name)
+        set_keys = _WriteSetRecords(plan, commit_version, transaction)
+  
+  # Count this commit towards the table's next checkpoint
+  if commit_version != None:
+    versioning.NoteCommit(database, table, commit_version, len(plan['version_records']))
+  
+  # Get all the data in the database currently
+  #NOTE(g): Immediately tells us what the real data in the DB is
+  data = GetMany(session_id, database, table, set_keys, use_cache=False)
+  
+  if return_counts:
+    return {'records':data, 'counts':plan['counts']}
+  
+  return data
+
+
+def _IsAutoIncrementInsert(schema, record):
+  """Returns boolean, True if any PKEY fields are NULL, so the DB will create them (auto_increment)"""
+  for field in schema['key_fields']:
+    if record[field] == None:
+      return True
+  
+  return False
+
+
+def _GetSetFetchKeys(schema, records):
+  """Returns list of the keys of records (dict) that could already exist, to fetch before setting them"""
+  return [key for key in records if not _IsAutoIncrementInsert(schema, records[key])]
+
+
+def _GetChangedFields(schema, current, record):
+  """Returns tuple of the non-PKEY fields whose value in record differs from current (the stored record)"""
+  changed = []
+  
+  for field in schema['schema']:
+    if field in schema['key_fields'] or field not in record:
+      continue
+    
+    (current_value, value) = (current.get(field), record[field])
+    if current_value == value:
+      continue
+    
+    #NOTE(g): Clients send numbers and dates as strings, and MySQL converts them, 
+    #   so compare as strings.  If this is wrong, we only write an unchanged value.
+    if current_value == None or value == None or str(current_value) != str(value):
+      changed.append(field)
+  
+  return tuple(changed)
+
+
+def _PrepareSetRecords(session_id, database, table, records, expected_version=None, current_data=None):
+  """Decides how SetMany() or Batch() will write the records.  Must hold the table write lock.
+  
+  Args:
+    current_data: dict or None, GetMany() result with (at least) these records, if the 
+        caller already has it.  If None, only these records are fetched.
+  
+  Returns: dict, the plan to pass to _WriteSetRecords()
   """
   schema = GetSchemaInfo(session_id, database, table)
-  current_data = GetMany(session_id, database, table)
   
-  # Return data, this will have our updated/inserted keys and records
-  data = {}
+  if current_data == None:
+    current_data = GetMany(session_id, database, table, _GetSetFetchKeys(schema, records), use_cache=False)
+    
+    #NOTE(g): GetMany refreshes the schema if it detects a mismatch, so get it again
+    schema = GetSchemaInfo(session_id, database, table)
+  
+  # If the writer expected the records to be unchanged since a version, make sure they are
+  if expected_version != None:
+    versioning.CheckExpectedVersion(database, table, records.keys(), expected_version)
   
   # List of our table keys to fetch after we're done to get the real DB contents
   set_keys = []
   
-  # Create Commit Version
-  commit_version = versioning.CreateCommitVersion(session_id, comment=comment)
+  # Existing records to UPDATE in batches, grouped by the fields that changed.  New 
+  #   records with their PKEY to INSERT in a batch.  Keys of records which are 
+  #   auto-incrementing and must be INSERTed one at a time to get their keys.
+  #NOTE(g): No upserts, as MySQL's ON DUPLICATE KEY UPDATE also fires on other 
+  #   UNIQUE indexes, and would overwrite a different record.  We already know which 
+  #   keys exist, and a duplicate on INSERT fails the same way on every backend.
+  update_groups = {}
+  insert_records = []
+  insert_keys = []
+  
+  # Records that changed, to store versions of
+  version_records = {}
+  counts = {'inserted':0, 'updated':0, 'unchanged':0}
   
   # Go through the items we want to set, compare them to our current keys (update or add)
   for key in records:
-    # Commit the record version
-    versioning.CommitRecordVersion(commit_version, schema, database, table, key, data=records[key])
-    
-    # If this key exists, we are UPDATEing this record
+    # If this key exists, we are UPDATEing the fields of this record that changed
     if key in current_data:
-      Log('Updating key: %s: Currently: %s' % (key, current_data[key]))
-      
-      # Create the SQL for the UPDATE
-      sql = _CreateRecordUpdateSql(schema, table, records[key])
-      
-      # Execute the SQL
-      query.Query(sql, database=database)
+      changed_fields = _GetChangedFields(schema, current_data[key], records[key])
       
       # Update the set_keys, so we can retrieve all the touched data
       set_keys.append(key)
+      
+      # Nothing changed, so there is nothing to write
+      if not changed_fields:
+        Log('Unchanged key: %s', args=(key,), level=query.LOG_DEBUG)
+        counts['unchanged'] += 1
+        continue
+      
+      Log('Updating key: %s: Changed: %s: Currently: %s', args=(key, changed_fields, current_data[key]), level=query.LOG_DEBUG)
+      
+      # UPDATE the changed fields, the version has the current record with our changes
+      record = dict(current_data[key])
+      record.update(records[key])
+      update_groups.setdefault(changed_fields, []).append(record)
+      
+      version_records[key] = record
+      counts['updated'] += 1
     
     # Else, this is a new key so we are INSERTing this record
     else:
-      Log('Inserting key: %s: New data: %s' % (key, records[key]))
+      Log('Inserting key: %s: New data: %s', args=(key, records[key]), level=query.LOG_DEBUG)
       
-      # Create the SQL for the UPDATE
-      sql = _CreateRecordInsertSql(schema, table, records[key])
-      
-      # Execute the SQL
-      last_inserted_key = query.Query(sql, database=database)
-      
-      # If we were auto-incrementing, then get the data
-      if last_inserted_key != 0:
-        insert_key = str(last_inserted_key)
+      # If any PKEY fields are NULL, the DB will create them (auto_increment)
+      if _IsAutoIncrementInsert(schema, records[key]):
+        insert_keys.append(key)
       
       # Else, we passed in the primary key values, so extract them from the record
       else:
-        insert_key = _CreateSchemaKey(schema, records[key])
-      
-      Log('Inserted Key: %s' % insert_key)
-      
-      # Update the set_keys, so we can retrieve all the touched data
-      set_keys.append(insert_key)
+        insert_records.append(records[key])
+        set_keys.append(_CreateSchemaKey(schema, records[key]))
       
+      version_records[key] = records[key]
+      counts['inserted'] += 1
   
-  # Get all the data in the database currently
-  #NOTE(g): Immediately tells us what the real data in the DB is
-  data = GetMany(session_id, database, table, set_keys)
+  plan = {'database':database, 'table':table, 'schema':schema, 'records':records, 'version_records':version_records,
+          'update_groups':update_groups, 'insert_records':insert_records, 'insert_keys':insert_keys, 
+          'set_keys':set_keys, 'counts':counts}
   
-  return data
+  return plan
 
 
-def DeleteMany(session_id, database, table, keys, comment=None):
-  """Sets many records for a given database and table
+def _WriteSetRecords(plan, commit_version, transaction):
+  """Writes the record versions and records from _PrepareSetRecords() in the transaction.
+  
+  Returns: list of strings, the keys of the records that were set
+  """
+  (database, table, schema, records) = (plan['database'], plan['table'], plan['schema'], plan['records'])
+  set_keys = list(plan['set_keys'])
+  
+  # Cached reads of this table are stale once the transaction is finished
+  transaction.AddFinishCallback(lambda committed: cache.InvalidateTable(database, table))
+  
+  # Commit the versions of the records that changed
+  if plan['version_records']:
+    versioning.CommitRecordVersions(commit_version, database, table, plan['version_records'], transaction=transaction)
+  
+  # UPDATE only the changed fields of the existing records
+  for (update_fields, update_records) in plan['update_groups'].items():
+    (sql, bind_fields) = _GetSqlTemplate(schema, database, table, 'update', update_fields=update_fields)
+    transaction.QueryMany(sql, [_GetSqlParams(bind_fields, record) for record in update_records])
+  
+  # INSERT the new records we have keys for, the driver sends them as multi-row INSERTs
+  (sql, bind_fields) = _GetSqlTemplate(schema, database, table, 'insert')
+  if plan['insert_records']:
+    transaction.QueryMany(sql, [_GetSqlParams(bind_fields, record) for record in plan['insert_records']])
+  
+  # INSERT the auto_incrementing records, one at a time to get their keys
+  for key in plan['insert_keys']:
+    last_inserted_key = transaction.Query(sql, _GetSqlParams(bind_fields, records[key]))
+    
+    # If we were auto-incrementing, then get the data
+    if last_inserted_key != 0:
+      insert_key = str(last_inserted_key)
+    
+    # Else, we passed in the primary key values, so extract them from the record
+    else:
+      insert_key = _CreateSchemaKey(schema, records[key])
+    
+    Log('Inserted Key: %s' % insert_key, level=query.LOG_DEBUG)
+    
+    # Update the set_keys, so we can retrieve all the touched data
+    set_keys.append(insert_key)
+  
+  return set_keys
+
+
+def DeleteMany(session_id, database, table, keys, comment=None, expected_version=None):
+  """Deletes many records for a given database and table
   
   Args:
     session_id: string, session ID
     database: string, database name
     table: string, table name
-    keys: sequence of strings or None, if a sequence of strings, only records who have a key
-        that matches one in this sequence will be returned
+    keys: sequence of strings, keys of the records to delete
+    comment: string or None, comment for this commit
+    expected_version: int or None, if an int, no records are deleted if any of them have
+        been changed after this version (raises versioning.VersionConflict)
   
   Returns: None
   """
+  # Hold this table's write lock while we decide what to delete, and delete it
+  with query.GetTableWriteLock(database, table):
+    plan = _PrepareDeleteRecords(session_id, database, table, keys, expected_version=expected_version)
+    
+    # Commit the versions and the deletes all together, or none of it
+    user_name = versioning.PrepareCommitVersion(session_id)
+    with query.Transaction() as transaction:
+      commit_version = versioning.CreateCommitVersion(session_id, comment=comment, transaction=transaction, user_name=user_name)
+      _WriteDeleteRecords(plan, commit_version, transaction)
+  
+  # Count this commit towards the table's next checkpoint
+  versioning.NoteCommit(database, table, commit_version, len(keys))
+  
+  return {}
+
+
+def _PrepareDeleteRecords(session_id, database, table, keys, expected_version=None, current_data=None):
+  """Decides what DeleteMany() or Batch() will delete.  Must hold the table write lock.
+  
+  Args:
+    current_data: dict or None, GetMany() result with (at least) these records, if the 
+        caller already has it.  If None, only these records are fetched.
+  
+  Returns: dict, the plan to pass to _WriteDeleteRecords()
+  """
+  #NOTE(g): GetMany first, so a schema mismatch it detects is refreshed here
+  if current_data == None:
+    current_data = GetMany(session_id, database, table, keys, use_cache=False)
   schema = GetSchemaInfo(session_id, database, table)
-  records = GetMany(session_id, database, table)
   
-  # Create Commit Version
-  commit_version = versioning.CreateCommitVersion(session_id, comment=comment)
+  # If the writer expected the records to be unchanged since a version, make sure they are
+  if expected_version != None:
+    versioning.CheckExpectedVersion(database, table, keys, expected_version)
   
-  # Go through the items we want to set, compare them to our current keys (update or add)
+  # Keys of the records we have to DELETE
+  delete_keys = []
+  
+  # Go through the keys we want to delete, compare them to our current keys
   for key in keys:
-    # Commit the record version
-    versioning.CommitRecordVersion(commit_version, schema, database, table, key, data=None, delete=True)
-    
     # If this key exists, we are DELETEing this record
-    if key in records:
-      Log('Deleting key: %s: Currently: %s' % (key, records[key]))
-      
-      # Create the SQL for the UPDATE
-      sql = _CreateRecordDeleteSql(schema, table, records[key])
-      #Log('DELETE SQL: %s' % sql)
+    if key in current_data:
+      Log('Deleting key: %s: Currently: %s', args=(key, current_data[key]), level=query.LOG_DEBUG)
       
-      # Execute the SQL
-      query.Query(sql, database=database)
+      delete_keys.append(key)
     
-    # Else, this is a new key so we are INSERTing this record
+    # Else, this key is missing, so there is nothing to DELETE
     else:
       Log('Delete key is missing: %s: %s: %s' % (database, table, key))
       
       #TODO(g): Return errors on what we couldnt delete.  Should we delete anything if any data is invalid?
       pass
   
-  return {}
+  plan = {'database':database, 'table':table, 'schema':schema, 'keys':keys,
+          'delete_keys':delete_keys, 'records':dict([(key, current_data[key]) for key in delete_keys])}
+  
+  return plan
 
 
-def _CreateRecordUpdateSql(schema, table, record):
-  """Returns SQL (string) for an UPDATE on this record, for this key"""
-  sql = 'UPDATE `%s`' % table
-  sql_where = ''
-  sql_values = ''
+def _WriteDeleteRecords(plan, commit_version, transaction):
+  """Writes the record versions and deletes the records from _PrepareDeleteRecords() in the transaction."""
+  (database, table, schema) = (plan['database'], plan['table'], plan['schema'])
   
-  # Create the WHERE section, which specifies the PRIMARY KEY (multi-key possible)
-  for field in schema['key_fields']:
-    # Add seperators after the first field is added
-    if sql_where:
-      sql_where += ' AND '
-    
-    sql_where += '`%s` = %s' % (field, _SanitizeSQL(schema, field, record[field]))
+  # Cached reads of this table are stale once the transaction is finished
+  transaction.AddFinishCallback(lambda committed: cache.InvalidateTable(database, table))
   
-  # Create the WHERE section, which specifies the PRIMARY KEY (multi-key possible)
-  for field in schema['schema']:
-    # Skip fields that are part of the PRIMARY KEY, these never need to be updated
-    if field in schema['key_fields']:
-      continue
-    
-    # Add seperators after the first field is added
-    if sql_values:
-      sql_values += ', '
-    
-    sql_values += '`%s` = %s' % (field, _SanitizeSQL(schema, field, record[field]))
+  # Commit the record versions
+  versioning.CommitRecordVersions(commit_version, database, table, plan['keys'], delete=True, transaction=transaction)
   
-  # Put it all together
-  sql_final = '%s SET %s WHERE %s' % (sql, sql_values, sql_where)
+  # DELETE the records in batches by their PKEY
+  where_list = _CreateKeyWhereSql(schema, plan['delete_keys'])
+  if where_list != None:
+    for (where, params) in where_list:
+      transaction.Query('DELETE FROM %s WHERE %s' % (_GetTableSql(database, table), where), params)
   
-  return sql_final
+  # Else, the keys couldnt be parsed, so DELETE them one at a time from their data
+  else:
+    (sql, bind_fields) = _GetSqlTemplate(schema, database, table, 'delete')
+    transaction.QueryMany(sql, [_GetSqlParams(bind_fields, plan['records'][key]) for key in plan['delete_keys']])
 
 
-def _CreateRecordInsertSql(schema, table, record):
-  """Returns SQL (string) for an INSERT on this record, for this key"""
-  sql = 'INSERT INTO `%s`' % table
-  sql_fields = ''
-  sql_values = ''
+def Batch(session_id, operations, comment=None):
+  """Sets and deletes records in many tables (and databases) as one commit, all or nothing.
   
-  # Create the Field and Values section of the INSERT
-  for field in schema['schema']:
-    # Add seperators after the first field is added
-    if sql_values:
-      sql_fields += ', '
-      sql_values += ', '
+  Args:
+    session_id: string, session ID
+    operations: list of dicts, each one of:
+        {'op':'set', 'database':string, 'table':string, 'records':dict, 'expected_version':int or None}
+        {'op':'delete', 'database':string, 'table':string, 'keys':list, 'expected_version':int or None}
+        'records', 'keys' and 'expected_version' are the same as for SetMany() and DeleteMany()
+    comment: string or None, comment for this commit
+  
+  Returns: list, one result per operation, what SetMany() or DeleteMany() would have returned
+  """
+  # Validate the operations before we lock anything, and get the keys each table is changing
+  table_keys = {}
+  table_fetch_keys = {}
+  for operation in operations:
+    if operation.get('op') not in ('set', 'delete'):
+      raise ValueError('Unknown batch operation: %s' % operation.get('op'))
+    
+    cache_key = (operation['database'], operation['table'])
+    
+    if operation['op'] == 'set':
+      keys = list(operation['records'].keys())
+      schema = GetSchemaInfo(session_id, cache_key[0], cache_key[1])
+      fetch_keys = _GetSetFetchKeys(schema, operation['records'])
+    else:
+      keys = list(operation['keys'])
+      fetch_keys = keys
     
-    sql_fields += '`%s`' % field
-    sql_values += '%s' % _SanitizeSQL(schema, field, record[field])
+    # Each record version in a commit must be unique, so a record can only be changed once
+    seen_keys = table_keys.setdefault(cache_key, set())
+    duplicate_keys = seen_keys.intersection(keys)
+    if duplicate_keys:
+      raise ValueError('Batch changes records more than once: %s: %s: %s' % (cache_key[0], cache_key[1], sorted(duplicate_keys)))
+    seen_keys.update(keys)
+    
+    table_fetch_keys.setdefault(cache_key, []).extend(fetch_keys)
+  
+  if not operations:
+    return []
   
-  # Put it all together
-  sql_final = '%s (%s) VALUES (%s)' % (sql, sql_fields, sql_values)
+  # Hold the write locks of all the tables, always taken in sorted order so batches cant deadlock
+  locks = [query.GetTableWriteLock(database, table) for (database, table) in sorted(table_keys.keys())]
+  for lock in locks:
+    lock.acquire()
   
-  return sql_final
+  try:
+    # Get the records the batch could be changing, with one read per table
+    current_data = {}
+    for (cache_key, fetch_keys) in table_fetch_keys.items():
+      current_data[cache_key] = GetMany(session_id, cache_key[0], cache_key[1], fetch_keys, use_cache=False)
+    
+    # Decide what to write
+    plans = []
+    for operation in operations:
+      cache_key = (operation['database'], operation['table'])
+      
+      if operation['op'] == 'set':
+        plan = _PrepareSetRecords(session_id, cache_key[0], cache_key[1], operation['records'],
+                                  expected_version=operation.get('expected_version'), current_data=current_data[cache_key])
+      else:
+        plan = _PrepareDeleteRecords(session_id, cache_key[0], cache_key[1], operation['keys'],
+                                     expected_version=operation.get('expected_version'), current_data=current_data[cache_key])
+      plans.append(plan)
+    
+    # Records each table is changing, the sets that are unchanged are skipped
+    table_counts = {}
+    for (operation, plan) in zip(operations, plans):
+      cache_key = (operation['database'], operation['table'])
+      if operation['op'] == 'set':
+        table_counts[cache_key] = table_counts.get(cache_key, 0) + len(plan['version_records'])
+      else:
+        table_counts[cache_key] = table_counts.get(cache_key, 0) + len(plan['keys'])
+    
+    # If nothing changed, there is nothing to commit
+    if not sum(table_counts.values()):
+      commit_version = None
+      set_keys_list = [plan.get('set_keys') for plan in plans]
+    
+    # Commit all the versions and all the changes together, or none of it
+    else:
+      set_keys_list = []
+      user_name = versioning.PrepareCommitVersion(session_id)
+      with query.Transaction() as transaction:
+        commit_version = versioning.CreateCommitVersion(session_id, comment=comment, transaction=transaction, user_name=user_name)
+        
+        for (operation, plan) in zip(operations, plans):
+          if operation['op'] == 'set':
+            set_keys_list.append(_WriteSetRecords(plan, commit_version, transaction))
+          else:
+            _WriteDeleteRecords(plan, commit_version, transaction)
+            set_keys_list.append(None)
+  
+  finally:
+    for lock in reversed(locks):
+      lock.release()
+  
+  # Count this commit towards each table's next checkpoint
+  if commit_version != None:
+    for (cache_key, count) in table_counts.items():
+      if count:
+        versioning.NoteCommit(cache_key[0], cache_key[1], commit_version, count)
+  
+  # Get the real DB contents of what was set, like SetMany()
+  results = []
+  for (operation, set_keys) in zip(operations, set_keys_list):
+    if operation['op'] == 'set':
+      results.append(GetMany(session_id, operation['database'], operation['table'], set_keys, use_cache=False))
+    else:
+      results.append({})
+  
+  return results
 
 
-def _CreateRecordDeleteSql(schema, table, record):
-  """Returns SQL (string) for an INSERT on this record, for this key"""
-  sql = 'DELETE FROM `%s`' % table
-  sql_where = ''
+def RevertToVersion(session_id, database, table, version, keys=None, comment=None):
+  """Reverts the records of a database table to what they were at a version, as one new commit.
   
-  # Loop over the Primary Key fields to preoperly delete this data (and only this data)
-  for field in schema['key_fields']:
-    # Add seperators after the first field is added
-    if sql_where:
-      sql_where += ' AND '
+  Only records changed after the version are looked at.  They are INSERTed, UPDATEd or 
+  DELETEd as needed (records already the same are skipped), in one transaction.
+  
+  Args:
+    session_id: string, session ID
+    database: string, database name
+    table: string, table name
+    version: int, commit_version.id to revert to
+    keys: sequence of strings or None, if a sequence of strings, only revert these records
+    comment: string or None, comment for this commit.  If None, says what version was reverted to
+  
+  Returns: dict, 'version' is the new commit_version.id (None if nothing needed reverting),
+      'inserted', 'updated', 'deleted' and 'unchanged' are the counts of records
+  """
+  version = int(version)
+  if comment == None:
+    comment = 'Revert to version %s' % version
+  
+  # Hold this table's write lock, so nothing changes while we work out and write the revert
+  with query.GetTableWriteLock(database, table):
+    # Only the records changed after the version can be different from it
+    changed_keys = list(versioning.GetChangedKeys(database, table, version, keys=keys))
+    
+    # What the records were at the version, and what they are now
+    target_data = versioning.GetRecordsAtVersion(database, table, version, keys=changed_keys)
+    current_data = GetMany(session_id, database, table, changed_keys, use_cache=False)
+    
+    # Records that existed at the version are set back, the rest are deleted
+    set_records = dict([(key, target_data[key]) for key in changed_keys if key in target_data])
+    delete_keys = [key for key in changed_keys if key not in target_data and key in current_data]
+    
+    set_plan = _PrepareSetRecords(session_id, database, table, set_records, current_data=current_data)
+    delete_plan = _PrepareDeleteRecords(session_id, database, table, delete_keys, current_data=current_data)
     
-    sql_where += '`%s` = %s' % (field, _SanitizeSQL(schema, field, record[field]))
+    result = dict(set_plan['counts'])
+    result['deleted'] = len(delete_keys)
+    result['version'] = None
+    
+    # If nothing is different, there is nothing to commit
+    if not set_plan['version_records'] and not delete_keys:
+      return result
+    
+    # Commit the versions and all the changes together, or none of it
+    user_name = versioning.PrepareCommitVersion(session_id)
+    with query.Transaction() as transaction:
+      commit_version = versioning.CreateCommitVersion(session_id, comment=comment, transaction=transaction, user_name=user_name)
+      
+      _WriteSetRecords(set_plan, commit_version, transaction)
+      if delete_keys:
+        _WriteDeleteRecords(delete_plan, commit_version, transaction)
+  
+  # Count this commit towards the table's next checkpoint
+  versioning.NoteCommit(database, table, commit_version, len(set_plan['version_records']) + len(delete_keys))
+  
+  Log('Reverted to version: %s: %s: %s: %s' % (database, table, version, result))
   
-  # Put it all together
-  sql_final = '%s WHERE %s' % (sql, sql_where)
+  result['version'] = commit_version
   
-  return sql_final
+  return result
 
 
-def _SanitizeSQL(schema, field, value):
-  """Returns a single-quoted or non-single quoted string, depending on whether 
-  SQL requires it for this schema field
+def _GetSqlTemplate(schema, database, table, operation, update_fields=None):
+  """Returns tuple (SQL template string, list of fields to bind in order) for this table operation.
+  
+  Templates are parameterized (%s per value, bound by the driver) and cached, so 
+  writing a record is only getting its values with _GetSqlParams().
   
   Args:
     schema: dict, from GetSchemaInfo()
-    field: string, name of the table field
-    value: any, value to be single-quoted, or not
+    database: string, database name
+    table: string, table name
+    operation: string, 'insert', 'update' or 'delete'
+    update_fields: sequence of strings or None, for 'update', only UPDATE these 
+        fields.  If None, all the non-PKEY fields.
   
-  Returns: string, valid data to be assigned to as a SQL value (UPDATE or INSERT)
+  Returns: tuple (string, list of strings)
   """
-  # Get a simplified SQL field tyle
-  sql_type = schema['schema'][field]['Type'].lower()
-  if '(' in sql_type:
-    sql_type = sql_type.split('(')[0]
+  fields = tuple(schema['schema'].keys())
+  key_fields = tuple(schema['key_fields'])
   
-  # -- Sanitize by Type and Value --
+  if update_fields != None:
+    update_fields = tuple(update_fields)
   
-  # If value is None, then set it to NULL
-  if value == None:
-    result = 'NULL'
+  # The fields are part of the key, so an ALTERed table gets new templates
+  cache_key = (database, table, operation, fields, key_fields, update_fields)
   
-  # Do not quote these forms
-  elif sql_type in ('integer', 'int', 'smallint', 'tinyint', 'mediumint', 'bigint', 'decimal', 'numeric', 'float', 'double', 'bit', 'year'):
-    result = str(value)
-    
-  # Single quote everything else
+  with SQL_TEMPLATE_CACHE_LOCK:
+    if cache_key in SQL_TEMPLATE_CACHE:
+      return SQL_TEMPLATE_CACHE[cache_key]
+  
+  template = _CreateSqlTemplate(database, table, operation, fields, key_fields, update_fields)
+  
+  with SQL_TEMPLATE_CACHE_LOCK:
+    SQL_TEMPLATE_CACHE[cache_key] = template
+  
+  return template
+
+
+def _CreateSqlTemplate(database, table, operation, fields, key_fields, update_fields=None):
+  """Returns tuple (SQL template string, list of fields to bind in order).  See _GetSqlTemplate()."""
+  table_sql = _GetTableSql(database, table)
+  
+  # Fields that are not part of the PRIMARY KEY, these are the only ones that need to be updated
+  if update_fields == None:
+    value_fields = [field for field in fields if field not in key_fields]
   else:
-    result = "'%s'" % SanitizeSQL(value)
+    value_fields = [field for field in update_fields if field not in key_fields]
   
-  return result
+  sql_fields = ', '.join([query.QuoteName(field) for field in fields])
+  sql_values = ', '.join(['%s'] * len(fields))
+  sql_where = ' AND '.join(['%s = %%s' % query.QuoteName(field) for field in key_fields])
+  
+  # INSERT a new record
+  if operation == 'insert':
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (table_sql, sql_fields, sql_values)
+    bind_fields = list(fields)
+  
+  # UPDATE a record by its PKEY
+  elif operation == 'update':
+    sql_set = ', '.join(['%s = %%s' % query.QuoteName(field) for field in value_fields])
+    sql = 'UPDATE %s SET %s WHERE %s' % (table_sql, sql_set, sql_where)
+    bind_fields = value_fields + list(key_fields)
+  
+  # DELETE a record by its PKEY
+  elif operation == 'delete':
+    sql = 'DELETE FROM %s WHERE %s' % (table_sql, sql_where)
+    bind_fields = list(key_fields)
+  
+  else:
+    raise ValueError('Unknown SQL template operation: %s' % operation)
+  
+  return (sql, bind_fields)
+
+
+def _GetSqlParams(bind_fields, record):
+  """Returns tuple of the record values to bind to a template from _GetSqlTemplate()"""
+  return tuple([record[field] for field in bind_fields])
+
+
+def _GetColumnConverters(schema):
+  """Returns list of (field, converter function) for the temporal fields of this schema.
+  
+  Computed once per schema, so per row we only touch the fields that need it.  Empty 
+  if there are no temporal fields, or the backend already returns them as strings.
+  """
+  if not query.BACKEND.returns_temporal_objects:
+    return []
+  
+  # The field types are the key, so an ALTERed table gets new converters
+  cache_key = tuple(schema['field_types'].items())
+  
+  with COLUMN_CONVERTER_CACHE_LOCK:
+    if cache_key in COLUMN_CONVERTER_CACHE:
+      return COLUMN_CONVERTER_CACHE[cache_key]
+  
+  converters = []
+  for (field, sql_type) in schema['field_types'].items():
+    if sql_type in COLUMN_CONVERTERS:
+      converters.append((field, COLUMN_CONVERTERS[sql_type]))
+  
+  with COLUMN_CONVERTER_CACHE_LOCK:
+    COLUMN_CONVERTER_CACHE[cache_key] = converters
+  
+  return converters
+
+
+def _ConvertDateTime(value):
+  """Returns string, datetime as YYYY-MM-DD HH:MM:SS"""
+  return "%d-%02d-%02d %02d:%02d:%02d" % (value.year, value.month, value.day, value.hour, value.minute, value.second)
+
+
+def _ConvertDate(value):
+  """Returns string, date as YYYY-MM-DD"""
+  return "%d-%02d-%02d" % (value.year, value.month, value.day)
 
 
-def _CleanObjectGarbage(schema, record):
+def _ConvertTime(value):
+  """Returns string, time as HH:MM:SS.  MySQLdb returns TIME as a timedelta, which can be negative or over 24 hours."""
+  if isinstance(value, datetime.timedelta):
+    seconds = int(value.total_seconds())
+    sign = '-' if seconds < 0 else ''
+    seconds = abs(seconds)
+    
+    return "%s%02d:%02d:%02d" % (sign, seconds // 3600, (seconds // 60) % 60, seconds % 60)
+  
+  return "%02d:%02d:%02d" % (value.hour, value.minute, value.second)
+
+
+# Converters for the simplified SQL field types MySQLdb returns as objects, by _GetColumnConverters()
+COLUMN_CONVERTERS = {'datetime':_ConvertDateTime, 'timestamp':_ConvertDateTime, 'date':_ConvertDate, 'time':_ConvertTime}
+
+
+def _CleanObjectGarbage(converters, record):
   """MySQLdb irresponsibly pollutes the data it returns with the useless 
   DateTime object, which does not convert cleanly back to a string that 
   can be inserted back into MySQL.
   
   This function un-does the work MySQLdb does to convert dates/times/etc 
-  into DateTime objects, back to their string counterparts.
+  into DateTime objects, back to their string counterparts.  The record is 
+  changed in place, and returned.
+  
+  Args:
+    converters: list of (field, converter function), from _GetColumnConverters()
+    record: dict, row from MySQLdb
+  
+  Returns: dict, record
   """
-  data = {}
-
-  # Clean all the fields in the record
-  for (field, value) in record.items():
-    # Get a simplified SQL field tyle
-    sql_type = schema['schema'][field]['Type'].lower()
-    if '(' in sql_type:
-      sql_type = sql_type.split('(')[0]
+  for (field, converter) in converters:
+    value = record[field]
     
-    # Date Time
-    if sql_type in ('datetime', 'timestamp') and hasattr(value, 'timetuple'):
-      timetuple = value.timetuple()
-      # Convert to YYYY-MM-DD HH:MM:SS format
-      data[field] = "%d-%02d-%02d %02d:%02d:%02d" % (timetuple.tm_year, timetuple.tm_mon, timetuple.tm_mday, timetuple.tm_hour, timetuple.tm_min, timetuple.tm_sec)
-    
-    # Date
-    elif sql_type == 'date' and hasattr(value, 'timetuple'):
-      timetuple = value.timetuple()
-      # Convert to YYYY-MM-DD
-      data[field] = "%d-%02d-%02d" % (timetuple.tm_year, timetuple.tm_mon, timetuple.tm_mday)
-    
-    # Time
-    elif sql_type == 'time' and hasattr(value, 'timetuple'):
-      timetuple = value.timetuple()
-      # Convert to HH:MM:SS format
-      data[field] = "%02d:%02d:%02d" % (timetuple.tm_hour, timetuple.tm_min, timetuple.tm_sec)
-    
-    # Else, no changes required, just store it (as it should be)
-    else:
-      data[field] = value
-
-  return data
-
+    # NULL, or already a string (invalid dates come back as strings)
+    if value == None or isinstance(value, str):
+      continue
+    
+    record[field] = converter(value)
+  
+  return record
@@ -3,13 +3,15 @@ Query Library for TransAm API
 """
 
 
-import MySQLdb
-import MySQLdb.cursors
 import threading
+import time
 import os
 import sys
-import imp
 import gc
+import queue
+import atexit
+
+import backend
 
 
 # Default database connection: The OPs DB
@@ -21,167 +23,781 @@ DEFAULT_DB_DATABASE = 'transam'
 DEFAULT_DB_PORT = 3306
 
 
-# Global to store DB connections
-#NOTE(g): We store connections to each database separately, even if
-#   they go to the same DB host, so that we dont have to keep track
-#   of which DB we are currently connected to.
-DB_CONNECTION = {}
-DB_CURSOR = {}
-
-
-# Create a Global Write Lock
-#NOTE(g): You have to grab this to do an UPDATE/INSERT, so we are
-#   never doing these at exactly the same time.  Avoids all kinds
-#   of problems immediately and can be refactored out later once
-#   the project is up and running with all other things being stable.
-GLOBAL_WRITE_LOCK = threading.Lock()
+# Global to store DB connection pools, keyed on (host, user, password, database, port)
+#NOTE(g): We store pools for each database separately, even if they go to 
+#   the same DB host, so that we dont have to keep track of which DB a 
+#   connection is currently using.
+DB_POOL = {}
+DB_POOL_LOCK = threading.Lock()
+
+# Maximum connections in each pool (checked out and idle)
+POOL_MAX_SIZE = 10
+# Seconds to wait for a connection when all of them are checked out
+POOL_WAIT_TIMEOUT = 30
+# Seconds a connection can be idle before we ping it before use
+POOL_VALIDATE_IDLE = 60
+# Seconds a connection is used before it is closed and replaced
+POOL_MAX_LIFETIME = 3600
+
+
+# Database backend all queries go through, see backend.py.  Change it with SetBackend().
+#NOTE(g): For DATE/TIME/DATETIME values returned as strings, instead of datetime 
+#   objects: SetBackend(backend.MySQLBackend(temporal_as_string=True))
+BACKEND = backend.MySQLBackend()
+
+
+# Write Locks, keyed on (database, table)
+#NOTE(g): You have to grab the table's lock to do an UPDATE/INSERT on it, so 
+#   we are never deciding between UPDATE and INSERT while another thread is 
+#   writing the same table.  Writes to different tables dont wait on each other.
+TABLE_WRITE_LOCKS = {}
+TABLE_WRITE_LOCKS_LOCK = threading.Lock()
+
+
+# Maximum number of keys to put in a single IN clause when restricting a SELECT
+#NOTE(g): Keeps the SQL statement size sane (max_allowed_packet), while
+#   still only costing 1 query per batch of keys, instead of a full table scan
+KEY_BATCH_SIZE = 500
+
+
+# Log levels, anything logged below LOG_LEVEL is skipped
+#NOTE(g): Every query is logged at LOG_DEBUG, set LOG_LEVEL to LOG_DEBUG to see them
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_WARNING = 30
+LOG_ERROR = 40
+LOG_LEVEL_NAMES = {LOG_DEBUG:'DEBUG', LOG_INFO:'INFO', LOG_WARNING:'WARNING', LOG_ERROR:'ERROR'}
+LOG_LEVEL = LOG_INFO
+
+# Log entries waiting for the background writer thread.  If full, new entries are dropped.
+LOG_QUEUE = queue.Queue(10000)
+LOG_WRITER_THREAD = None
+LOG_WRITER_LOCK = threading.Lock()
+LOG_DROPPED = 0
+# Maximum entries the writer takes off the queue for each write
+LOG_BATCH_SIZE = 500
+# Maximum characters of a log entry (and of each of its args), 0 for no limit
+LOG_MAX_TEXT = 4000
+# Rotate the log file when it is this big, keeping this many old log files
+LOG_MAX_BYTES = 100*1024*1024
+LOG_BACKUP_COUNT = 5
 
 
 class QueryFailure(Exception):
   """Failure to query the DB properly"""
 
 
-def CloseAll():
-  """Forcibly close all the MYSQLdb connections"""
-  global DB_CONNECTION
-  global DB_CURSOR
+class PooledConnection:
+  """A database connection and its cursor, as stored in a ConnectionPool"""
   
-  # Loop through all our connection cache keys, and close them all
-  keys = list(DB_CONNECTION.keys())
-  for cache_key in keys:
-    DB_CONNECTION[cache_key].close()
-    del DB_CURSOR[cache_key]
-    del DB_CONNECTION[cache_key]
+  def __init__(self, conn, cursor):
+    self.conn = conn
+    self.cursor = cursor
+    self.created = time.time()
+    self.last_used = self.created
+
+
+class ConnectionPool:
+  """Bounded pool of connections to one database.
   
-  # Reload the MySQLdb module to try to clear more cache
-  imp.reload(MySQLdb)
+  Every Checkout() gets a connection no other thread is using, until it is 
+  returned with Checkin().  If all connections are checked out, Checkout() 
+  waits for one to be returned.
+  """
   
-  # Force GC to run now and do whatever terrible things MySQLdb is doing to 
-  #   close our connections and not allow new ones to open
-  gc.collect()
-
+  def __init__(self, host, user, password, database, port, max_size=None, 
+               wait_timeout=None, validate_idle=None, max_lifetime=None):
+    """If max_size, wait_timeout, validate_idle or max_lifetime are None, the POOL_* setting is used."""
+    self.host = host
+    self.user = user
+    self.password = password
+    self.database = database
+    self.port = port
+    
+    #NOTE(g): Read the settings now, not when this module loaded, so changing them affects new pools
+    if max_size == None:
+      max_size = POOL_MAX_SIZE
+    if wait_timeout == None:
+      wait_timeout = POOL_WAIT_TIMEOUT
+    if validate_idle == None:
+      validate_idle = POOL_VALIDATE_IDLE
+    if max_lifetime == None:
+      max_lifetime = POOL_MAX_LIFETIME
+    
+    self.max_size = max_size
+    self.wait_timeout = wait_timeout
+    self.validate_idle = validate_idle
+    self.max_lifetime = max_lifetime
+    
+    # Idle connections, and the count of all connections (idle and checked out)
+    self.idle = []
+    self.size = 0
+    self.condition = threading.Condition()
+    
+    self.stats = {'checkouts':0, 'created':0, 'closed':0, 'timeouts':0, 'waited':0, 
+                  'wait_total':0.0, 'wait_max':0.0, 'queries':0}
+  
+  
+  def Checkout(self):
+    """Returns PooledConnection, which must be returned with Checkin()"""
+    start_time = time.time()
+    connection = None
+    
+    with self.condition:
+      while True:
+        # Use an idle connection, newest first, so old ones can expire
+        if self.idle:
+          connection = self.idle.pop()
+          break
+        
+        # Else, we have room to create a new connection
+        if self.size < self.max_size:
+          self.size += 1
+          break
+        
+        # Else, wait for a connection to be checked in
+        remaining = self.wait_timeout - (time.time() - start_time)
+        if remaining <= 0:
+          self.stats['timeouts'] += 1
+          raise QueryFailure('Timed out waiting for a connection (%s in use): %s' % (self.size, BACKEND.DescribeConnection(self.host, self.database)))
+        
+        self.condition.wait(remaining)
+      
+      # Track how long we waited for this connection
+      wait_time = time.time() - start_time
+      self.stats['checkouts'] += 1
+      self.stats['wait_total'] += wait_time
+      if wait_time > self.stats['wait_max']:
+        self.stats['wait_max'] = wait_time
+      if wait_time > 0.001:
+        self.stats['waited'] += 1
+    
+    # Connect and validate outside the lock, so we dont block other threads
+    if connection != None and not self._IsUsable(connection):
+      self._Close(connection)
+      connection = None
+    
+    if connection == None:
+      try:
+        connection = self._Create()
+      except:
+        # We couldnt connect, so give back our slot in the pool
+        with self.condition:
+          self.size -= 1
+          self.condition.notify()
+        raise
+    
+    return connection
+  
+  
+  def Checkin(self, connection, discard=False):
+    """Return a connection from Checkout() to the pool.  If discard, it is closed instead."""
+    now = time.time()
+    
+    # Close connections that failed or have lived too long
+    if discard or now - connection.created > self.max_lifetime:
+      self._Close(connection)
+      
+      with self.condition:
+        self.size -= 1
+        self.condition.notify()
+    
+    else:
+      connection.last_used = now
+      
+      with self.condition:
+        self.idle.append(connection)
+        self.condition.notify()
+  
+  
+  def NoteQuery(self):
+    """Count a query run on one of our connections"""
+    with self.condition:
+      self.stats['queries'] += 1
+  
+  
+  def CloseAll(self):
+    """Close all the idle connections.  Checked out connections close when checked in."""
+    with self.condition:
+      idle = self.idle
+      self.idle = []
+      self.size -= len(idle)
+      self.condition.notify_all()
+    
+    for connection in idle:
+      self._Close(connection)
+  
+  
+  def GetStats(self):
+    """Returns dict of pool size and checkout/wait metrics"""
+    with self.condition:
+      stats = dict(self.stats)
+      stats['size'] = self.size
+      stats['idle'] = len(self.idle)
+      stats['max_size'] = self.max_size
+    
+    if stats['checkouts']:
+      stats['wait_average'] = stats['wait_total'] / stats['checkouts']
+    else:
+      stats['wait_average'] = 0.0
+    
+    return stats
+  
+  
+  def _Create(self):
+    """Returns a new PooledConnection"""
+    Log('Creating %s connection: %s' % (BACKEND.name, BACKEND.DescribeConnection(self.host, self.database)))
+    conn = BACKEND.Connect(self.host, self.user, self.password, self.database, self.port)
+    
+    with self.condition:
+      self.stats['created'] += 1
+    
+    return PooledConnection(conn, BACKEND.GetCursor(conn))
+  
+  
+  def _IsUsable(self, connection):
+    """Returns boolean, True if this idle connection is still good to use"""
+    now = time.time()
+    
+    # Too old, replace it
+    if now - connection.created > self.max_lifetime:
+      return False
+    
+    # Idle for a while, make sure the server didnt close it on us
+    if now - connection.last_used > self.validate_idle:
+      try:
+        BACKEND.Ping(connection.conn)
+      except BACKEND.DatabaseError as exc:
+        Log('Idle connection failed validation: %s: %s' % (BACKEND.DescribeConnection(self.host, self.database), exc), level=LOG_WARNING)
+        return False
+    
+    return True
+  
+  
+  def _Close(self, connection):
+    """Close this connection, ignoring any errors, as we are done with it anyway"""
+    try:
+      connection.conn.close()
+    except BACKEND.DatabaseError:
+      pass
+    
+    with self.condition:
+      self.stats['closed'] += 1
 
-def Connect(host, user, password, database, port, reset=False):
-  """Connect to the specified MySQL DB"""
-  global DB_CONNECTION
-  global DB_CURSOR
 
+def GetPool(host, user, password, database, port):
+  """Returns the ConnectionPool for the specified DB, creating it if needed"""
   # Convert to proper empty DB
   if database == None:
     database = ''
-
-  # Create the cache key (tuple), for caching the DB connection and cursor
+  
+  # Create the cache key (tuple), for caching the DB connection pool
   cache_key = (host, user, password, database, port)
+  
+  with DB_POOL_LOCK:
+    if cache_key not in DB_POOL:
+      DB_POOL[cache_key] = ConnectionPool(host, user, password, database, port)
+    
+    pool = DB_POOL[cache_key]
+  
+  return pool
 
-  # Close any connection we have persistent, if resetting
-  if reset and cache_key in DB_CURSOR:
-    Log('Resetting cache key: %s' % str(cache_key))
-    DB_CONNECTION[cache_key].close()
-    del DB_CURSOR[cache_key]
-    del DB_CONNECTION[cache_key]
-    # Force module reload to clear out anything that is being incorrectly cached
-    imp.reload(MySQLdb)
-    #Log('Connections: %s  Cursors: %s' % (DB_CONNECTION, DB_CURSOR))
-
-  # If no cached cursor/connection exists, create them
-  if reset or cache_key not in DB_CURSOR:
-    Log('Creating MySQL connection: %s' % str(cache_key))
-    conn = MySQLdb.Connect(host, user, password, database, port=port, cursorclass=MySQLdb.cursors.DictCursor)
-    cursor = conn.cursor()
-
-    DB_CURSOR[cache_key] = cursor
-    DB_CONNECTION[cache_key] = conn
-    #Log('Connections: %s  Cursors: %s' % (DB_CONNECTION, DB_CURSOR))
-
-  # Else, use the cache
-  else:
-    conn = DB_CONNECTION[cache_key]
-    cursor = DB_CURSOR[cache_key]
 
-  return (conn, cursor)
+def SetBackend(new_backend):
+  """Use new_backend (backend.Backend) for all queries.  Existing pooled connections are closed."""
+  global BACKEND
+  
+  CloseAll()
+  
+  with DB_POOL_LOCK:
+    DB_POOL.clear()
+    BACKEND = new_backend
+  
+  Log('Using %s database backend' % new_backend.name)
+
+
+def GetBackend():
+  """Returns the backend.Backend all queries go through"""
+  return BACKEND
+
+
+def QuoteName(name):
+  """Returns the quoted name (string) of a database, table, field or index, for SQL"""
+  return BACKEND.QuoteName(name)
+
+
+def GetTableFields(database, table):
+  """Returns list of dicts, one per field of the table in order, in MySQL DESC format: Field, Type, Null, Key, Default, Extra"""
+  return BACKEND.GetFields(lambda sql: Query(sql, database=database), database, table)
+
+
+def GetPrimaryKeyFields(database, table):
+  """Returns list of the table's PRIMARY KEY field names (strings), in order"""
+  return BACKEND.GetPrimaryKey(lambda sql: Query(sql, database=database), database, table)
+
+
+def GetTables(database):
+  """Returns list of the table names (strings) in the database"""
+  return BACKEND.GetTables(lambda sql: Query(sql, database=database), database)
+
+
+def GetDatabases():
+  """Returns list of the database names (strings)"""
+  return BACKEND.GetDatabases(Query)
+
+
+def GetIndexNames(table, database=DEFAULT_DB_DATABASE):
+  """Returns set of the index names (strings) on the table"""
+  return BACKEND.GetIndexNames(lambda sql: Query(sql, database=database), database, table)
+
+
+def AddIndex(table, name, fields, database=DEFAULT_DB_DATABASE):
+  """Add an index on the fields (sequence of strings) of the table"""
+  Query(BACKEND.GetAddIndexSql(database, table, name, fields), database=database)
+
+
+def GetTableWriteLock(database, table):
+  """Returns the threading.Lock that must be held while writing to this database table"""
+  cache_key = (database, table)
+  
+  with TABLE_WRITE_LOCKS_LOCK:
+    if cache_key not in TABLE_WRITE_LOCKS:
+      TABLE_WRITE_LOCKS[cache_key] = threading.Lock()
+    
+    lock = TABLE_WRITE_LOCKS[cache_key]
+  
+  return lock
+
+
+def GetPoolStats():
+  """Returns dict, key is 'host:port/database' and value is dict of that pool's stats"""
+  with DB_POOL_LOCK:
+    pools = list(DB_POOL.values())
+  
+  data = {}
+  for pool in pools:
+    data['%s:%s/%s' % (pool.host, pool.port, pool.database)] = pool.GetStats()
+  
+  return data
+
+
+def CloseAll():
+  """Forcibly close all the idle database connections in all pools"""
+  with DB_POOL_LOCK:
+    pools = list(DB_POOL.values())
+  
+  for pool in pools:
+    pool.CloseAll()
+  
+  # Force GC to run now and do whatever terrible things MySQLdb is doing to 
+  #   close our connections and not allow new ones to open
+  gc.collect()
 
 
 def Query(sql, host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER, 
 		password=DEFAULT_DB_PASSWORD, database=DEFAULT_DB_DATABASE, 
-		port=DEFAULT_DB_PORT):
-  """Execute and Fetch All results, or reutns last row ID inserted if INSERT."""
+		port=DEFAULT_DB_PORT, params=None):
+  """Execute and Fetch All results, or reutns last row ID inserted if INSERT.
+  
+  If params (sequence) is specified, sql has a %s for each value, and they are bound by the driver.
+  """
+  pool = GetPool(host, user, password, database, port)
+  
   # Try to reconnect and stuff
   success = False
   tries = 0
   last_error = None
   while tries <= 3 and success == False:
     tries += 1
-
+    
+    # Get a connection only this thread is using
+    connection = pool.Checkout()
+    
     try:
-      # Connect (will save connections)
-      (conn, cursor) = Connect(host, user, password, database, port)
-
       # Query
-      Log('Query: %s' % sql)
-      cursor.execute(sql)
-      
-      #Log('Query complete, committing')
+      Log('Query: %s', args=(sql,), level=LOG_DEBUG)
+      BACKEND.Execute(connection.cursor, sql, params)
+      pool.NoteQuery()
       
       # Force commit
-      conn.commit()
+      connection.conn.commit()
+      
+      # Get the result before anyone else can use this cursor
+      result = _FetchResult(connection.cursor, sql)
       
       # Command didnt throw an exception
       success = True
+      pool.Checkin(connection)
     
-    except MySQLdb.DatabaseError as exc:
-      (error_code, error_text) = (exc.code, exc.message)
-      last_error = '%s: %s (Attempt: %s): %s: %s: %s' % (error_code, error_text, tries, host, database, sql)
-      Log(last_error)
+    except BACKEND.DatabaseError as exc:
+      last_error = '%s (Attempt: %s): %s: %s' % (str(exc), tries, BACKEND.DescribeConnection(host, database), sql)
+      Log(last_error, level=LOG_WARNING)
+      
+      # Connect lost, throw away this connection, and we will get another
+      if BACKEND.IsLostConnection(exc):
+        Log('Lost connection: %s' % last_error, level=LOG_WARNING)
+        pool.Checkin(connection, discard=True)
       
-      # Connect lost, reconnect
-      if error_code in (2006, '2006'):
-        Log('Lost connection: %s' % last_error)
+      else:
+        Log('Unhandled %s query error: %s' % (BACKEND.name, last_error), level=LOG_ERROR)
+        
+        # Clear out anything the failure left on this connection, before reuse
+        try:
+          connection.conn.rollback()
+          pool.Checkin(connection)
+        except BACKEND.DatabaseError:
+          pool.Checkin(connection, discard=True)
+    
+    # Anything else, we dont know what state the connection is in, so dont reuse it
+    except:
+      pool.Checkin(connection, discard=True)
+      raise
 
-        # Enforce we always close the connections, because 
-        CloseAll()
+  # We failed, no result for you
+  if not success:
+    raise QueryFailure(str(last_error))
 
-        # Reset connection
-        Connect(host, user, password, database, port, reset=True)
-      else:
-        Log('Unhandled MySQL query error: %s' % last_error)
+  return result
 
-  # If we made the query, get the result
-  if success:
-    if sql.upper()[:6] not in ('INSERT', 'UPDATE', 'DELETE'):
-      result = cursor.fetchall()
-    elif sql.upper()[:6] == 'INSERT':
-      # This is 0 unless we were auto_incrementing, and then it is accurate
-      result = cursor.lastrowid
 
-    else:
-      result = None
+def QueryIter(sql, host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER, 
+		password=DEFAULT_DB_PASSWORD, database=DEFAULT_DB_DATABASE, 
+		port=DEFAULT_DB_PORT, params=None):
+  """Execute a SELECT and yield the result rows (dicts) as they arrive from the server.
+  
+  Uses an unbuffered cursor, so the whole result is never held in memory.  The 
+  connection is used until the generator is exhausted or closed, so dont hold 
+  it open longer than needed.
+  
+  If params (sequence) is specified, sql has a %s for each value, and they are bound by the driver.
+  """
+  pool = GetPool(host, user, password, database, port)
+  connection = pool.Checkout()
+  discard = False
+  cursor = None
+  
+  try:
+    Log('Query: %s', args=(sql,), level=LOG_DEBUG)
+    
+    cursor = BACKEND.GetCursor(connection.conn, streaming=True)
+    BACKEND.Execute(cursor, sql, params)
+    pool.NoteQuery()
+    
+    while True:
+      rows = cursor.fetchmany(KEY_BATCH_SIZE)
+      if not rows:
+        break
+      
+      for row in rows:
+        yield row
+  
+  except BACKEND.DatabaseError as exc:
+    discard = True
+    raise QueryFailure('%s: %s: %s' % (str(exc), BACKEND.DescribeConnection(host, database), sql))
+  
+  #NOTE(g): If the caller stopped early, closing the cursor reads the rest of 
+  #   the result off the connection, so it can be used again
+  finally:
+    if cursor != None and not discard:
+      try:
+        cursor.close()
+      except BACKEND.DatabaseError:
+        discard = True
+    
+    pool.Checkin(connection, discard=discard)
 
-  # We failed, no result for you
-  else:
-    raise QueryFailure(str(last_error))
 
+def _FetchResult(cursor, sql):
+  """Returns the result of the sql just executed on cursor: rows, last inserted ID, or None"""
+  if sql.upper()[:6] not in ('INSERT', 'UPDATE', 'DELETE'):
+    result = cursor.fetchall()
+  elif sql.upper()[:6] == 'INSERT':
+    # This is 0 unless we were auto_incrementing, and then it is accurate
+    result = cursor.lastrowid
+  
+  else:
+    result = None
+  
   return result
 
 
-def Log(text, reset=False, logfile=None):
-  """Log things we are doing"""
+class Transaction:
+  """Executes many queries on one connection, committed together at the end.
+  
+  If any query (or anything else in the block) fails, all of it is rolled back.
+  Tables in other databases must be specified as `database`.`table`.
+  
+    with query.Transaction() as transaction:
+      transaction.Query(sql)
+  """
+  
+  def __init__(self, host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER, 
+               password=DEFAULT_DB_PASSWORD, database=DEFAULT_DB_DATABASE, 
+               port=DEFAULT_DB_PORT):
+    self.host = host
+    self.database = database
+    
+    self.pool = GetPool(host, user, password, database, port)
+    self.connection = None
+    
+    # Called with a boolean, True if committed, when the transaction is finished
+    self.finish_callbacks = []
+  
+  
+  def __enter__(self):
+    # Keep our own connection for the whole transaction
+    self.connection = self.pool.Checkout()
+    
+    return self
+  
+  
+  def __exit__(self, exc_type, exc_value, exc_traceback):
+    discard = False
+    committed = False
+    
+    try:
+      # Everything worked, commit it all
+      if exc_type == None:
+        self.connection.conn.commit()
+        committed = True
+      
+      # Else, undo everything we did
+      else:
+        Log('Rolling back transaction: %s' % exc_value, level=LOG_WARNING)
+        self.connection.conn.rollback()
+    
+    # If the commit or rollback failed, we cant trust this connection anymore
+    except BACKEND.DatabaseError:
+      discard = True
+      raise
+    
+    finally:
+      self.pool.Checkin(self.connection, discard=discard)
+      self.connection = None
+      
+      for callback in self.finish_callbacks:
+        try:
+          callback(committed)
+        except Exception as exc:
+          Log('Transaction finish callback failed: %s' % exc, level=LOG_ERROR)
+    
+    # Never suppress the exception
+    return False
+  
+  
+  def AddFinishCallback(self, callback):
+    """Call callback(committed) when the transaction is committed or rolled back"""
+    self.finish_callbacks.append(callback)
+  
+  
+  def Query(self, sql, params=None):
+    """Execute and Fetch All results, or returns last row ID inserted if INSERT.  Does not commit.
+    
+    If params (sequence) is specified, sql is a template with a %s for each param, 
+    which the driver escapes and binds.
+    """
+    Log('Query: %s', args=(sql,), level=LOG_DEBUG)
+    
+    #NOTE(g): No retries here, a lost connection loses the transaction, so fail it
+    try:
+      BACKEND.Execute(self.connection.cursor, sql, params)
+    except BACKEND.DatabaseError as exc:
+      raise QueryFailure('%s: %s: %s' % (str(exc), BACKEND.DescribeConnection(self.host, self.database), sql))
+    
+    self.pool.NoteQuery()
+    
+    return _FetchResult(self.connection.cursor, sql)
+  
+  
+  def QueryMany(self, sql, params_list):
+    """Execute the sql template once for each params sequence in params_list.  Does not commit.
+    
+    The driver binds the params (MySQLdb sends an INSERT as multi-row INSERTs), 
+    so there is no per-row SQL building or quoting.
+    
+    Returns: int, rows affected
+    """
+    if not params_list:
+      return 0
+    
+    Log('Query Many (%s): %s', args=(len(params_list), sql), level=LOG_DEBUG)
+    
+    try:
+      count = BACKEND.ExecuteMany(self.connection.cursor, sql, params_list)
+    except BACKEND.DatabaseError as exc:
+      raise QueryFailure('%s: %s: %s' % (str(exc), BACKEND.DescribeConnection(self.host, self.database), sql))
+    
+    self.pool.NoteQuery()
+    
+    return count
+
+
+def Log(text, reset=False, logfile=None, level=LOG_INFO, args=None):
+  """Log things we are doing
+  
+  Logs are written by a background thread, so requests dont wait on the disk.
+  
+  Args:
+    text: string, text to log, or a format string if args are specified
+    reset: boolean, if True, the log file is truncated before writing this
+    logfile: string or None, log file path.  If None, it is created from the script name
+    level: int, LOG_DEBUG/LOG_INFO/LOG_WARNING/LOG_ERROR, not logged if below LOG_LEVEL
+    args: tuple or None, if specified, text is formatted with these in the background 
+        thread, so large records are only converted to strings if they will be logged
+  """
+  # Skip anything below our log level, before we do any work
+  if level < LOG_LEVEL:
+    return
+  
   # Generate the log file from the file name, if it wasnt specified
   if logfile == None:
     logfile = os.path.basename(sys.argv[0]).replace('.py', '.log')
   
   # If we dont have a log file, we're using the REPL interactively, print
   if not logfile:
-    print(text)
+    print(_FormatLog(text, args))
   
-  # Else, log it
+  # Else, queue it for the log writer
   else:
-    if not reset:
-      fp = open(logfile, 'a')
-    else:
-      fp = open(logfile, 'w')
+    _StartLogWriter()
+    
+    try:
+      LOG_QUEUE.put_nowait((logfile, reset, level, text, args))
+    
+    # If the writer cant keep up, drop this instead of blocking the request
+    except queue.Full:
+      global LOG_DROPPED
+      LOG_DROPPED += 1
+
+
+def FlushLog(timeout=5):
+  """Wait for everything logged so far to be written.  Returns boolean, True if flushed."""
+  if LOG_WRITER_THREAD == None:
+    return True
+  
+  flushed = threading.Event()
+  try:
+    LOG_QUEUE.put(flushed, timeout=timeout)
+  except queue.Full:
+    return False
   
-    fp.write('%s\n' % str(text))
+  return flushed.wait(timeout)
+
+
+def _FormatLog(text, args):
+  """Returns string, the log text formatted with args, with large values truncated"""
+  if args != None:
+    text = str(text) % tuple([_TruncateLog(str(arg)) for arg in args])
+  
+  return _TruncateLog(str(text))
+
+
+def _TruncateLog(text):
+  """Returns string, text truncated to LOG_MAX_TEXT characters"""
+  if LOG_MAX_TEXT and len(text) > LOG_MAX_TEXT:
+    text = '%s... (%s more characters)' % (text[:LOG_MAX_TEXT], len(text) - LOG_MAX_TEXT)
+  
+  return text
+
+
+def _StartLogWriter():
+  """Start the background log writer thread, if it isnt running yet"""
+  global LOG_WRITER_THREAD
+  
+  if LOG_WRITER_THREAD != None:
+    return
+  
+  with LOG_WRITER_LOCK:
+    if LOG_WRITER_THREAD == None:
+      thread = threading.Thread(target=_LogWriter, name='LogWriter')
+      thread.daemon = True
+      thread.start()
+      
+      # Write out anything queued when the process exits normally
+      atexit.register(FlushLog)
+      
+      LOG_WRITER_THREAD = thread
+
+
+def _LogWriter():
+  """Background thread: write the queued log entries in batches, rotating large log files"""
+  global LOG_DROPPED
+  
+  while True:
+    # Wait for something to log, then take everything else that is waiting too
+    entries = [LOG_QUEUE.get()]
+    while len(entries) < LOG_BATCH_SIZE:
+      try:
+        entries.append(LOG_QUEUE.get_nowait())
+      except queue.Empty:
+        break
+    
+    # Group the lines for each log file, keeping their order
+    flush_events = []
+    lines = {}
+    for entry in entries:
+      # Flush requests are signalled after everything before them is written
+      if isinstance(entry, threading.Event):
+        flush_events.append(entry)
+        continue
+      
+      (logfile, reset, level, text, args) = entry
+      
+      # Truncate the log file, dropping anything before this in it
+      if reset:
+        lines.pop(logfile, None)
+        _WriteLog(logfile, [], mode='w')
+      
+      try:
+        line = _FormatLog(text, args)
+      except Exception as exc:
+        line = 'Failed to format log: %s: %s' % (repr(text), exc)
+      
+      if level >= LOG_WARNING:
+        line = '%s: %s' % (LOG_LEVEL_NAMES[level], line)
+      
+      lines.setdefault(logfile, []).append(line)
+    
+    # Report anything we had to drop, so we know the log is incomplete
+    if LOG_DROPPED:
+      dropped = LOG_DROPPED
+      LOG_DROPPED = 0
+      for logfile in lines:
+        lines[logfile].append('WARNING: Log queue full, dropped %s log entries' % dropped)
+    
+    for logfile in lines:
+      _WriteLog(logfile, lines[logfile])
+    
+    for flushed in flush_events:
+      flushed.set()
+
+
+def _WriteLog(logfile, lines, mode='a'):
+  """Write lines to the logfile, rotating it first if it is too large"""
+  try:
+    if mode == 'a' and LOG_MAX_BYTES and os.path.exists(logfile) and os.path.getsize(logfile) >= LOG_MAX_BYTES:
+      _RotateLog(logfile)
+    
+    fp = open(logfile, mode)
+    for line in lines:
+      fp.write('%s\n' % line)
     fp.close()
+  
+  # Never let a logging failure kill the writer thread
+  except (IOError, OSError) as exc:
+    print('Failed to write log: %s: %s' % (logfile, exc))
+
+
+def _RotateLog(logfile):
+  """Rotate logfile to logfile.1, logfile.1 to logfile.2, etc, up to LOG_BACKUP_COUNT"""
+  for count in range(LOG_BACKUP_COUNT - 1, 0, -1):
+    if os.path.exists('%s.%s' % (logfile, count)):
+      os.replace('%s.%s' % (logfile, count), '%s.%s' % (logfile, count + 1))
+  
+  if LOG_BACKUP_COUNT:
+    os.replace(logfile, '%s.1' % logfile)
+  else:
+    os.remove(logfile)
 
 
 def SanitizeSQL(sql):
@@ -4,13 +4,35 @@ Session Management for TransAm
 
 import hashlib
 import time
+import threading
+import collections
 
 import query
-from query import Log, Query, SanitizeSQL
+from query import Log, Query
 
 
-# Keep a lookup dictionary of known sessions to reduce DB latency
-SESSION_CACHE = {}
+# Keep an LRU lookup of known sessions to reduce DB latency
+#NOTE(g): Values are (session info, time to stop using the cached info).  
+#   Valid sessions are kept until they expire, or SESSION_CACHE_TTL.  
+#   Invalid session_ids are kept separately, so junk cant push out good sessions.
+SESSION_CACHE = collections.OrderedDict()
+SESSION_NEGATIVE_CACHE = collections.OrderedDict()
+SESSION_CACHE_LOCK = threading.Lock()
+
+# Maximum number of valid sessions, and invalid session_ids, to cache
+SESSION_CACHE_MAX = 10000
+SESSION_NEGATIVE_CACHE_MAX = 1000
+
+# Seconds to cache a valid session, and an invalid session_id
+SESSION_CACHE_TTL = 60*5
+SESSION_NEGATIVE_CACHE_TTL = 60
+
+# Seconds between cleaning up expired sessions in the database
+SESSION_SWEEP_INTERVAL = 60*5
+
+# Background thread cleaning up expired sessions, and when we last cleaned up
+SESSION_SWEEPER_THREAD = None
+LAST_CLEANUP_TIME = 0
 
 # Default timeout (8 hours)
 TIMEOUT_DEFAULT = 60*60*8
@@ -21,15 +43,23 @@ def GetSessionInfo(session_id):
   
   Relevant keys: 'user', 'application', 'expire', 'created'
   """
-  global SESSION_CACHE
-  
-  # If we have this session cached, return it
-  if session_id in SESSION_CACHE:
-    return SESSION_CACHE[session_id]
+  now = time.time()
+  
+  # If we have this session cached, and it hasnt expired, return it
+  with SESSION_CACHE_LOCK:
+    for cache in (SESSION_CACHE, SESSION_NEGATIVE_CACHE):
+      if session_id in cache:
+        (info, cache_expire) = cache[session_id]
+        
+        if now < cache_expire:
+          cache.move_to_end(session_id)
+          return info
+        
+        del cache[session_id]
   
   # Fetch the session by it's ID from the database
-  sql = "SELECT * FROM `session` WHERE `key` = '%s'" % session_id
-  result = Query(sql)
+  sql = "SELECT * FROM `session` WHERE `key` = %s AND (`expire` IS NULL OR `expire` > NOW())"
+  result = Query(sql, params=[session_id])
   
   if not result:
     info = None
@@ -37,11 +67,37 @@ def GetSessionInfo(session_id):
     info = result[0]
   
   # Cache this session, whether it is valid or not
-  SESSION_CACHE[session_id] = info
+  with SESSION_CACHE_LOCK:
+    if info == None:
+      _CacheSession(SESSION_NEGATIVE_CACHE, SESSION_NEGATIVE_CACHE_MAX, session_id, info, now + SESSION_NEGATIVE_CACHE_TTL)
+    
+    else:
+      cache_expire = now + SESSION_CACHE_TTL
+      
+      # Dont use the cache after the session expires
+      #NOTE(g): Backends returning dates as strings give us YYYY-MM-DD HH:MM:SS
+      if hasattr(info['expire'], 'timetuple'):
+        cache_expire = min(cache_expire, time.mktime(info['expire'].timetuple()))
+      elif isinstance(info['expire'], str):
+        try:
+          cache_expire = min(cache_expire, time.mktime(time.strptime(info['expire'][:19], '%Y-%m-%d %H:%M:%S')))
+        except ValueError:
+          pass
+      
+      _CacheSession(SESSION_CACHE, SESSION_CACHE_MAX, session_id, info, cache_expire)
   
   return info
 
 
+def _CacheSession(cache, max_size, session_id, info, cache_expire):
+  """Store session info in an LRU cache, removing the least recently used over max_size.  Must hold SESSION_CACHE_LOCK."""
+  cache[session_id] = (info, cache_expire)
+  cache.move_to_end(session_id)
+  
+  while len(cache) > max_size:
+    cache.popitem(last=False)
+
+
 def GetUser(session_id):
   """Returns string (user name) or None if this is not a valid session_id"""
   session_info = GetSessionInfo(session_id)
@@ -64,16 +120,15 @@ def CreateSession(user, application, timeout=TIMEOUT_DEFAULT):
   key = '%s_%s_%s' % (str(user), str(application), str(time.time()))
   session_id = hashlib.sha1(key.encode('utf-8')).hexdigest()
   
-  # Cleanup any expired sessions in the database
+  # Cleanup any expired sessions in the database, if the sweeper isnt doing it
   #NOTE(g): Has to be done sometime, might as well do it now so no cron-type 
-  #   system has to be created
-  #TODO(g): Would it better to do this more often?  I think so...
-  _CleanupSessions()
+  #   system has to be created.  Only every SESSION_SWEEP_INTERVAL though.
+  if SESSION_SWEEPER_THREAD == None and time.time() - LAST_CLEANUP_TIME > SESSION_SWEEP_INTERVAL:
+    _CleanupSessions()
   
   # Store in the database
-  sql = "INSERT INTO `session` (`key`, `application`, `user`, `expire`) VALUES ('%s', '%s', '%s', NOW() + INTERVAL %s SECOND)" % \
-        (SanitizeSQL(session_id), SanitizeSQL(application), SanitizeSQL(user), int(timeout))
-  result = Query(sql)
+  sql = "INSERT INTO `session` (`key`, `application`, `user`, `expire`) VALUES (%%s, %%s, %%s, %s)" % query.GetBackend().GetNowSql(int(timeout))
+  result = Query(sql, params=[session_id, application, user])
   
   # If successful, return the session_id
   if result:
@@ -84,27 +139,45 @@ def CreateSession(user, application, timeout=TIMEOUT_DEFAULT):
     return None
 
 
-def _CleanupSessions():
-  """Clean up any expired sessions.  Returns list of strings, removed session keys"""
-  global SESSION_CACHE
+def StartSessionSweeper(interval=SESSION_SWEEP_INTERVAL):
+  """Start a background thread that cleans up expired sessions every interval seconds"""
+  global SESSION_SWEEPER_THREAD
   
-  sql = "SELECT * FROM `session` WHERE NOW() > `expire`"
-  result = Query(sql)
+  if SESSION_SWEEPER_THREAD != None:
+    return
   
-  removed_session_keys = []
-  for item in result:
-    # Get the session_id that has expired, and add to our list
-    session_id = item['key']
-    removed_session_keys.append(session_id)
+  SESSION_SWEEPER_THREAD = threading.Thread(target=_SessionSweeper, args=(interval,), name='SessionSweeper')
+  SESSION_SWEEPER_THREAD.daemon = True
+  SESSION_SWEEPER_THREAD.start()
+
+
+def _SessionSweeper(interval):
+  """Background thread: clean up expired sessions forever"""
+  while True:
+    try:
+      _CleanupSessions()
     
-    # Delete this key from the database
-    #NOTE(g): Doing it 1 by 1 ensures we always keep the cache and DB in sync
-    sql = "DELETE FROM `session` WHERE `id` = %s" % item['id']
-    Query(sql)
+    # Never let a failed cleanup stop the sweeper, we will try again next time
+    except Exception as exc:
+      Log('Session cleanup failed: %s' % exc, level=query.LOG_ERROR)
     
-    # Delete this key from cache, if it exists
-    if session_id in SESSION_CACHE:
-      del SESSION_CACHE[session_id]
-  
-  return removed_session_keys
+    time.sleep(interval)
+
 
+def _CleanupSessions():
+  """Clean up any expired sessions, in the database and the cache."""
+  global LAST_CLEANUP_TIME
+  
+  LAST_CLEANUP_TIME = time.time()
+  
+  # Delete all the expired sessions at once
+  sql = "DELETE FROM `session` WHERE NOW() > `expire`"
+  Query(sql)
+  
+  # Remove expired sessions from the cache
+  #NOTE(g): GetSessionInfo() already wont return them, this just frees the memory
+  now = time.time()
+  with SESSION_CACHE_LOCK:
+    for cache in (SESSION_CACHE, SESSION_NEGATIVE_CACHE):
+      for session_id in [session_id for (session_id, (info, cache_expire)) in cache.items() if now >= cache_expire]:
+        del cache[session_id]
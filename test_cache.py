@@ -0,0 +1,123 @@
+"""
+Tests for the GetMany result cache, against an in memory SQLite backend
+
+Run with:  python -m unittest test_cache
+"""
+
+
+import threading
+import unittest
+from unittest import mock
+
+import backend
+import cache
+import process
+import query
+import versioning
+
+
+# Seconds to wait for the other thread, before failing instead of hanging
+THREAD_TIMEOUT = 10
+
+
+class VersionedCacheTest(unittest.TestCase):
+  """A versioned read must not cache a version that has a commit still in progress"""
+  
+  def setUp(self):
+    sqlite_backend = backend.SQLiteBackend()
+    query.SetBackend(sqlite_backend)
+    sqlite_backend.CreateDatabase('app')
+    query.Query('CREATE TABLE `app`.`items` (`id` INTEGER PRIMARY KEY, `name` TEXT)')
+    
+    # Start the commit feed over for this database
+    with versioning.COMMIT_FEED_CONDITION:
+      versioning.COMMIT_FEED.clear()
+      versioning.COMMIT_FEED_PENDING.clear()
+      versioning.COMMIT_FEED_START = None
+      versioning.COMMIT_FEED_VERSION = 0
+    
+    cache.Clear()
+    
+    self.session_id = process.Authenticate('test', 'test', 'app')['session']
+    process.SetMany(self.session_id, 'app', 'items', {'1':{'id':'1', 'name':'old'}})
+  
+  
+  def tearDown(self):
+    query.SetBackend(backend.MySQLBackend())
+  
+  
+  def testReadDuringCommit(self):
+    """A read at a version whose commit finishes while the read runs isnt cached"""
+    commit_written = threading.Event()
+    commit_release = threading.Event()
+    read_done = threading.Event()
+    read_release = threading.Event()
+    
+    commit_record_versions = versioning.CommitRecordVersions
+    get_records_at_version = versioning.GetRecordsAtVersion
+    
+    # Hold the writer's transaction open after it wrote its record versions
+    def CommitRecordVersions(*args, **kwargs):
+      result = commit_record_versions(*args, **kwargs)
+      commit_written.set()
+      commit_release.wait(THREAD_TIMEOUT)
+      return result
+    
+    # Hold the reader after it read, until the writer committed
+    def GetRecordsAtVersion(*args, **kwargs):
+      result = get_records_at_version(*args, **kwargs)
+      read_done.set()
+      read_release.wait(THREAD_TIMEOUT)
+      return result
+    
+    writer = threading.Thread(target=process.SetMany, args=(self.session_id, 'app', 'items', {'1':{'id':'1', 'name':'new'}}))
+    
+    with mock.patch.object(versioning, 'CommitRecordVersions', CommitRecordVersions):
+      writer.start()
+      self.assertTrue(commit_written.wait(THREAD_TIMEOUT))
+    
+    # The commit is in progress, its version is the newest
+    version = max(versioning.COMMIT_FEED_PENDING)
+    self.assertLess(versioning.GetCommittedVersion(), version)
+    
+    reads = []
+    reader = threading.Thread(target=lambda: reads.append(process.GetMany(self.session_id, 'app', 'items', version=version)))
+    
+    with mock.patch.object(versioning, 'GetRecordsAtVersion', GetRecordsAtVersion):
+      reader.start()
+      self.assertTrue(read_done.wait(THREAD_TIMEOUT))
+      
+      # Commit while the read is finishing
+      commit_release.set()
+      writer.join(THREAD_TIMEOUT)
+      self.assertGreaterEqual(versioning.GetCommittedVersion(), version)
+      
+      read_release.set()
+      reader.join(THREAD_TIMEOUT)
+    
+    # The read started before the commit, so it didnt see it, and it must not be cached
+    self.assertEqual(reads[0]['1']['name'], 'old')
+    self.assertEqual(process.GetMany(self.session_id, 'app', 'items', version=version)['1']['name'], 'new')
+    
+    # Now the version is committed, reads at it are cached
+    self.assertEqual(process.GetMany(self.session_id, 'app', 'items', version=version)['1']['name'], 'new')
+    self.assertGreaterEqual(cache.GetStats()['versioned']['hits'], 1)
+  
+  
+  def testPendingLowerVersion(self):
+    """The committed version is never at or past a commit still in progress"""
+    committed_version = versioning.GetCommittedVersion()
+    
+    # A lower version is pending, while a higher one was published
+    with versioning.COMMIT_FEED_CONDITION:
+      versioning.COMMIT_FEED_PENDING[committed_version + 1] = {'tables':[], 'finished':False, 'committed':False}
+      versioning.COMMIT_FEED_VERSION = committed_version + 2
+    
+    self.assertEqual(versioning.GetCommittedVersion(), committed_version)
+    
+    versioning._FinishFeedCommit(committed_version + 1, True)
+    self.assertEqual(versioning.GetCommittedVersion(), committed_version + 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
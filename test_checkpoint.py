@@ -0,0 +1,84 @@
+"""
+Tests for version checkpoints, against an in memory SQLite backend
+
+Run with:  python -m unittest test_checkpoint
+"""
+
+
+import unittest
+
+import backend
+import process
+import query
+import versioning
+
+
+class CheckpointTest(unittest.TestCase):
+  """Checkpoints are opt-in, keep their records exactly, and old ones are pruned"""
+  
+  def setUp(self):
+    sqlite_backend = backend.SQLiteBackend()
+    query.SetBackend(sqlite_backend)
+    sqlite_backend.CreateDatabase('app')
+    query.Query('CREATE TABLE `app`.`items` (`id` INTEGER PRIMARY KEY, `name` TEXT)')
+    
+    # Start the commit feed over for this database
+    with versioning.COMMIT_FEED_CONDITION:
+      versioning.COMMIT_FEED.clear()
+      versioning.COMMIT_FEED_PENDING.clear()
+      versioning.COMMIT_FEED_START = None
+      versioning.COMMIT_FEED_VERSION = 0
+    
+    with versioning.CHECKPOINT_LOCK:
+      versioning.CHECKPOINT_CONFIG.clear()
+      versioning.CHECKPOINT_COUNTS.clear()
+    
+    self.session_id = process.Authenticate('test', 'test', 'app')['session']
+  
+  
+  def tearDown(self):
+    query.SetBackend(backend.MySQLBackend())
+  
+  
+  def _GetCheckpoints(self):
+    """Returns list of the version_checkpoint rows of app.items, oldest first"""
+    return query.Query("SELECT `id`, `version` FROM `version_checkpoint` WHERE `database` = 'app' AND `table` = 'items' ORDER BY `version`")
+  
+  
+  def testOffByDefault(self):
+    """No checkpoints are created unless they are turned on"""
+    for count in range(3):
+      process.SetMany(self.session_id, 'app', 'items', {'1':{'id':'1', 'name':'n%s' % count}})
+      versioning.NoteCommit('app', 'items', count + 1, 1)
+    
+    self.assertTrue(versioning.CHECKPOINT_QUEUE.empty())
+    self.assertEqual(self._GetCheckpoints(), [])
+  
+  
+  def testRecordsAndPruning(self):
+    """Values JSON escapes (quotes, backslashes, newlines, non-ASCII) read back exactly, and only keep checkpoints stay"""
+    versioning.SetCheckpointConfig('app', 'items', keep=2)
+    
+    names = ['café', 'say "hi"', 'back\\slash', 'two\nlines', "it's"]
+    versions = []
+    for name in names:
+      process.SetMany(self.session_id, 'app', 'items', {'1':{'id':'1', 'name':name}})
+      versions.append(versioning.GetCommittedVersion())
+      versioning.CreateCheckpoint('app', 'items', versions[-1])
+    
+    checkpoints = self._GetCheckpoints()
+    self.assertEqual([int(item['version']) for item in checkpoints], versions[-2:])
+    
+    # Read the kept checkpoints' records directly, and through a versioned read
+    for (name, version) in zip(names[-2:], versions[-2:]):
+      checkpoint = versioning._GetCheckpoint('app', 'items', version)
+      self.assertEqual(int(checkpoint['version']), version)
+      self.assertEqual(versioning._GetCheckpointRecords(checkpoint['id'])['1']['name'], name)
+      self.assertEqual(versioning.GetRecordsAtVersion('app', 'items', version)['1']['name'], name)
+    
+    # Versions before the kept checkpoints are read from record_version
+    self.assertEqual(versioning.GetRecordsAtVersion('app', 'items', versions[0])['1']['name'], names[0])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,66 @@
+"""
+Tests that record keys are bound as params, against an in memory SQLite backend
+
+Run with:  python -m unittest test_keys
+"""
+
+
+import unittest
+
+import backend
+import process
+import query
+import versioning
+
+
+class BoundKeysTest(unittest.TestCase):
+  """Keys with quotes, backslashes and % in them are read, paged and deleted exactly"""
+  
+  def setUp(self):
+    sqlite_backend = backend.SQLiteBackend()
+    query.SetBackend(sqlite_backend)
+    sqlite_backend.CreateDatabase('app')
+    query.Query('CREATE TABLE `app`.`pairs` (`name` TEXT, `number` INTEGER, `value` TEXT, PRIMARY KEY (`name`, `number`))')
+    
+    self.session_id = process.Authenticate('test', 'test', 'app')['session']
+    schema = process.GetSchemaInfo(self.session_id, 'app', 'pairs')
+    
+    self.records = {}
+    for name in ["it's", '50%', 'back\\slash']:
+      for number in range(3):
+        record = {'name':name, 'number':str(number), 'value':'%s %s' % (name, number)}
+        self.records[process._CreateSchemaKey(schema, record)] = record
+    
+    process.SetMany(self.session_id, 'app', 'pairs', self.records)
+  
+  
+  def tearDown(self):
+    query.SetBackend(backend.MySQLBackend())
+  
+  
+  def testGetPageDelete(self):
+    """GetMany with keys, every GetManyPage, and DeleteMany only touch their records"""
+    keys = sorted(self.records.keys())
+    
+    data = process.GetMany(self.session_id, 'app', 'pairs', keys=keys[:4], use_cache=False)
+    self.assertEqual(sorted(data.keys()), keys[:4])
+    
+    paged = []
+    cursor = None
+    while True:
+      page = process.GetManyPage(self.session_id, 'app', 'pairs', page_size=2, cursor=cursor)
+      paged += list(page['records'].keys())
+      cursor = page['cursor']
+      if not cursor:
+        break
+    self.assertEqual(sorted(paged), keys)
+    
+    process.DeleteMany(self.session_id, 'app', 'pairs', keys[:2])
+    self.assertEqual(sorted(process.GetMany(self.session_id, 'app', 'pairs', use_cache=False).keys()), keys[2:])
+    
+    # Their record versions are found by key too
+    self.assertEqual(sorted(versioning.GetLatestVersions('app', 'pairs', keys[:3]).keys()), keys[:3])
+
+
+if __name__ == '__main__':
+  unittest.main()
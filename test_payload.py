@@ -0,0 +1,53 @@
+"""
+Tests for record version payloads of rows with values JSON cant encode, against an in memory SQLite backend
+
+Run with:  python -m unittest test_payload
+"""
+
+
+import base64
+import decimal
+import unittest
+
+import backend
+import process
+import query
+import versioning
+
+
+class PayloadTest(unittest.TestCase):
+  """Partial updates version the current row, which has the driver's types (bytes, Decimal)"""
+  
+  def setUp(self):
+    sqlite_backend = backend.SQLiteBackend()
+    query.SetBackend(sqlite_backend)
+    sqlite_backend.CreateDatabase('app')
+    query.Query('CREATE TABLE `app`.`files` (`id` INTEGER PRIMARY KEY, `name` TEXT, `content` BLOB)')
+    query.Query('INSERT INTO `app`.`files` (`id`, `name`, `content`) VALUES (1, %s, %s)', params=['old', b'\x00\xffdata'])
+    
+    self.session_id = process.Authenticate('test', 'test', 'app')['session']
+  
+  
+  def tearDown(self):
+    query.SetBackend(backend.MySQLBackend())
+  
+  
+  def testPartialUpdateWithBlob(self):
+    """Updating only the name of a row with a BLOB versions the BLOB as base64"""
+    process.SetMany(self.session_id, 'app', 'files', {'1':{'id':'1', 'name':'new'}})
+    
+    self.assertEqual(process.GetMany(self.session_id, 'app', 'files', use_cache=False)['1']['name'], 'new')
+    
+    record = versioning.GetRecordsAtVersion('app', 'files', versioning.GetCommittedVersion())['1']
+    self.assertEqual(record['name'], 'new')
+    self.assertEqual(base64.b64decode(record['content']), b'\x00\xffdata')
+  
+  
+  def testEncodeDecimal(self):
+    """Decimals are stored as their exact string"""
+    payload = versioning._EncodePayload({'price':decimal.Decimal('10.50')})
+    self.assertEqual(versioning._DecodePayload(payload)[0], {'price':'10.50'})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,73 @@
+"""
+Tests that writes never hold one pool connection while they wait for another, against an in memory SQLite backend
+
+Run with:  python -m unittest test_pool
+"""
+
+
+import unittest
+from unittest import mock
+
+import backend
+import process
+import query
+import session
+import versioning
+
+
+class WritePoolTest(unittest.TestCase):
+  """Writes work with one connection per pool, so concurrent writers cant deadlock the pool"""
+  
+  def setUp(self):
+    # One connection per pool, and fail fast instead of waiting for a second
+    self.patches = [mock.patch.object(query, 'POOL_MAX_SIZE', 1), mock.patch.object(query, 'POOL_WAIT_TIMEOUT', 1),
+                    mock.patch.object(versioning, 'RECORD_VERSION_BASE_INTERVAL', 4)]
+    for patch in self.patches:
+      patch.start()
+    
+    sqlite_backend = backend.SQLiteBackend()
+    query.SetBackend(sqlite_backend)
+    sqlite_backend.CreateDatabase('app')
+    query.Query('CREATE TABLE `app`.`items` (`id` INTEGER PRIMARY KEY, `name` TEXT, `qty` INTEGER)')
+    
+    self.session_id = process.Authenticate('test', 'test', 'app')['session']
+    
+    # The commit's user and the feed start have to be read from the database
+    with session.SESSION_CACHE_LOCK:
+      session.SESSION_CACHE.clear()
+    with versioning.COMMIT_FEED_CONDITION:
+      versioning.COMMIT_FEED_START = None
+  
+  
+  def tearDown(self):
+    query.SetBackend(backend.MySQLBackend())
+    
+    for patch in self.patches:
+      patch.stop()
+  
+  
+  def testPoolSettingsReadAtCreation(self):
+    """Pools use the POOL_* settings when they are created, not when query.py loaded"""
+    self.assertEqual(query.Transaction().pool.max_size, 1)
+    self.assertEqual(query.Transaction().pool.wait_timeout, 1)
+  
+  
+  def testWritesWithOneConnection(self):
+    """Set (with delta versions), delete and batch, with one connection per pool"""
+    process.SetMany(self.session_id, 'app', 'items', {'1':{'id':'1', 'name':'a', 'qty':'1'}, '2':{'id':'2', 'name':'b', 'qty':'2'}})
+    process.SetMany(self.session_id, 'app', 'items', {'1':{'id':'1', 'name':'a2', 'qty':'1'}})
+    process.SetMany(self.session_id, 'app', 'items', {'1':{'id':'1', 'name':'a3', 'qty':'3'}})
+    process.DeleteMany(self.session_id, 'app', 'items', ['2'])
+    process.Batch(self.session_id, [{'op':'set', 'database':'app', 'table':'items', 'records':{'3':{'id':'3', 'name':'c', 'qty':'3'}}}])
+    
+    data = process.GetMany(self.session_id, 'app', 'items')
+    self.assertEqual(sorted(data.keys()), ['1', '3'])
+    self.assertEqual(data['1']['name'], 'a3')
+    
+    # The delta versions rebuild to the records that were set
+    versions = versioning.GetRecordVersions(self.session_id, 'app', 'items', '1')
+    self.assertEqual(len(versions), 3)
+
+
+if __name__ == '__main__':
+  unittest.main()
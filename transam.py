@@ -13,6 +13,7 @@ __author__ = 'Geoff Howland <geoff@gmail.com>'
 import sys
 import os
 import socketserver
+import threading
 from xmlrpc.server import SimpleXMLRPCServer
 from xmlrpc.server import SimpleXMLRPCRequestHandler
 from traceback import format_tb
@@ -20,7 +21,11 @@ from traceback import format_tb
 import process
 import versioning
 import session
-from query import Log
+import binaryrpc
+import asyncserver
+import backend
+import query
+from query import Log, LOG_ERROR
 
 
 # Bind on this port (first year of TransAm production)
@@ -28,6 +33,23 @@ LISTEN_PORT = 1967
 # Use this when testing, to not conflict with the "production" service
 TEST_LISTEN_PORT = 7691
 
+# Bind the binary RPC transport on this port (transam://host:1968/)
+BINARY_LISTEN_PORT = 1968
+
+# Database backend: 'mysql', or 'sqlite' for embedded SQLite files in SQLITE_PATH (None is in memory)
+#   Can also be selected with the --sqlite or --sqlite=PATH argument
+DATABASE_BACKEND = 'mysql'
+SQLITE_PATH = None
+
+# Add any missing record_version indexes at startup, in the background.  If False, only log their DDL.
+#   Can also be selected with the --ensure-indexes argument, or run later with the EnsureRecordVersionIndexes RPC
+#NOTE(g): Adding an index to a big record_version takes a while, so do it when you choose to
+ENSURE_INDEXES = False
+
+# Server core: 'threaded' (a thread per request) or 'async' (event loop, bounded worker threads)
+#   Can also be selected with the --async or --threaded argument
+SERVER_MODE = 'threaded'
+
 
 # Threaded mix-in
 class AsyncXMLRPCServer(socketserver.ThreadingMixIn,SimpleXMLRPCServer):
@@ -42,7 +64,7 @@ class TransAm:
       return process.Authenticate(user, password, str(application))
     except Exception as exc:
       error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
-      Log(error)
+      Log(error, level=LOG_ERROR)
       return {'[error]':error}
     
   
@@ -51,7 +73,7 @@ class TransAm:
       return session.GetSessionInfo(session_id)
     except Exception as exc:
       error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
-      Log(error)
+      Log(error, level=LOG_ERROR)
       return {'[error]':error}
     
   
@@ -60,25 +82,53 @@ class TransAm:
       return process.GetMany(session_id, database, table, keys=keys, version=version)
     except Exception as exc:
       error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
-      Log(error)
+      Log(error, level=LOG_ERROR)
+      return {'[error]':error}
+    
+  
+  def GetManyPage(self, session_id, database, table, page_size=None, cursor=None):
+    try:
+      return process.GetManyPage(session_id, database, table, page_size=page_size, cursor=cursor)
+    except Exception as exc:
+      error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
+      Log(error, level=LOG_ERROR)
       return {'[error]':error}
     
   
-  def SetMany(self, session_id, database, table, records, comment=None):
+  def SetMany(self, session_id, database, table, records, comment=None, expected_version=None, return_counts=False):
     try:
-      return process.SetMany(session_id, database, table, records, comment=comment)
+      return process.SetMany(session_id, database, table, records, comment=comment, expected_version=expected_version,
+                             return_counts=return_counts)
     except Exception as exc:
       error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
-      Log(error)
+      Log(error, level=LOG_ERROR)
       return {'[error]':error}
     
   
-  def DeleteMany(self, session_id, database, table, keys, comment=None):
+  def DeleteMany(self, session_id, database, table, keys, comment=None, expected_version=None):
     try:
-      return process.DeleteMany(session_id, database, table, keys, comment=comment)
+      return process.DeleteMany(session_id, database, table, keys, comment=comment, expected_version=expected_version)
     except Exception as exc:
       error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
-      Log(error)
+      Log(error, level=LOG_ERROR)
+      return {'[error]':error}
+  
+    
+  def Batch(self, session_id, operations, comment=None):
+    try:
+      return process.Batch(session_id, operations, comment=comment)
+    except Exception as exc:
+      error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
+      Log(error, level=LOG_ERROR)
+      return {'[error]':error}
+  
+    
+  def RevertToVersion(self, session_id, database, table, version, keys=None, comment=None):
+    try:
+      return process.RevertToVersion(session_id, database, table, version, keys=keys, comment=comment)
+    except Exception as exc:
+      error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
+      Log(error, level=LOG_ERROR)
       return {'[error]':error}
   
     
@@ -87,16 +137,52 @@ class TransAm:
       return process.GetSchemaInfo(session_id, database, table)
     except Exception as exc:
       error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
-      Log(error)
+      Log(error, level=LOG_ERROR)
+      return {'[error]':error}
+  
+      
+  def ClearSchemaCache(self, session_id, database=None, table=None):
+    try:
+      return process.ClearSchemaCache(session_id, database=database, table=table)
+    except Exception as exc:
+      error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
+      Log(error, level=LOG_ERROR)
+      return {'[error]':error}
+  
+      
+  def GetPoolStats(self, session_id):
+    try:
+      return process.GetPoolStats(session_id)
+    except Exception as exc:
+      error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
+      Log(error, level=LOG_ERROR)
+      return {'[error]':error}
+  
+      
+  def GetCacheStats(self, session_id):
+    try:
+      return process.GetCacheStats(session_id)
+    except Exception as exc:
+      error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
+      Log(error, level=LOG_ERROR)
       return {'[error]':error}
   
       
+  def EnsureRecordVersionIndexes(self, session_id):
+    try:
+      return process.EnsureRecordVersionIndexes(session_id)
+    except Exception as exc:
+      error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
+      Log(error, level=LOG_ERROR)
+      return {'[error]':error}
+  
+  
   def GetDatabaseTables(self, session_id, database):
     try:
       return process.GetDatabaseTables(session_id, database)
     except Exception as exc:
       error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
-      Log(error)
+      Log(error, level=LOG_ERROR)
       return {'[error]':error}
   
   
@@ -105,25 +191,58 @@ class TransAm:
       return process.GetDatabases(session_id)
     except Exception as exc:
       error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
-      Log(error)
+      Log(error, level=LOG_ERROR)
+      return {'[error]':error}
+  
+  
+  def ListCommits(self, session_id, before_version=None, after_version=None, limit=None, newest_first=False, 
+                  user=None, since=None, until=None, database=None, table=None, counts=False):
+    try:
+      return versioning.ListCommits(session_id, before_version=before_version, after_version=after_version, limit=limit,
+                                    newest_first=newest_first, user=user, since=since, until=until, database=database,
+                                    table=table, counts=counts)
+    except Exception as exc:
+      error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
+      Log(error, level=LOG_ERROR)
+      return {'[error]':error}
+  
+  
+  def GetRecordVersions(self, session_id, database, table, key, metadata_only=False, after_version=None, before_version=None,
+                        limit=None, newest_first=False, versions=None):
+    try:
+      return versioning.GetRecordVersions(session_id, database, table, key, metadata_only=metadata_only, after_version=after_version,
+                                          before_version=before_version, limit=limit, newest_first=newest_first, versions=versions)
+    except Exception as exc:
+      error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
+      Log(error, level=LOG_ERROR)
       return {'[error]':error}
   
   
-  def ListCommits(self, session_id, before_version=None, after_version=None):
+  def WaitForCommits(self, session_id, after_version, timeout=None, database=None, table=None):
     try:
-      return versioning.ListCommits(session_id, before_version=before_version, after_version=after_version)
+      return versioning.WaitForCommits(session_id, after_version, timeout=timeout, database=database, table=table)
     except Exception as exc:
       error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
-      Log(error)
+      Log(error, level=LOG_ERROR)
       return {'[error]':error}
   
   
-  def GetRecordVersions(self, session_id, database, table, key):
+  def GetChanges(self, session_id, database, table, from_version, to_version=None, metadata_only=False):
     try:
-      return versioning.GetRecordVersions(session_id, database, table, key)
+      return versioning.GetChanges(session_id, database, table, from_version, to_version=to_version, metadata_only=metadata_only)
     except Exception as exc:
       error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
-      Log(error)
+      Log(error, level=LOG_ERROR)
+      return {'[error]':error}
+  
+  
+  def SetCheckpointConfig(self, session_id, database, table, commits=None, records=None, enabled=True, keep=None):
+    try:
+      versioning.SetCheckpointConfig(database, table, commits=commits, records=records, enabled=enabled, keep=keep)
+      return {}
+    except Exception as exc:
+      error = 'Error:\n%s\n%s\n' % ('\n'.join(format_tb(exc.__traceback__)), str(exc))
+      Log(error, level=LOG_ERROR)
       return {'[error]':error}
 
 
@@ -131,11 +250,66 @@ def Main(args=None):
   if not args:
     args = []
   
-  # Instantiate and bind our listening port
-  server = AsyncXMLRPCServer(('', LISTEN_PORT), SimpleXMLRPCRequestHandler, allow_none=True)
- 
+  server_mode = SERVER_MODE
+  if '--async' in args:
+    server_mode = 'async'
+  elif '--threaded' in args:
+    server_mode = 'threaded'
+  
+  ensure_indexes = ENSURE_INDEXES
+  if '--ensure-indexes' in args:
+    ensure_indexes = True
+  
+  database_backend = DATABASE_BACKEND
+  sqlite_path = SQLITE_PATH
+  listen_port = LISTEN_PORT
+  binary_listen_port = BINARY_LISTEN_PORT
+  for arg in args:
+    if arg == '--sqlite' or arg.startswith('--sqlite='):
+      database_backend = 'sqlite'
+      sqlite_path = arg.partition('=')[2] or None
+    elif arg.startswith('--port='):
+      listen_port = int(arg.partition('=')[2])
+    elif arg.startswith('--binary-port='):
+      binary_listen_port = int(arg.partition('=')[2])
+  
+  # Use embedded SQLite instead of a MySQL server
+  if database_backend == 'sqlite':
+    query.SetBackend(backend.SQLiteBackend(sqlite_path))
+  
   # Register example object instance
-  server.register_instance(TransAm())
+  instance = TransAm()
+  
+  # Clean up expired sessions in the background
+  session.StartSessionSweeper()
+  
+  # Add any missing record_version indexes in the background, this can take a while
+  if ensure_indexes:
+    index_thread = threading.Thread(target=versioning.EnsureRecordVersionIndexes, name='RecordVersionIndexes')
+    index_thread.daemon = True
+    index_thread.start()
+  
+  # Else, only tell the operator what to add
+  else:
+    versioning.LogMissingRecordVersionIndexes()
+  
+  # Serve XML-RPC and binary RPC from one event loop, with bounded worker threads
+  if server_mode == 'async':
+    asyncserver.Serve(instance, ('', listen_port), ('', binary_listen_port))
+    return
+  
+  # Instantiate and bind our listening port
+  server = AsyncXMLRPCServer(('', listen_port), SimpleXMLRPCRequestHandler, allow_none=True)
+  server.register_instance(instance)
+  
+  # Allow many calls in one request, to collapse read fan-out into one round trip
+  server.register_multicall_functions()
+  
+  # Serve the same instance over the binary RPC transport, in the background
+  binary_server = binaryrpc.BinaryRPCServer(('', binary_listen_port), instance)
+  binary_thread = threading.Thread(target=binary_server.serve_forever, name='BinaryRPCServer')
+  binary_thread.daemon = True
+  binary_thread.start()
  
   # Run!  Forever!
   #TODO(g): Switch to polling, and look for SIGTERM to quit nicely, finishing 
@@ -5,30 +5,205 @@ Handles all versioning issues for process.py, to separate concerns.
 """
 
 import json
+import decimal
+import datetime
+import threading
+import queue
+import zlib
+import base64
+import time
+import collections
 
 import session
 import query
-from query import Log, Query, SanitizeSQL
+from query import Log, Query
 
 
-def CreateCommitVersion(session_id, comment=None):
-  """Create the commit_version entry to reference all records stored.
+# Storage format of record_version.data
+#NOTE(g): By default every version stores the full record as JSON.  If 
+#   RECORD_VERSION_BASE_INTERVAL is more than 1, only every Nth version of a 
+#   record stores the full record, the versions in between store the fields 
+#   changed since the previous version.  If RECORD_VERSION_COMPRESS, the JSON 
+#   is zlib compressed (base64, as data is a text column).  Reads handle all 
+#   formats, so these can be changed at any time.
+RECORD_VERSION_BASE_INTERVAL = 1
+RECORD_VERSION_COMPRESS = False
+
+# Compressed payloads smaller than this are stored uncompressed
+RECORD_VERSION_COMPRESS_MIN = 200
+
+
+# Create checkpoints of the full state of a table, so reading an old version
+#   only has to apply the changes since the newest checkpoint before it.
+#NOTE(g): Off unless turned on for a table with SetCheckpointConfig(), or for every
+#   table with CHECKPOINTS_ENABLED.  Creating one reads the whole table into memory
+#   and writes it in one transaction, so only use them on tables where old version 
+#   reads are slow.  A checkpoint is created after this many commits or changed 
+#   records to a table, and only the newest CHECKPOINT_KEEP of each table are kept.
+CHECKPOINTS_ENABLED = False
+CHECKPOINT_COMMITS = 1000
+CHECKPOINT_RECORDS = 50000
+CHECKPOINT_KEEP = 3
+
+# Per table config from SetCheckpointConfig(), and counts since the last checkpoint, keyed on (database, table)
+#NOTE(g): Counts are only kept in memory, so a restart delays the next checkpoint
+CHECKPOINT_CONFIG = {}
+CHECKPOINT_COUNTS = {}
+CHECKPOINT_LOCK = threading.Lock()
+
+# Checkpoints waiting to be created by the background thread: (database, table, version)
+CHECKPOINT_QUEUE = queue.Queue()
+CHECKPOINT_THREAD = None
+
+# Checkpoint tables, created the first time a table with checkpoints turned on needs them.
+#   Create them yourself with this DDL if TransAm's MySQL user cant CREATE TABLE.
+#NOTE(g): This is MySQL, backends that create the system tables already made them
+CHECKPOINT_TABLES_CREATED = False
+CHECKPOINT_TABLES_FAILED = False
+CHECKPOINT_TABLES_SQL = [
+  """CREATE TABLE IF NOT EXISTS `version_checkpoint` (
+    `id` INT NOT NULL AUTO_INCREMENT,
+    `database` VARCHAR(255) NOT NULL,
+    `table` VARCHAR(255) NOT NULL,
+    `version` INT NOT NULL,
+    `record_count` INT NOT NULL DEFAULT 0,
+    `created` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (`id`),
+    KEY `database_table_version` (`database`, `table`, `version`)
+  )""",
+  """CREATE TABLE IF NOT EXISTS `version_checkpoint_record` (
+    `checkpoint` INT NOT NULL,
+    `record` VARCHAR(255) NOT NULL,
+    `data` LONGTEXT,
+    PRIMARY KEY (`checkpoint`, `record`)
+  )""",
+]
+
+
+# Feed of the commits made by this process, for WaitForCommits()
+#NOTE(g): Commits are published in version order, once every lower version this
+#   process created has been committed or rolled back, so waiters never see a 
+#   version before an older one they would then miss.  Only this process's commits
+#   are in the feed, like the table write locks, this assumes one TransAm server.
+COMMIT_FEED_SIZE = 10000
+COMMIT_FEED = collections.deque(maxlen=COMMIT_FEED_SIZE)
+COMMIT_FEED_CONDITION = threading.Condition()
+# Commits in progress, keyed on version, value is dict: 'tables' list of [database, table, records], 'finished', 'committed'
+COMMIT_FEED_PENDING = {}
+# The feed has every commit after this version (None until we know), and up to COMMIT_FEED_VERSION
+COMMIT_FEED_START = None
+COMMIT_FEED_VERSION = 0
+# Held while a commit_version is INSERTed and noted in COMMIT_FEED_PENDING
+#NOTE(g): Otherwise a lower version could be allocated but not yet pending, while a 
+#   higher one finishes and COMMIT_FEED_VERSION moves past it
+COMMIT_FEED_REGISTER_LOCK = threading.Lock()
+
+# Seconds WaitForCommits() waits by default, and at most
+COMMIT_WAIT_TIMEOUT = 30
+COMMIT_WAIT_TIMEOUT_MAX = 300
+
+# Most commits WaitForCommits() returns from the database, when the feed doesnt go back far enough
+COMMIT_WAIT_DATABASE_LIMIT = 1000
+
+
+# Indexes record_version needs for version reads, by name.  Added by EnsureRecordVersionIndexes() if missing.
+#NOTE(g): (database, table, record, version) reads a record's versions, and the newest 
+#   version of records.  (database, table, version) lets GetChanges() read only the 
+#   versions in its range, so incremental syncs cost the churn, not the table size.  
+#   (version, database, table) counts the changes of a page of commits for ListCommits().
+RECORD_VERSION_INDEXES = {
+  'database_table_record_version':('database', 'table', 'record', 'version'),
+  'database_table_version':('database', 'table', 'version'),
+  'version_database_table':('version', 'database', 'table'),
+}
+
+
+# Most commits ListCommits() returns in a page
+LIST_COMMITS_LIMIT_MAX = 10000
+
+# commit_version field with the time of the commit, for the ListCommits() time range
+#NOTE(g): Only used if since/until are passed, set it to your commit_version timestamp field
+COMMIT_VERSION_TIME_FIELD = 'created'
+
+
+class VersionConflict(Exception):
+  """A record was changed after the version the writer expected"""
+
+
+def GetLatestVersions(database, table, keys):
+  """Returns dict, key is the record key and value is the newest version (int) it was changed in.
   
-  Returns: int, commit_version.id (or None on failure)
+  Records that have never been versioned are not included.
+  """
+  data = {}
+  for (batch_where, params) in _GetRecordWhereList('`database` = %s AND `table` = %s', keys, [database, table]):
+    sql = "SELECT `record`, MAX(`version`) AS `max_version` FROM `record_version` WHERE %s GROUP BY `record`" % batch_where
+    result = Query(sql, params=params)
+    
+    for item in result:
+      data[item['record']] = int(item['max_version'])
+  
+  return data
+
+
+def CheckExpectedVersion(database, table, keys, expected_version):
+  """Raises VersionConflict if any of these records changed after expected_version."""
+  latest_versions = GetLatestVersions(database, table, keys)
+  
+  stale_keys = [key for key in latest_versions if latest_versions[key] > int(expected_version)]
+  if stale_keys:
+    stale_keys.sort()
+    raise VersionConflict('Records changed after expected version %s: %s: %s: %s' % (expected_version, database, table, ', '.join(stale_keys)))
+
+
+def PrepareCommitVersion(session_id):
+  """Look up what CreateCommitVersion() needs from the database.  Returns string, the user name to pass it.
+  
+  Call before the commit's query.Transaction() is entered, so the transaction never 
+  holds its pool connection while it waits for another one to do these queries.
   """
   #TODO(g): Finish Authorize() and fetch the user from session.key
   
+  # Know where the feed starts before any commit is pending, so it cant start after one
+  _GetFeedStart()
+  
   # Get the user for this session
-  user_name = session.GetUser(session_id)
+  return session.GetUser(session_id)
+
+
+def CreateCommitVersion(session_id, comment=None, transaction=None, user_name=None):
+  """Create the commit_version entry to reference all records stored.
+  
+  Args:
+    session_id: string, session ID
+    comment: string or None, comment for this commit
+    transaction: query.Transaction or None, if specified, the INSERT is done in this transaction
+    user_name: string or None, from PrepareCommitVersion().  If None, it is called here, 
+        which checks out another pool connection while the transaction holds one.
+  
+  Returns: int, commit_version.id (or None on failure)
+  """
+  if user_name == None:
+    user_name = PrepareCommitVersion(session_id)
   
   # Create INSERT SQL without or with comment
   if not comment:
-    sql = "INSERT INTO commit_version (`user`) VALUES ('%s')" % SanitizeSQL(user_name)
+    sql = "INSERT INTO commit_version (`user`) VALUES (%s)"
+    params = [user_name]
   else:
-    sql = "INSERT INTO commit_version (`user`, `comment`) VALUES ('%s', '%s')" % (SanitizeSQL(user_name), SanitizeSQL(comment))
+    sql = "INSERT INTO commit_version (`user`, `comment`) VALUES (%s, %s)"
+    params = [user_name, comment]
   
   # Insert the commit and get the version
-  version = Query(sql)
+  if transaction:
+    # Hold back newer versions in the commit feed until this one is finished
+    with COMMIT_FEED_REGISTER_LOCK:
+      version = transaction.Query(sql, params)
+      _BeginFeedCommit(version)
+    
+    transaction.AddFinishCallback(lambda committed: _FinishFeedCommit(version, committed))
+  else:
+    version = Query(sql, params=params)
   
   return version
 
@@ -37,63 +212,229 @@ def CommitRecordVersion(commit_version, schema, database, table, key, data=None,
   """Store a version of a record.  Assume not deleting unless specified."""
   # Create the INSERT SQL for the data storage
   if not delete:
-    sql = "INSERT INTO record_version (`version`, `database`, `table`, `record`, `data`) VALUES (%s, '%s', '%s', '%s', '%s')" % \
-          (commit_version, SanitizeSQL(database), SanitizeSQL(table), SanitizeSQL(key), SanitizeSQL(json.dumps(data)))
+    sql = "INSERT INTO record_version (`version`, `database`, `table`, `record`, `data`) VALUES (%s, %s, %s, %s, %s)"
+    params = [int(commit_version), database, table, key, _EncodePayload(data)]
   # Create the INSERT SQL for the delete entry
   else:
-    sql = "INSERT INTO record_version (`version`, `database`, `table`, `record`, `is_deleted`) VALUES (%s, '%s', '%s', '%s', 1)" % \
-          (commit_version, SanitizeSQL(database), SanitizeSQL(table), SanitizeSQL(key))
+    sql = "INSERT INTO record_version (`version`, `database`, `table`, `record`, `is_deleted`) VALUES (%s, %s, %s, %s, 1)"
+    params = [int(commit_version), database, table, key]
   
   # Execute the record version INSERT
-  Query(sql)  
+  Query(sql, params=params)  
+
+
+def CommitRecordVersions(commit_version, database, table, records, delete=False, transaction=None):
+  """Store a version of many records, with multi-row INSERTs.
+  
+  Args:
+    commit_version: int, commit_version.id these records are stored with
+    database: string, database name
+    table: string, table name
+    records: dict or sequence, if not delete, dict keyed on record key with the record data 
+        dict as value.  If delete, a sequence of record keys.
+    delete: boolean, if True, store these records as deleted
+    transaction: query.Transaction or None, if specified, the INSERTs are done in this transaction
+  """
+  # Encode the record data for storage, reading previous versions on the transaction's connection
+  if not delete:
+    if transaction:
+      payloads = _EncodeRecordVersions(database, table, records, query_function=transaction.Query)
+    else:
+      payloads = _EncodeRecordVersions(database, table, records)
+  
+  # Get the values to bind for every record
+  params_list = []
+  for key in records:
+    if not delete:
+      params_list.append((int(commit_version), database, table, key, payloads[key], 0))
+    else:
+      params_list.append((int(commit_version), database, table, key, None, 1))
+  
+  #NOTE(g): The driver binds the values and sends them as multi-row INSERTs, sized to 
+  #   keep the statement size sane
+  sql = "INSERT INTO `record_version` (`version`, `database`, `table`, `record`, `data`, `is_deleted`) VALUES (%s, %s, %s, %s, %s, %s)"
+  
+  if transaction:
+    transaction.QueryMany(sql, params_list)
+  else:
+    with query.Transaction() as transaction:
+      transaction.QueryMany(sql, params_list)
+  
+  _AddFeedCommitTable(commit_version, database, table, len(params_list))
 
 
-def ListCommits(session_id, before_version=None, after_version=None):
-  """List all the commits, optionally before/after version to limit view.
+def ListCommits(session_id, before_version=None, after_version=None, limit=None, newest_first=False, 
+                user=None, since=None, until=None, database=None, table=None, counts=False):
+  """List the commits, optionally before/after version to limit view.
+  
+  Page through them by passing the last version of a page as after_version (or 
+  before_version if newest_first) for the next page.
   
-  Returns: dict, keyed on version number, value is dict of commit info
+  Args:
+    session_id: string, session ID
+    before_version: int or None, only commits before this version
+    after_version: int or None, only commits after this version
+    limit: int or None, return at most this many commits, up to LIST_COMMITS_LIMIT_MAX.  If None, all of them
+    newest_first: boolean, if True, the newest commits first, else the oldest first
+    user: string or None, only commits by this user
+    since: string or None, only commits at or after this time (YYYY-MM-DD HH:MM:SS)
+    until: string or None, only commits before this time (YYYY-MM-DD HH:MM:SS)
+    database: string or None, only commits that changed this database
+    table: string or None, only commits that changed this table
+    counts: boolean, if True, each commit has 'changes' (int, records changed), 'deleted' (int, 
+        records deleted) and 'tables' (list of [database, table, records changed])
+  
+  Returns: dict, keyed on version number, value is dict of commit info.  In the order asked for.
   """
   # Create the SQL for the list of versions
-  sql = 'SELECT * FROM `commit_version`'
-  where = ''
+  sql = 'SELECT * FROM `commit_version` AS `cv`'
+  where = []
+  params = []
   
   # If we want versions before a specified version
   if before_version:
-    where += '`id` < %s' % int(before_version)
+    where.append('`cv`.`id` < %s' % int(before_version))
   
   # If we want versions after a specific version
   if after_version:
-    if where:
-      where += ' AND '
+    where.append('`cv`.`id` > %s' % int(after_version))
+  
+  if user != None:
+    where.append('`cv`.`user` = %s')
+    params.append(user)
+  
+  if since != None:
+    where.append('`cv`.`%s` >= %%s' % COMMIT_VERSION_TIME_FIELD)
+    params.append(since)
+  
+  if until != None:
+    where.append('`cv`.`%s` < %%s' % COMMIT_VERSION_TIME_FIELD)
+    params.append(until)
+  
+  # Only commits that changed the database/table, looked up per commit on the (database, table, version) index
+  if database != None or table != None:
+    record_where = ['`rv`.`version` = `cv`.`id`']
+    if database != None:
+      record_where.append('`rv`.`database` = %s')
+      params.append(database)
+    if table != None:
+      record_where.append('`rv`.`table` = %s')
+      params.append(table)
     
-    where += '`id` > %s' % int(after_version)
+    where.append('EXISTS (SELECT 1 FROM `record_version` AS `rv` WHERE %s)' % ' AND '.join(record_where))
   
   # If we had WHERE clauses, add them to the SQL statement
   if where:
-    sql = '%s WHERE %s' % (sql, where)
+    sql = '%s WHERE %s' % (sql, ' AND '.join(where))
+  
+  # Walk the PRIMARY KEY in order, so a limited page reads only its rows
+  if newest_first:
+    sql += ' ORDER BY `cv`.`id` DESC'
+  else:
+    sql += ' ORDER BY `cv`.`id`'
+  
+  if limit != None:
+    sql += ' LIMIT %s' % max(1, min(int(limit), LIST_COMMITS_LIMIT_MAX))
   
   # Query our versions
-  result = query.Query(sql)
+  result = query.Query(sql, params=params)
   
   # Return as a dict, keyed on the id
   data = {}
   for item in result:
     data[str(item['id'])] = item
   
+  if counts:
+    _AddCommitCounts(data)
+  
   return data
 
 
-def GetRecordVersions(session_id, database, table, key):
-  """Returns all the versions of the database/table/key.
+def _AddCommitCounts(commits):
+  """Add 'changes', 'deleted' and 'tables' to each commit (dict keyed on version) from ListCommits()
+  
+  Only counts the record_version rows, never reads their data.
+  """
+  for commit in commits.values():
+    commit['changes'] = 0
+    commit['deleted'] = 0
+    commit['tables'] = []
+  
+  versions = list(commits.keys())
+  for offset in range(0, len(versions), query.KEY_BATCH_SIZE):
+    batch = versions[offset:offset + query.KEY_BATCH_SIZE]
+    
+    sql = 'SELECT `version`, `database`, `table`, COUNT(*) AS `records`, SUM(`is_deleted`) AS `deleted` FROM `record_version` ' \
+          'WHERE `version` IN (%s) GROUP BY `version`, `database`, `table`' % ', '.join([str(int(version)) for version in batch])
+    result = Query(sql)
+    
+    for item in result:
+      commit = commits[str(item['version'])]
+      commit['changes'] += int(item['records'])
+      commit['deleted'] += int(item['deleted'] or 0)
+      commit['tables'].append([item['database'], item['table'], int(item['records'])])
+
+
+def GetRecordVersions(session_id, database, table, key, metadata_only=False, after_version=None, before_version=None,
+                      limit=None, newest_first=False, versions=None):
+  """Returns the versions of the database/table/key.
+  
+  By default all versions with their data.  For a history list, use metadata_only 
+  and a window, then get the data of the versions you need with versions=[...].
+  
+  Args:
+    session_id: string, session ID
+    database: string, database name
+    table: string, table name
+    key: string, record key
+    metadata_only: boolean, if True, no 'data', instead the commit info of each version 
+        ('user', 'comment', and the rest of its commit_version fields)
+    after_version: int or None, only versions after this version
+    before_version: int or None, only versions before this version
+    limit: int or None, return at most this many versions
+    newest_first: boolean, if True (and limit), the newest versions in the window, else the oldest
+    versions: list of ints or None, only these versions
   
   Returns: dict, key is the commit_version.id(int) and value is dict of the entry.  
       Relevant keys are 'data' and 'is_deleted'
   """
   data = {}
   
-  sql = "SELECT * FROM `record_version` WHERE `database` = '%s' AND `table` = '%s' AND `record`='%s'" % \
-        (SanitizeSQL(database), SanitizeSQL(table), SanitizeSQL(key))
-  result = Query(sql)
+  where = '`rv`.`database` = %s AND `rv`.`table` = %s AND `rv`.`record` = %s'
+  
+  if after_version != None:
+    where += ' AND `rv`.`version` > %s' % int(after_version)
+  if before_version != None:
+    where += ' AND `rv`.`version` < %s' % int(before_version)
+  
+  if versions != None:
+    if not versions:
+      return data
+    where += ' AND `rv`.`version` IN (%s)' % ', '.join([str(int(version)) for version in versions])
+  
+  # Only the version info, and the commit info from its commit_version, never the data
+  if metadata_only:
+    sql = 'SELECT `rv`.`version`, `rv`.`is_deleted`, `cv`.* FROM `record_version` AS `rv` ' \
+          'LEFT JOIN `commit_version` AS `cv` ON `cv`.`id` = `rv`.`version` WHERE %s' % where
+  else:
+    sql = 'SELECT `rv`.* FROM `record_version` AS `rv` WHERE %s' % where
+  
+  # Read the window in version order on the (database, table, record, version) index
+  if newest_first:
+    sql += ' ORDER BY `rv`.`version` DESC'
+  else:
+    sql += ' ORDER BY `rv`.`version`'
+  
+  if limit != None:
+    sql += ' LIMIT %s' % max(1, int(limit))
+  
+  result = list(Query(sql, params=[database, table, key]))
+  
+  if metadata_only:
+    for item in result:
+      item.pop('id', None)
+  else:
+    _LoadRecordVersionData(database, table, key, result)
   
   # Return the versions, key on version number for this record
   for item in result:
@@ -101,3 +442,795 @@ def GetRecordVersions(session_id, database, table, key):
   
   return data
 
+
+def _LoadRecordVersionData(database, table, key, rows):
+  """Set each record_version row's 'data' to its full record JSON, rebuilding versions stored as changes.
+  
+  Only the versions from the oldest full version the rows need are read, not the whole history.
+  
+  Args:
+    rows: list of record_version row dicts of one record
+  """
+  # Find the full versions the versions stored as changes start from
+  base_versions = []
+  for item in rows:
+    if not item['is_deleted']:
+      (payload, is_delta) = _DecodePayload(item['data'])
+      if is_delta:
+        base_versions.append(payload['b'])
+  
+  # Rebuild the record at every version from there
+  records = {}
+  if base_versions:
+    history = _GetRecordHistory(database, table, {key:(min(base_versions), max([item['version'] for item in rows]))})
+    
+    record = None
+    for item in history.get(key, []):
+      if item['is_deleted']:
+        record = None
+      else:
+        record = _DecodeRecordData(item['data'], record)
+      
+      records[item['version']] = record
+  
+  for item in rows:
+    if item['is_deleted']:
+      continue
+    
+    (payload, is_delta) = _DecodePayload(item['data'])
+    if is_delta:
+      item['data'] = json.dumps(records[item['version']])
+    else:
+      item['data'] = json.dumps(payload)
+
+
+def WaitForCommits(session_id, after_version, timeout=None, database=None, table=None):
+  """Waits for commits newer than after_version, and returns them.  Costs no queries while waiting.
+  
+  Args:
+    session_id: string, session ID
+    after_version: int, return commits after this commit_version.id
+    timeout: number or None, seconds to wait, up to COMMIT_WAIT_TIMEOUT_MAX.  If None, COMMIT_WAIT_TIMEOUT
+    database: string or None, if specified, only commits that changed this database
+    table: string or None, if specified, only commits that changed this table
+  
+  Returns: dict, 'commits' is list of dicts in version order: 'version' (int), 'tables' (list of 
+      [database, table, records changed]).  Empty if we timed out.  'version' (int) is the 
+      after_version to pass to the next call.  Commits older than the feed are read from the
+      database, COMMIT_WAIT_DATABASE_LIMIT at a time, so keep calling to get the rest.
+  """
+  after_version = int(after_version)
+  
+  if timeout == None:
+    timeout = COMMIT_WAIT_TIMEOUT
+  deadline = time.time() + max(0, min(float(timeout), COMMIT_WAIT_TIMEOUT_MAX))
+  
+  # If the feed doesnt go back far enough, get the commits it is missing from the database
+  feed_start = _GetFeedStart()
+  if after_version < feed_start:
+    (commits, next_version) = _GetDatabaseCommits(after_version, feed_start, database=database, table=table)
+    if commits:
+      return {'commits':commits, 'version':next_version}
+    
+    after_version = feed_start
+  
+  with COMMIT_FEED_CONDITION:
+    while True:
+      commits = [commit for commit in COMMIT_FEED if commit['version'] > after_version and _IsFeedCommitMatch(commit, database, table)]
+      
+      remaining = deadline - time.time()
+      if commits or remaining <= 0:
+        break
+      
+      COMMIT_FEED_CONDITION.wait(remaining)
+    
+    # Everything up to the feed version has been published, so the next call can start there
+    next_version = max(after_version, COMMIT_FEED_VERSION)
+  
+  return {'commits':commits, 'version':next_version}
+
+
+def _IsFeedCommitMatch(commit, database, table):
+  """Returns boolean, True if the feed commit changed the database and table (if specified)"""
+  if database == None and table == None:
+    return True
+  
+  for (commit_database, commit_table, _) in commit['tables']:
+    if (database == None or commit_database == database) and (table == None or commit_table == table):
+      return True
+  
+  return False
+
+
+def _GetFeedStart():
+  """Returns int, the feed has every commit after this version.  The first call gets the newest version."""
+  global COMMIT_FEED_START
+  global COMMIT_FEED_VERSION
+  
+  with COMMIT_FEED_CONDITION:
+    if COMMIT_FEED_START != None:
+      return COMMIT_FEED_START
+  
+  result = Query('SELECT MAX(`id`) AS `version` FROM `commit_version`')
+  newest_version = int(result[0]['version'] or 0)
+  
+  with COMMIT_FEED_CONDITION:
+    if COMMIT_FEED_START == None:
+      COMMIT_FEED_START = newest_version
+      COMMIT_FEED_VERSION = max(COMMIT_FEED_VERSION, newest_version)
+    
+    return COMMIT_FEED_START
+
+
+def GetCommittedVersion():
+  """Returns int, every version up to this one is committed (or rolled back), so reads at it never change"""
+  _GetFeedStart()
+  
+  with COMMIT_FEED_CONDITION:
+    # Never at or past a commit still in progress
+    if COMMIT_FEED_PENDING:
+      return min(COMMIT_FEED_VERSION, min(COMMIT_FEED_PENDING) - 1)
+    
+    return COMMIT_FEED_VERSION
+
+
+def _GetDatabaseCommits(after_version, to_version, database=None, table=None, limit=COMMIT_WAIT_DATABASE_LIMIT):
+  """Returns tuple (list of commits in (after_version, to_version] from record_version, like 
+  WaitForCommits(), int version they go up to).  At most limit commits, the oldest.
+  """
+  where = ''
+  params = []
+  if database != None:
+    where += ' AND `database` = %s'
+    params.append(database)
+  if table != None:
+    where += ' AND `table` = %s'
+    params.append(table)
+  
+  # If there are more than limit commits, only go up to the last one of the oldest limit
+  #NOTE(g): Limit on versions, not rows, so a commit's tables are never split between calls
+  sql = 'SELECT DISTINCT `version` FROM `record_version` WHERE `version` > %s AND `version` <= %s%s ' \
+        'ORDER BY `version` LIMIT %s' % (int(after_version), int(to_version), where, int(limit))
+  versions = Query(sql, params=params)
+  if len(versions) >= int(limit):
+    to_version = versions[-1]['version']
+  
+  where = '`version` > %s AND `version` <= %s%s' % (int(after_version), int(to_version), where)
+  
+  sql = 'SELECT `version`, `database`, `table`, COUNT(*) AS `records` FROM `record_version` WHERE %s ' \
+        'GROUP BY `version`, `database`, `table` ORDER BY `version`' % where
+  result = Query(sql, params=params)
+  
+  commits = []
+  for item in result:
+    if not commits or commits[-1]['version'] != item['version']:
+      commits.append({'version':item['version'], 'tables':[]})
+    
+    commits[-1]['tables'].append([item['database'], item['table'], int(item['records'])])
+  
+  return (commits, int(to_version))
+
+
+def _BeginFeedCommit(version):
+  """Note a commit in progress, so newer commits are held back in the feed until it is finished.
+  
+  Must hold COMMIT_FEED_REGISTER_LOCK since version was allocated, and _GetFeedStart() was called before.
+  """
+  with COMMIT_FEED_CONDITION:
+    COMMIT_FEED_PENDING[version] = {'tables':[], 'finished':False, 'committed':False}
+
+
+def _AddFeedCommitTable(version, database, table, records):
+  """Note a table changed by a commit in progress"""
+  with COMMIT_FEED_CONDITION:
+    if version in COMMIT_FEED_PENDING:
+      COMMIT_FEED_PENDING[version]['tables'].append([database, table, records])
+
+
+def _FinishFeedCommit(version, committed):
+  """A commit was committed or rolled back.  Publish the finished commits we can, in version order."""
+  global COMMIT_FEED_START
+  global COMMIT_FEED_VERSION
+  
+  with COMMIT_FEED_CONDITION:
+    if version not in COMMIT_FEED_PENDING:
+      return
+    
+    COMMIT_FEED_PENDING[version]['finished'] = True
+    COMMIT_FEED_PENDING[version]['committed'] = committed
+    
+    # Publish from the oldest commit, until one is still in progress
+    published = False
+    for pending_version in sorted(COMMIT_FEED_PENDING.keys()):
+      pending = COMMIT_FEED_PENDING[pending_version]
+      if not pending['finished']:
+        break
+      
+      del COMMIT_FEED_PENDING[pending_version]
+      COMMIT_FEED_VERSION = max(COMMIT_FEED_VERSION, pending_version)
+      published = True
+      
+      if pending['committed'] and pending['tables']:
+        # The oldest commit is about to drop off the feed, so the feed starts after it
+        if len(COMMIT_FEED) == COMMIT_FEED.maxlen:
+          COMMIT_FEED_START = max(COMMIT_FEED_START or 0, COMMIT_FEED[0]['version'])
+        
+        COMMIT_FEED.append({'version':pending_version, 'tables':pending['tables']})
+    
+    if published:
+      COMMIT_FEED_CONDITION.notify_all()
+
+
+def GetChanges(session_id, database, table, from_version, to_version=None, metadata_only=False):
+  """Returns the records changed in database/table after from_version, up to to_version.
+  
+  For incremental syncs: pass the returned 'to_version' as the next from_version, 
+  and only the records changed since are returned.
+  
+  Args:
+    session_id: string, session ID
+    database: string, database name
+    table: string, table name
+    from_version: int, only changes after this commit_version.id.  0 for all changes
+    to_version: int or None, only changes at or before this commit_version.id.  If None, 
+        the newest commit
+    metadata_only: boolean, if True, only the version and deleted flag are returned, not the data
+  
+  Returns: dict, {'from_version':int, 'to_version':int, 'changes':dict}.  'changes' is keyed on
+      the record key (string), value is dict: 'version' (int, its newest version in the range),
+      'is_deleted' (boolean), and unless metadata_only, 'data' (record dict, or None if deleted)
+  """
+  from_version = int(from_version)
+  
+  # Use the newest commit, waiting for any write to this table in progress
+  #NOTE(g): Versions are created before their transaction commits, so a newer 
+  #   commit could be visible while an older one to this table is not yet.  Writers
+  #   hold the table write lock until they commit, so anything newer is after us.
+  if to_version == None:
+    with query.GetTableWriteLock(database, table):
+      result = Query('SELECT MAX(`id`) AS `version` FROM `commit_version`')
+    
+    to_version = int(result[0]['version'] or 0)
+  
+  to_version = int(to_version)
+  
+  changes = {}
+  if to_version > from_version:
+    rows = _GetNewestRecordVersions(database, table, to_version, after_version=from_version, with_data=not metadata_only)
+    
+    if not metadata_only:
+      changed_data = _LoadRecordData(database, table, rows)
+    
+    for (key, item) in rows.items():
+      changes[key] = {'version':item['version'], 'is_deleted':bool(item['is_deleted'])}
+      if not metadata_only:
+        changes[key]['data'] = changed_data.get(key)
+  
+  return {'from_version':from_version, 'to_version':to_version, 'changes':changes}
+
+
+def GetChangedKeys(database, table, after_version, keys=None):
+  """Returns set of the keys of records in database/table changed after after_version.
+  
+  Args:
+    keys: sequence of strings or None, if a sequence of strings, only check these records
+  """
+  rows = _GetNewestRecordVersions(database, table, None, after_version=after_version, keys=keys, with_data=False)
+  
+  return set(rows.keys())
+
+
+def GetRecordsAtVersion(database, table, version, keys=None):
+  """Returns the newest data of every record in database/table at or below version.
+  
+  Starts from the newest checkpoint at or below version (if any), and applies only
+  the newest record_version row per record after it (groupwise max), so the cost
+  is by the number of records, not the number of versions stored.
+  
+  Args:
+    database: string, database name
+    table: string, table name
+    version: int, commit_version.id to get the data as of
+    keys: sequence of strings or None, if a sequence of strings, only records with
+        these keys will be returned
+  
+  Returns: dict, key is the record key (string), value is the record data dict.  
+      Records that were deleted (or did not exist yet) at this version are not included.
+  """
+  # Start with the checkpoint, if we have one
+  checkpoint = _GetCheckpoint(database, table, version)
+  if checkpoint:
+    data = _GetCheckpointRecords(checkpoint['id'], keys=keys)
+    after_version = checkpoint['version']
+  else:
+    data = {}
+    after_version = None
+  
+  # Apply the changes since the checkpoint
+  changes = _GetNewestRecordVersions(database, table, version, after_version=after_version, keys=keys)
+  changed_data = _LoadRecordData(database, table, changes)
+  for key in changes:
+    if key in changed_data:
+      data[key] = changed_data[key]
+    else:
+      data.pop(key, None)
+  
+  return data
+
+
+def _EncodePayload(data, delta=False):
+  """Returns string, data encoded for storage in record_version.data or a checkpoint
+  
+  Full records are plain JSON (as they have always been stored), unless compressed.  
+  Other formats have a prefix: 'z:' compressed, 'd:' changes, 'dz:' compressed changes.
+  """
+  payload = json.dumps(data, default=_EncodePayloadValue)
+  prefix = ''
+  
+  if delta:
+    prefix += 'd'
+  
+  # Compress it, if it is worth it
+  if RECORD_VERSION_COMPRESS and len(payload) >= RECORD_VERSION_COMPRESS_MIN:
+    compressed = base64.b64encode(zlib.compress(payload.encode('utf-8'))).decode('ascii')
+    if len(compressed) < len(payload):
+      payload = compressed
+      prefix += 'z'
+  
+  if prefix:
+    payload = '%s:%s' % (prefix, payload)
+  
+  return payload
+
+
+def _EncodePayloadValue(value):
+  """Convert the values a database row can have that JSON cant encode, the same as the RPC layer returns them"""
+  #NOTE(g): Partial updates version the current row merged with the changes, so it has the driver's types
+  if isinstance(value, decimal.Decimal):
+    return str(value)
+  elif isinstance(value, (bytes, bytearray)):
+    return base64.b64encode(value).decode('ascii')
+  elif isinstance(value, datetime.datetime):
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+  elif isinstance(value, (datetime.date, datetime.time)):
+    return value.isoformat()
+  elif isinstance(value, datetime.timedelta):
+    return str(value)
+  
+  raise TypeError('Cannot encode for a record version: %s' % type(value))
+
+
+def _DecodePayload(payload):
+  """Returns tuple (data, is_delta), decoded from _EncodePayload()"""
+  (prefix, encoded) = (payload.split(':', 1) + [''])[:2]
+  
+  # Plain JSON, from before the other formats, or not worth compressing
+  if prefix not in ('z', 'd', 'dz'):
+    return (json.loads(payload), False)
+  
+  payload = encoded
+  
+  if 'z' in prefix:
+    payload = zlib.decompress(base64.b64decode(payload)).decode('utf-8')
+  
+  return (json.loads(payload), 'd' in prefix)
+
+
+def _DecodeRecordData(payload, previous):
+  """Returns the full record data (dict) from a record_version payload, and the previous version's full record"""
+  (data, is_delta) = _DecodePayload(payload)
+  
+  if not is_delta:
+    return data
+  
+  # Apply the changes to the previous version
+  record = dict(previous)
+  record.update(data['set'])
+  for field in data['unset']:
+    record.pop(field, None)
+  
+  return record
+
+
+def _LoadRecordData(database, table, rows, query_function=Query):
+  """Returns dict, key is the record key and value is the full record data, from record_version rows.
+  
+  Rows that store changes are rebuilt from their record's versions since the last full version.
+  Deleted rows are not included.
+  
+  Args:
+    database: string, database name
+    table: string, table name
+    rows: dict, key is the record key, value is the record_version row (from _GetNewestRecordVersions)
+    query_function: function, runs the SQL (ex: transaction.Query)
+  """
+  data = {}
+  
+  # Decode the full versions, and collect the version range to rebuild the others
+  rebuild = {}
+  for (key, item) in rows.items():
+    if item['is_deleted']:
+      continue
+    
+    (payload, is_delta) = _DecodePayload(item['data'])
+    if is_delta:
+      rebuild[key] = (payload['b'], item['version'])
+    else:
+      data[key] = payload
+  
+  # Rebuild the records stored as changes, from their full version forward
+  history = _GetRecordHistory(database, table, rebuild, query_function=query_function)
+  for key in rebuild:
+    record = None
+    for item in history.get(key, []):
+      record = _DecodeRecordData(item['data'], record)
+    
+    data[key] = record
+  
+  return data
+
+
+def _GetRecordHistory(database, table, version_ranges, query_function=Query):
+  """Returns dict, key is record key, value is list of record_version rows in version order.
+  
+  Args:
+    version_ranges: dict, key is the record key, value is tuple (first version, last version) to get
+    query_function: function, runs the SQL (ex: transaction.Query)
+  """
+  keys = list(version_ranges.keys())
+  
+  data = {}
+  for offset in range(0, len(keys), query.KEY_BATCH_SIZE):
+    batch = keys[offset:offset + query.KEY_BATCH_SIZE]
+    
+    where = ' OR '.join(['(`record` = %s AND `version` BETWEEN %s AND %s)'] * len(batch))
+    sql = 'SELECT `record`, `version`, `data`, `is_deleted` FROM `record_version` WHERE `database` = %%s AND `table` = %%s AND (%s) ORDER BY `version`' % where
+    
+    params = [database, table]
+    for key in batch:
+      params += [key, int(version_ranges[key][0]), int(version_ranges[key][1])]
+    
+    result = query_function(sql, params=params)
+    
+    for item in result:
+      data.setdefault(item['record'], []).append(item)
+  
+  return data
+
+
+def _EncodeRecordVersions(database, table, records, query_function=Query):
+  """Returns dict, key is the record key and value is the payload to store in record_version.data
+  
+  If RECORD_VERSION_BASE_INTERVAL is more than 1, records are stored as the changes from 
+  their previous version, with a full version every RECORD_VERSION_BASE_INTERVAL versions.
+  Must hold the table write lock, so the previous versions dont change under us.
+  
+  Args:
+    query_function: function, runs the SQL reading the previous versions (ex: transaction.Query)
+  """
+  payloads = {}
+  
+  # Store everything in full
+  if RECORD_VERSION_BASE_INTERVAL <= 1:
+    for key in records:
+      payloads[key] = _EncodePayload(records[key])
+    
+    return payloads
+  
+  # Get the previous version of each record, to store only the changes from it
+  previous_rows = _GetNewestRecordVersions(database, table, None, keys=records.keys(), query_function=query_function)
+  previous_data = _LoadRecordData(database, table, previous_rows, query_function=query_function)
+  
+  for key in records:
+    record = records[key]
+    
+    # If we have a previous version, and we are not due for a full version, store the changes
+    if key in previous_data and isinstance(record, dict) and isinstance(previous_data[key], dict):
+      (previous_payload, is_delta) = _DecodePayload(previous_rows[key]['data'])
+      if is_delta:
+        (base_version, depth) = (previous_payload['b'], previous_payload['n'])
+      else:
+        (base_version, depth) = (previous_rows[key]['version'], 0)
+      
+      if depth + 1 < RECORD_VERSION_BASE_INTERVAL:
+        previous = previous_data[key]
+        delta = {'b':base_version, 'n':depth + 1, 
+                 'set':dict([(field, value) for (field, value) in record.items() if field not in previous or previous[field] != value]),
+                 'unset':[field for field in previous if field not in record]}
+        payloads[key] = _EncodePayload(delta, delta=True)
+        continue
+    
+    # Else, store the full record
+    payloads[key] = _EncodePayload(record)
+  
+  return payloads
+
+
+def _GetRecordWhereList(where, keys=None, params=None):
+  """Returns list of tuples (SQL WHERE clause (string), params (list)): where with its %s params, restricted to batches of keys if specified"""
+  params = list(params or [])
+  
+  if keys == None:
+    return [(where, params)]
+  
+  keys = list(set([str(key) for key in keys]))
+  
+  where_list = []
+  for offset in range(0, len(keys), query.KEY_BATCH_SIZE):
+    batch = keys[offset:offset + query.KEY_BATCH_SIZE]
+    where_list.append(('%s AND `record` IN (%s)' % (where, ', '.join(['%s'] * len(batch))), params + batch))
+  
+  return where_list
+
+
+def _GetNewestRecordVersions(database, table, version, after_version=None, keys=None, with_data=True, query_function=Query):
+  """Returns the newest record_version row for each record changed in (after_version, version].
+  
+  If version is None, there is no upper version limit.
+  
+  Relies on the (`database`, `table`, `record`, `version`) index on record_version, 
+  and (`database`, `table`, `version`) when after_version is specified without keys.
+  
+  query_function is the function to run the SQL with (ex: transaction.Query).
+  
+  Returns: dict, key is the record key (string), value is the record_version row dict
+      (`record`, `version`, `data`, `is_deleted`).  If not with_data, there is no `data`
+  """
+  columns = '`rv`.`record`, `rv`.`version`, `rv`.`is_deleted`'
+  if with_data:
+    columns += ', `rv`.`data`'
+  
+  where = '`database` = %s AND `table` = %s'
+  
+  if version != None:
+    where += " AND `version` <= %s" % int(version)
+  
+  if after_version != None:
+    where += " AND `version` > %s" % int(after_version)
+  
+  data = {}
+  for (batch_where, params) in _GetRecordWhereList(where, keys, [database, table]):
+    # Join against the newest version per record
+    sql = "SELECT %s FROM `record_version` AS `rv` " \
+          "INNER JOIN (SELECT `record`, MAX(`version`) AS `max_version` FROM `record_version` WHERE %s GROUP BY `record`) AS `latest` " \
+          "ON `rv`.`record` = `latest`.`record` AND `rv`.`version` = `latest`.`max_version` " \
+          "WHERE `rv`.`database` = %%s AND `rv`.`table` = %%s" % (columns, batch_where)
+    result = query_function(sql, params=params + [database, table])
+    
+    for item in result:
+      data[item['record']] = item
+  
+  return data
+
+
+def SetCheckpointConfig(database, table, commits=None, records=None, enabled=True, keep=None):
+  """Configure when checkpoints are created for a database table.  Turning them on creates the checkpoint tables if needed.
+  
+  Args:
+    database: string, database name
+    table: string, table name
+    commits: int or None, create a checkpoint after this many commits.  If None, CHECKPOINT_COMMITS
+    records: int or None, create a checkpoint after this many changed records.  If None, CHECKPOINT_RECORDS
+    enabled: boolean, if False, no checkpoints are created or used for this table
+    keep: int or None, keep this many of the newest checkpoints, older ones are deleted.  If None, CHECKPOINT_KEEP
+  """
+  if commits == None:
+    commits = CHECKPOINT_COMMITS
+  if records == None:
+    records = CHECKPOINT_RECORDS
+  if keep == None:
+    keep = CHECKPOINT_KEEP
+  
+  if enabled and not _EnsureCheckpointTables():
+    raise query.QueryFailure('Checkpoint tables dont exist and couldnt be created, see the log for their DDL')
+  
+  with CHECKPOINT_LOCK:
+    CHECKPOINT_CONFIG[(database, table)] = {'commits':int(commits), 'records':int(records), 'enabled':bool(enabled), 
+                                            'keep':max(1, int(keep))}
+
+
+def _GetCheckpointConfig(database, table):
+  """Returns dict, the checkpoint config of database/table: 'commits', 'records', 'enabled', 'keep'"""
+  with CHECKPOINT_LOCK:
+    return CHECKPOINT_CONFIG.get((database, table), {'commits':CHECKPOINT_COMMITS, 'records':CHECKPOINT_RECORDS, 
+                                                     'enabled':CHECKPOINTS_ENABLED, 'keep':CHECKPOINT_KEEP})
+
+
+def NoteCommit(database, table, commit_version, record_count):
+  """Count a commit to database/table, and queue a background checkpoint when it is due."""
+  config = _GetCheckpointConfig(database, table)
+  if not config['enabled']:
+    return
+  
+  cache_key = (database, table)
+  
+  with CHECKPOINT_LOCK:
+    counts = CHECKPOINT_COUNTS.setdefault(cache_key, {'commits':0, 'records':0})
+    counts['commits'] += 1
+    counts['records'] += record_count
+    
+    # Not due yet
+    if counts['commits'] < config['commits'] and counts['records'] < config['records']:
+      return
+    
+    CHECKPOINT_COUNTS[cache_key] = {'commits':0, 'records':0}
+    
+    # Start the checkpoint writer, if it isnt running yet
+    global CHECKPOINT_THREAD
+    if CHECKPOINT_THREAD == None:
+      CHECKPOINT_THREAD = threading.Thread(target=_CheckpointWriter, name='CheckpointWriter')
+      CHECKPOINT_THREAD.daemon = True
+      CHECKPOINT_THREAD.start()
+  
+  CHECKPOINT_QUEUE.put((database, table, commit_version))
+
+
+def CreateCheckpoint(database, table, version):
+  """Store the full state of database/table at version as a checkpoint.
+  
+  Returns: int, version_checkpoint.id
+  """
+  _EnsureCheckpointTables()
+  
+  data = GetRecordsAtVersion(database, table, version)
+  
+  # Write the checkpoint and all its records together, so a partial checkpoint is never used
+  #NOTE(g): The driver binds the values, payloads are JSON full of backslashes, which MySQL would unescape
+  with query.Transaction() as transaction:
+    sql = "INSERT INTO `version_checkpoint` (`database`, `table`, `version`, `record_count`) VALUES (%s, %s, %s, %s)"
+    checkpoint_id = transaction.Query(sql, (database, table, int(version), len(data)))
+    
+    if data:
+      sql = "INSERT INTO `version_checkpoint_record` (`checkpoint`, `record`, `data`) VALUES (%s, %s, %s)"
+      transaction.QueryMany(sql, [(int(checkpoint_id), key, _EncodePayload(data[key])) for key in data])
+  
+  Log('Created checkpoint: %s: %s: %s: Version: %s  Records: %s' % (checkpoint_id, database, table, version, len(data)))
+  
+  _PruneCheckpoints(database, table, _GetCheckpointConfig(database, table)['keep'])
+  
+  return checkpoint_id
+
+
+def _PruneCheckpoints(database, table, keep):
+  """Delete all but the newest keep checkpoints of database/table.  Reads older than them use record_version."""
+  with query.Transaction() as transaction:
+    sql = "SELECT `id` FROM `version_checkpoint` WHERE `database` = %s AND `table` = %s ORDER BY `version` DESC, `id` DESC"
+    old_ids = [int(item['id']) for item in transaction.Query(sql, (database, table))][keep:]
+    
+    for offset in range(0, len(old_ids), query.KEY_BATCH_SIZE):
+      sql_ids = ', '.join([str(checkpoint_id) for checkpoint_id in old_ids[offset:offset + query.KEY_BATCH_SIZE]])
+      transaction.Query("DELETE FROM `version_checkpoint_record` WHERE `checkpoint` IN (%s)" % sql_ids)
+      transaction.Query("DELETE FROM `version_checkpoint` WHERE `id` IN (%s)" % sql_ids)
+  
+  if old_ids:
+    Log('Deleted old checkpoints: %s: %s: %s' % (database, table, ', '.join([str(checkpoint_id) for checkpoint_id in old_ids])))
+
+
+def _CheckpointWriter():
+  """Background thread: create the checkpoints queued by NoteCommit()"""
+  while True:
+    (database, table, version) = CHECKPOINT_QUEUE.get()
+    
+    try:
+      CreateCheckpoint(database, table, version)
+    
+    # Never let a failed checkpoint stop the writer, reads still work without it
+    except Exception as exc:
+      Log('Failed to create checkpoint: %s: %s: %s: %s' % (database, table, version, exc), level=query.LOG_ERROR)
+
+
+def _GetCheckpoint(database, table, version):
+  """Returns dict of the newest version_checkpoint row at or below version, or None"""
+  if not _GetCheckpointConfig(database, table)['enabled'] or not _EnsureCheckpointTables():
+    return None
+  
+  sql = 'SELECT `id`, `version` FROM `version_checkpoint` WHERE `database` = %s AND `table` = %s AND `version` <= %s ORDER BY `version` DESC LIMIT 1'
+  result = Query(sql, params=[database, table, int(version)])
+  
+  if not result:
+    return None
+  
+  return result[0]
+
+
+def _GetCheckpointRecords(checkpoint_id, keys=None):
+  """Returns dict, key is the record key and value is the record data dict, of this checkpoint"""
+  data = {}
+  for (where, params) in _GetRecordWhereList('`checkpoint` = %s', keys, [int(checkpoint_id)]):
+    sql = "SELECT `record`, `data` FROM `version_checkpoint_record` WHERE %s" % where
+    result = Query(sql, params=params)
+    
+    for item in result:
+      data[item['record']] = _DecodePayload(item['data'])[0]
+  
+  return data
+
+
+def _EnsureCheckpointTables():
+  """Create the checkpoint tables, if they dont exist.  Returns boolean, True if they exist.
+  
+  Only called for tables with checkpoints turned on.  If they cant be created, their DDL
+  is logged, no checkpoints are created, and reads use record_version only.
+  """
+  global CHECKPOINT_TABLES_CREATED
+  global CHECKPOINT_TABLES_FAILED
+  
+  if CHECKPOINT_TABLES_CREATED:
+    return True
+  
+  if CHECKPOINT_TABLES_FAILED:
+    return False
+  
+  # The backend already made them
+  if query.GetBackend().creates_system_tables:
+    CHECKPOINT_TABLES_CREATED = True
+    return True
+  
+  try:
+    for sql in CHECKPOINT_TABLES_SQL:
+      Query(sql)
+    
+    CHECKPOINT_TABLES_CREATED = True
+  
+  except query.QueryFailure as exc:
+    Log('Could not create checkpoint tables, checkpoints disabled: %s: Create them with: %s' % (exc, '; '.join(CHECKPOINT_TABLES_SQL)), 
+        level=query.LOG_ERROR)
+    CHECKPOINT_TABLES_FAILED = True
+  
+  return CHECKPOINT_TABLES_CREATED
+
+
+def GetMissingRecordVersionIndexes():
+  """Returns dict of the RECORD_VERSION_INDEXES record_version is missing, key is the name, value is the DDL to add it"""
+  existing = query.GetIndexNames('record_version')
+  
+  missing = {}
+  for (name, columns) in sorted(RECORD_VERSION_INDEXES.items()):
+    if name not in existing:
+      missing[name] = query.BACKEND.GetAddIndexSql(query.DEFAULT_DB_DATABASE, 'record_version', name, columns)
+  
+  return missing
+
+
+def LogMissingRecordVersionIndexes():
+  """Log the DDL for any of the RECORD_VERSION_INDEXES that record_version is missing, without adding them.
+  
+  Returns list of the missing index names.
+  """
+  try:
+    missing = GetMissingRecordVersionIndexes()
+  except query.QueryFailure as exc:
+    Log('Could not check record_version indexes: %s' % exc, level=query.LOG_ERROR)
+    return []
+  
+  for (name, sql) in sorted(missing.items()):
+    Log('Missing record_version index: %s: Add it with: %s' % (name, sql), level=query.LOG_WARNING)
+  
+  return sorted(missing)
+
+
+def EnsureRecordVersionIndexes():
+  """Add any of the RECORD_VERSION_INDEXES that record_version is missing.
+  
+  Adding an index to a big record_version takes a while, and blocks writes to it
+  on some MySQL versions, so this only runs when asked for (--ensure-indexes, or
+  the EnsureRecordVersionIndexes RPC).  Returns list of the index names added.
+  """
+  try:
+    missing = GetMissingRecordVersionIndexes()
+  except query.QueryFailure as exc:
+    Log('Could not check record_version indexes: %s' % exc, level=query.LOG_ERROR)
+    return []
+  
+  added = []
+  for name in sorted(missing):
+    columns = RECORD_VERSION_INDEXES[name]
+    
+    Log('Adding record_version index: %s (%s)' % (name, ', '.join(columns)))
+    try:
+      query.AddIndex('record_version', name, columns)
+      added.append(name)
+    except query.QueryFailure as exc:
+      Log('Could not add record_version index: %s: %s' % (name, exc), level=query.LOG_ERROR)
+  
+  return added